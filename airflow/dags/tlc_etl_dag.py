@@ -0,0 +1,58 @@
+import os
+import sys
+from datetime import datetime
+from airflow.decorators import dag, task, task_group
+
+# The repository is mounted at TLC_PIPELINE_HOME; stage scripts run from there so
+# relative data/ and logs/ paths resolve as they do locally
+pipeline_home = os.getenv("TLC_PIPELINE_HOME", os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+sys.path.insert(0, os.path.join(pipeline_home, "scripts"))
+months = os.getenv("TLC_MONTHS", "2025-01,2025-02,2025-03").split(",")
+# Dedup looks up earlier months' runs, so transforms then run in month order (as in pipeline.py)
+chain_transforms = os.getenv("DEDUP", "false").lower() == "true"
+
+
+# One pipeline node; skipped inside when its key matches the recorded state
+@task(pool=os.getenv("TLC_AIRFLOW_POOL", "default_pool"))
+def run_stage(stage, dataset, month):
+    os.chdir(pipeline_home)
+    from pipeline import run_single
+    if run_single(stage, dataset, month) == "failed":
+        raise RuntimeError(f"{stage}/{dataset}/{month} failed, see logs/pipeline/")
+
+
+@dag(schedule=None, start_date=datetime(2025, 1, 1), catchup=False, tags=["tlc"])
+def tlc_etl():
+    # Per-month chains, one task group per month so a changed month reruns only its
+    # chain; each group returns its transform task for chaining across months
+    @task_group
+    def yellow_month(month):
+        extract = run_stage.override(task_id="extract")("extract", "yellow", month)
+        analyze = run_stage.override(task_id="analyze")("analyze", "yellow", month)
+        transform = run_stage.override(task_id="transform")("transform", "yellow", month)
+        verify_processed = run_stage.override(task_id="verify_processed")("verify_processed", "yellow", month)
+        verify_borough = run_stage.override(task_id="verify_borough")("verify_borough", "yellow", month)
+        load = run_stage.override(task_id="load", pool="warehouse")("load", "yellow", month)
+        extract >> [analyze, transform]
+        transform >> [verify_processed, verify_borough]
+        verify_processed >> load
+        return transform
+
+    @task_group
+    def green_month(month):
+        extract = run_stage.override(task_id="extract")("extract", "green", month)
+        verify_green = run_stage.override(task_id="verify_green")("verify_green", "green", month)
+        transform = run_stage.override(task_id="transform")("transform", "green", month)
+        extract >> [verify_green, transform]
+        return transform
+
+    for name, month_group in (("yellow", yellow_month), ("green", green_month)):
+        previous = None
+        for month in sorted(months):
+            transform = month_group.override(group_id=f"{name}_{month}")(month)
+            if chain_transforms and previous is not None:
+                previous >> transform
+            previous = transform
+
+
+tlc_etl()
@@ -2,12 +2,21 @@ import pyarrow.parquet as pq
 import pandas as pd
 import os
 import logging
+from parquet_metadata import footer_profile, fill_missing_stats, missing_stats_columns, row_groups_outside
+from cleaning_rules import month_bounds
+from dq_scanner import dataset_checks, needed_columns, scan_file, write_report
+from metrics import StageMetrics, timer
+from sampling import describe, sample_fraction, sampling_enabled, select_row_groups
+from sketches import SketchSet, build_sketches, describe_change, record_month, sketch_root
+from storage import open_storage
 
 # Configuration
 raw_path = "data/raw/2025/yellow/"
 log_path = "logs/yellow/"
 dataset = "yellow"
-months = ["2025-01", "2025-02", "2025-03"]
+months = os.getenv("TLC_MONTHS", "2025-01,2025-02,2025-03").split(",")
+analyze_mode = os.getenv("ANALYZE_MODE", "metadata")  # "metadata" (footer statistics) or "full"
+storage = open_storage()  # Raw files are read through the storage layer (STORAGE_URL)
 
 # Expected columns for raw Yellow data
 expected_columns = [
@@ -18,12 +27,203 @@ expected_columns = [
     "cbd_congestion_fee"
 ]
 
+# Valid codes for categorical checks
+categorical_values = dataset_checks[dataset]["valid_codes"]
+
 # Create log directory
 os.makedirs(log_path, exist_ok=True)
 
 # Configure logger
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+
+# Full analysis: read the whole table into pandas (with SAMPLE_FRACTION, only the
+# sampled row groups, and counts are reported for the sample as read)
+def analyze_full(file_path, metrics=None):
+    # Read full dataset
+    with timer(metrics, "read"):
+        if sampling_enabled():
+            metadata = storage.metadata(file_path)
+            row_groups = select_row_groups(metadata, "tpep_pickup_datetime", month_of(file_path))
+            table = pq.ParquetFile(storage.fetch(file_path, row_groups=row_groups)).read_row_groups(row_groups)
+            scope = f"sample of {table.num_rows}/{metadata.num_rows} rows"
+        else:
+            table = pq.read_table(storage.fetch(file_path))
+            scope = "full"
+        df_full = table.to_pandas()
+    if metrics is not None:
+        metrics.add("rows_in", len(df_full))
+    columns = df_full.columns.tolist()
+    logger.info(f"{file_path}: {len(df_full)} rows ({scope})")
+    logger.info(f"Columns: {columns}")
+
+    # Verify expected columns
+    missing_cols = [col for col in expected_columns if col not in columns]
+    if missing_cols:
+        logger.warning(f"Missing columns: {missing_cols}")
+    else:
+        logger.info("All expected columns present")
+
+    # Null checks for all columns
+    for col in expected_columns:
+        if col in df_full.columns:
+            null_count = df_full[col].isnull().sum()
+            logger.info(f"Null {col} ({scope}): {null_count}")
+        else:
+            logger.warning(f"{col} not found in full data")
+
+    # Timestamp validation (full dataset) with debugging
+    if "tpep_pickup_datetime" in df_full.columns and "tpep_dropoff_datetime" in df_full.columns:
+        logger.info("Starting timestamp validation...")
+        df_full["tpep_pickup_datetime"] = pd.to_datetime(
+            df_full["tpep_pickup_datetime"], errors='coerce')
+        df_full["tpep_dropoff_datetime"] = pd.to_datetime(
+            df_full["tpep_dropoff_datetime"], errors='coerce')
+        invalid_pickup = df_full[df_full["tpep_pickup_datetime"].isna()]
+        invalid_dropoff = df_full[df_full["tpep_dropoff_datetime"].isna()]
+        if not invalid_pickup.empty or not invalid_dropoff.empty:
+            logger.warning(
+                f"Invalid pickup dates ({scope}): {len(invalid_pickup)} rows")
+            logger.warning(
+                f"Invalid dropoff dates ({scope}): {len(invalid_dropoff)} rows")
+            # Sample rows only at DEBUG (LOG_LEVEL=DEBUG)
+            if not invalid_pickup.empty and logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    f"Sample invalid pickup dates:\n{invalid_pickup.head().to_string()}")
+            if not invalid_dropoff.empty and logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    f"Sample invalid dropoff dates:\n{invalid_dropoff.head().to_string()}")
+        else:
+            logger.info("No invalid pickup or dropoff dates found")
+    else:
+        logger.warning("Timestamp columns missing, skipping validation")
+
+    # Categorical value checks (full dataset)
+    if "VendorID" in df_full.columns:
+        valid_vendors = df_full["VendorID"].isin([1, 2, 6, 7]).sum()
+        logger.info(
+            f"Valid VendorIDs (1, 2, 6, 7) in {scope}: {valid_vendors}/{len(df_full)}")
+    if "payment_type" in df_full.columns:
+        valid_payments = df_full["payment_type"].isin(
+            [0, 1, 2, 3, 4, 5, 6]).sum()
+        logger.info(
+            f"Valid payment_types (0-6) in {scope}: {valid_payments}/{len(df_full)}")
+    if "RatecodeID" in df_full.columns:
+        valid_rates = df_full["RatecodeID"].isin(
+            [1, 2, 3, 4, 5, 6, 99]).sum()
+        logger.info(
+            f"Valid RatecodeIDs (1-6, 99) in {scope}: {valid_rates}/{len(df_full)}")
+
+    # Outlier checks (full dataset)
+    if "trip_distance" in df_full.columns:
+        high_distance = len(df_full[df_full["trip_distance"] > 100])
+        logger.info(f"trip_distance > 100 miles in {scope}: {high_distance}")
+    if "fare_amount" in df_full.columns:
+        high_fare = len(df_full[df_full["fare_amount"] > 1000])
+        logger.info(f"fare_amount > $1000 in {scope}: {high_fare}")
+
+
+# Metadata analysis: rows, schema, nulls and invalid timestamps from the Parquet
+# footer; value checks run in one fused scan of only the columns they need (of the
+# sampled row groups with SAMPLE_FRACTION, scaled to the whole file) that also builds
+# the month's raw distribution sketches (not for a sample)
+def analyze_metadata(file_path, metrics=None):
+    with timer(metrics, "footer"):
+        local_file = storage.fetch(file_path, columns=[])
+        profile = footer_profile(local_file)
+    columns = profile["schema"].names
+    logger.info(f"{file_path}: {profile['num_rows']} rows")
+    logger.info(f"Columns: {columns}")
+
+    # Verify expected columns
+    missing_cols = [col for col in expected_columns if col not in columns]
+    if missing_cols:
+        logger.warning(f"Missing columns: {missing_cols}")
+    else:
+        logger.info("All expected columns present")
+
+    # Null checks for all columns (projected read only where statistics are missing)
+    with timer(metrics, "fill_stats"):
+        storage.fetch(file_path, missing_stats_columns(profile, expected_columns))
+        read_columns = fill_missing_stats(local_file, profile, expected_columns)
+    if read_columns:
+        logger.info(f"Statistics missing, read columns: {read_columns}")
+    for col in expected_columns:
+        if col in columns:
+            logger.info(f"Null {col} (full): {profile['null_counts'][col]}")
+        else:
+            logger.warning(f"{col} not found in full data")
+
+    # Timestamp validation: typed timestamp columns are only invalid when null
+    if "tpep_pickup_datetime" in columns and "tpep_dropoff_datetime" in columns:
+        invalid_pickup = profile["null_counts"]["tpep_pickup_datetime"]
+        invalid_dropoff = profile["null_counts"]["tpep_dropoff_datetime"]
+        if invalid_pickup or invalid_dropoff:
+            logger.warning(f"Invalid pickup dates (full): {invalid_pickup} rows")
+            logger.warning(
+                f"Invalid dropoff dates (full): {invalid_dropoff} rows")
+        else:
+            logger.info("No invalid pickup or dropoff dates found")
+        logger.info(
+            f"Pickup range: {profile['min']['tpep_pickup_datetime']} to {profile['max']['tpep_pickup_datetime']}")
+        # Row groups reaching outside the file's month, from their footer min/max
+        metadata = pq.read_metadata(local_file)
+        for col in ("tpep_pickup_datetime", "tpep_dropoff_datetime"):
+            low, high = month_bounds(month_of(file_path), profile["schema"].field(col).type)
+            outside = row_groups_outside(metadata, col, low, high)
+            if outside:
+                logger.warning(
+                    f"{col} outside {month_of(file_path)} in {len(outside)} of {profile['num_row_groups']} "
+                    f"row groups: " + ", ".join(f"#{i} {first} to {last}" for i, first, last in outside[:10]))
+            else:
+                logger.info(f"{col} within {month_of(file_path)} in every row group")
+    else:
+        logger.warning("Timestamp columns missing, skipping validation")
+
+    # Categorical, outlier and duration checks in one projected streaming pass
+    # (nulls already come from the footer)
+    checks = dict(dataset_checks[dataset], null_columns=[])
+    row_groups = None
+    if sampling_enabled():
+        row_groups = select_row_groups(pq.read_metadata(local_file), checks["pickup"], month_of(file_path))
+        logger.info(f"Sampling {len(row_groups)} of {profile['num_row_groups']} row groups "
+                    f"(SAMPLE_FRACTION={sample_fraction})")
+    with timer(metrics, "fetch"):
+        storage.fetch(file_path, needed_columns(checks, columns), row_groups)
+    sketches = SketchSet(checks["pickup"], checks["dropoff"]) if build_sketches and row_groups is None else None
+    report = scan_file(local_file, checks, metrics=metrics, row_groups=row_groups, month=month_of(file_path),
+                       sketches=sketches)
+    sample = report.get("sample")
+    report["null_counts"] = {col: profile["null_counts"][col]
+                             for col in expected_columns if col in columns}
+    write_report(report, os.path.join(
+        log_path, f"dq_{dataset}_{month_of(file_path)}.json"))
+    for col, count in report["valid_codes"].items():
+        logger.info(
+            f"Valid {col}s {categorical_values[col]} in full: "
+            f"{describe(count, sample, f'valid_codes.{col}')}/{profile['num_rows']}")
+    if "trip_distance" in columns:
+        logger.info(f"trip_distance > 100 miles in full: "
+                    f"{describe(report['above_threshold']['trip_distance'], sample, 'above_threshold.trip_distance')}")
+    if "fare_amount" in columns:
+        logger.info(f"fare_amount > $1000 in full: "
+                    f"{describe(report['above_threshold']['fare_amount'], sample, 'above_threshold.fare_amount')}")
+    logger.info(
+        f"Negative trip durations: {describe(report['negative_duration'], sample, 'negative_duration')}")
+    if sketches is not None:
+        with timer(metrics, "sketch_write"):
+            previous, changes = record_month(sketches, dataset, "raw", month_of(file_path))
+        logger.info(f"Stored raw distribution sketches in {sketch_root}{dataset}")
+        for name, change in (changes or {}).items():
+            if change["drift"]:
+                logger.warning(f"Distribution drift since {previous}: {describe_change(name, change)}")
+
+
+# Month from a raw file name like yellow_tripdata_2025-01.parquet
+def month_of(file_path):
+    return os.path.basename(file_path).rsplit("_", 1)[-1].split(".")[0]
+
 
 # Process each raw Yellow file
 for month in months:
@@ -35,7 +235,7 @@ for month in months:
     logger.addHandler(file_handler)
 
     file_path = f"{raw_path}/yellow_tripdata_{month}.parquet"
-    if not os.path.exists(file_path):
+    if not storage.exists(file_path):
         logger.warning(f"{file_path}: File not found")
         logger.removeHandler(file_handler)
         file_handler.close()
@@ -44,76 +244,12 @@ for month in months:
 
     try:
         logger.info(f"Analyzing {file_path}")
-        # Read full dataset
-        table = pq.read_table(file_path)
-        df_full = table.to_pandas()
-        columns = df_full.columns.tolist()
-        logger.info(f"{file_path}: {len(df_full)} rows")
-        logger.info(f"Columns: {columns}")
-
-        # Verify expected columns
-        missing_cols = [col for col in expected_columns if col not in columns]
-        if missing_cols:
-            logger.warning(f"Missing columns: {missing_cols}")
-        else:
-            logger.info("All expected columns present")
-
-        # Null checks for all columns
-        for col in expected_columns:
-            if col in df_full.columns:
-                null_count = df_full[col].isnull().sum()
-                logger.info(f"Null {col} (full): {null_count}")
-            else:
-                logger.warning(f"{col} not found in full data")
-
-        # Timestamp validation (full dataset) with debugging
-        if "tpep_pickup_datetime" in df_full.columns and "tpep_dropoff_datetime" in df_full.columns:
-            logger.info("Starting timestamp validation...")
-            df_full["tpep_pickup_datetime"] = pd.to_datetime(
-                df_full["tpep_pickup_datetime"], errors='coerce')
-            df_full["tpep_dropoff_datetime"] = pd.to_datetime(
-                df_full["tpep_dropoff_datetime"], errors='coerce')
-            invalid_pickup = df_full[df_full["tpep_pickup_datetime"].isna()]
-            invalid_dropoff = df_full[df_full["tpep_dropoff_datetime"].isna()]
-            if not invalid_pickup.empty or not invalid_dropoff.empty:
-                logger.warning(
-                    f"Invalid pickup dates (full): {len(invalid_pickup)} rows")
-                logger.warning(
-                    f"Invalid dropoff dates (full): {len(invalid_dropoff)} rows")
-                if not invalid_pickup.empty:
-                    logger.info(
-                        f"Sample invalid pickup dates:\n{invalid_pickup.head().to_string()}")
-                if not invalid_dropoff.empty:
-                    logger.info(
-                        f"Sample invalid dropoff dates:\n{invalid_dropoff.head().to_string()}")
-            else:
-                logger.info("No invalid pickup or dropoff dates found")
+        metrics = StageMetrics("analyze", dataset=dataset, month=month)
+        if analyze_mode == "full":
+            analyze_full(file_path, metrics)
         else:
-            logger.warning("Timestamp columns missing, skipping validation")
-
-        # Categorical value checks (full dataset)
-        if "VendorID" in df_full.columns:
-            valid_vendors = df_full["VendorID"].isin([1, 2, 6, 7]).sum()
-            logger.info(
-                f"Valid VendorIDs (1, 2, 6, 7) in full: {valid_vendors}/{len(df_full)}")
-        if "payment_type" in df_full.columns:
-            valid_payments = df_full["payment_type"].isin(
-                [0, 1, 2, 3, 4, 5, 6]).sum()
-            logger.info(
-                f"Valid payment_types (0-6) in full: {valid_payments}/{len(df_full)}")
-        if "RatecodeID" in df_full.columns:
-            valid_rates = df_full["RatecodeID"].isin(
-                [1, 2, 3, 4, 5, 6, 99]).sum()
-            logger.info(
-                f"Valid RatecodeIDs (1-6, 99) in full: {valid_rates}/{len(df_full)}")
-
-        # Outlier checks (full dataset)
-        if "trip_distance" in df_full.columns:
-            high_distance = len(df_full[df_full["trip_distance"] > 100])
-            logger.info(f"trip_distance > 100 miles in full: {high_distance}")
-        if "fare_amount" in df_full.columns:
-            high_fare = len(df_full[df_full["fare_amount"] > 1000])
-            logger.info(f"fare_amount > $1000 in full: {high_fare}")
+            analyze_metadata(file_path, metrics)
+        metrics.emit()
 
     except Exception as e:
         logger.error(f"Error analyzing {file_path}: {e}", exc_info=True)
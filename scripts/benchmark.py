@@ -0,0 +1,173 @@
+import pyarrow.parquet as pq
+import os
+import sys
+import json
+import logging
+import shutil
+import subprocess
+import time
+from dotenv import load_dotenv
+
+# Configuration
+load_dotenv()
+bench_path = os.path.abspath(os.getenv("BENCH_WORKDIR", "data/benchmark/"))  # Workspace the stages run in
+bench_rows = int(os.getenv("BENCH_ROWS", "1000000"))  # Synthetic rows per month
+bench_months = os.getenv("BENCH_MONTHS", "2025-01").split(",")
+bench_stages = os.getenv("BENCH_STAGES", "analyze,transform,verify_processed,load").split(",")
+repeats = int(os.getenv("BENCH_REPEATS", "3"))  # Best run of each stage is reported
+threshold = float(os.getenv("BENCH_THRESHOLD", "0.15"))  # Allowed rows/s drop and peak RSS growth
+baseline_path = os.getenv("BENCH_BASELINE", "logs/benchmark/baseline.json")
+update_baseline = os.getenv("BENCH_UPDATE_BASELINE", "false").lower() == "true"
+log_path = "logs/benchmark/"
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+lookup_file = "data/raw/2025/lookup/taxi_zone_lookup.csv"
+raw_file = "data/raw/2025/yellow/yellow_tripdata_{month}.parquet"
+
+# Benchmarked stages: script, metrics stage name and default settings (variables
+# already set in the environment win, e.g. LOAD_METHOD=insert)
+benchmarks = {
+    "analyze": {"script": "analyze_raw_yellow.py", "metrics": "analyze", "env": {}},
+    "transform": {"script": "transform_yellow.py", "metrics": "transform", "env": {}},
+    "verify_processed": {"script": "verify_processed.py", "metrics": "verify_processed", "env": {}},
+    "load": {"script": "load_to_snowflake.py", "metrics": "load",
+             "env": {"LOAD_BACKEND": "sqlite", "LOAD_METHOD": "bulk", "FULL_RELOAD": "true",
+                     "LOCAL_DB_LATENCY": "0"}},
+}
+
+# Create log directory
+os.makedirs(log_path, exist_ok=True)
+
+# Configure logger
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+log_file = os.path.join(log_path, "benchmark.log")
+file_handler = logging.FileHandler(log_file)
+file_handler.setFormatter(logging.Formatter(
+    "%(asctime)s - %(levelname)s - %(message)s"))
+logger.addHandler(file_handler)
+
+
+def stage_env(stage):
+    env = dict(os.environ, TLC_DATASET="yellow", TLC_DATASETS="yellow", TLC_MONTHS=",".join(bench_months),
+               METRICS_FORMAT="jsonl", METRICS_PATH="logs/metrics/")
+    for name, value in benchmarks[stage]["env"].items():
+        env.setdefault(name, value)
+    return env
+
+
+# Synthetic yellow months in the workspace, regenerated only when the row count changed
+def prepare_data():
+    os.makedirs(os.path.dirname(os.path.join(bench_path, lookup_file)), exist_ok=True)
+    if os.path.exists(lookup_file) and not os.path.exists(os.path.join(bench_path, lookup_file)):
+        shutil.copy(lookup_file, os.path.join(bench_path, lookup_file))
+    missing = [month for month in bench_months
+               if not os.path.exists(os.path.join(bench_path, raw_file.format(month=month)))
+               or pq.read_metadata(os.path.join(bench_path, raw_file.format(month=month))).num_rows != bench_rows]
+    if not missing:
+        return
+    logger.info(f"Generating {bench_rows} synthetic rows for {missing}")
+    env = dict(os.environ, SYNTH_ROWS=str(bench_rows), TLC_DATASETS="yellow", TLC_MONTHS=",".join(missing))
+    subprocess.run([sys.executable, os.path.join(scripts_dir, "synthetic_data.py")],
+                   cwd=bench_path, env=env, check=True, stdout=subprocess.DEVNULL)
+
+
+# Summaries a stage appended to its metrics file since offset
+def read_summaries(stage, offset):
+    path = os.path.join(bench_path, "logs", "metrics", f"{stage}.jsonl")
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        f.seek(offset)
+        return [record for record in map(json.loads, f) if "batch" not in record]
+
+
+def metrics_offset(stage):
+    path = os.path.join(bench_path, "logs", "metrics", f"{stage}.jsonl")
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+# One run of a stage over all benchmark months -> result, or None if it failed.
+# Throughput is rows over the stage's own wall time (interpreter startup excluded);
+# stages without row counters are measured against the generated rows.
+def run_stage(stage):
+    spec = benchmarks[stage]
+    offset = metrics_offset(spec["metrics"])
+    start = time.perf_counter()
+    with open(os.path.join(log_path, f"{stage}.out"), "w") as output:
+        returncode = subprocess.run([sys.executable, os.path.join(scripts_dir, spec["script"])],
+                                    cwd=bench_path, env=stage_env(stage),
+                                    stdout=output, stderr=subprocess.STDOUT).returncode
+    process_seconds = time.perf_counter() - start
+    summaries = read_summaries(spec["metrics"], offset)
+    if returncode != 0 or not summaries:
+        logger.error(f"{stage} failed (exit code {returncode}, {len(summaries)} metric records)")
+        return None
+    rows = sum(summary["counters"].get("rows_in", summary["counters"].get("rows_out", 0))
+               for summary in summaries) or bench_rows * len(bench_months)
+    stage_seconds = sum(summary["wall_seconds"] for summary in summaries)
+    return {
+        "rows": rows,
+        "stage_seconds": round(stage_seconds, 6),
+        "process_seconds": round(process_seconds, 6),
+        "rows_per_second": round(rows / stage_seconds, 1) if stage_seconds > 0 else None,
+        "peak_rss_bytes": max(summary["peak_rss_bytes"] for summary in summaries),
+    }
+
+
+# Stage results that fell behind the baseline by more than the threshold
+def regressions(results, baseline):
+    found = []
+    for stage, result in results.items():
+        before = baseline.get("stages", {}).get(stage)
+        if result is None:
+            found.append(f"{stage}: failed")
+            continue
+        if before is None or before.get("rows") != result["rows"]:
+            continue
+        if result["rows_per_second"] < before["rows_per_second"] * (1 - threshold):
+            found.append(f"{stage}: {result['rows_per_second']:.0f} rows/s vs "
+                         f"{before['rows_per_second']:.0f} baseline")
+        if result["peak_rss_bytes"] > before["peak_rss_bytes"] * (1 + threshold):
+            found.append(f"{stage}: peak RSS {result['peak_rss_bytes'] / 2**20:.0f} MiB vs "
+                         f"{before['peak_rss_bytes'] / 2**20:.0f} MiB baseline")
+    return found
+
+
+if __name__ == "__main__":
+    os.makedirs(bench_path, exist_ok=True)
+    prepare_data()
+    results = {}
+    for stage in bench_stages:
+        runs = [run_stage(stage) for _ in range(repeats)]
+        runs = [run for run in runs if run is not None]
+        results[stage] = max(runs, key=lambda run: run["rows_per_second"] or 0) if len(runs) == repeats else None
+        if results[stage] is not None:
+            result = results[stage]
+            logger.info(f"{stage}: {result['rows']} rows, {result['rows_per_second']:.0f} rows/s, "
+                        f"{result['stage_seconds']:.2f}s, peak RSS {result['peak_rss_bytes'] / 2**20:.0f} MiB")
+            print(f"{stage:<18} {result['rows_per_second']:>12.0f} rows/s "
+                  f"{result['peak_rss_bytes'] / 2**20:>8.0f} MiB peak RSS")
+
+    report = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "rows_per_month": bench_rows,
+              "months": bench_months, "repeats": repeats, "stages": results}
+    with open(os.path.join(log_path, f"benchmark_{time.strftime('%Y%m%dT%H%M%S')}.json"), "w") as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+    found = regressions(results, baseline or {})
+    for message in found:
+        logger.error(f"Regression beyond {threshold:.0%}: {message}")
+        print(f"REGRESSION {message}")
+    if (update_baseline or baseline is None) and not found:
+        os.makedirs(os.path.dirname(baseline_path) or ".", exist_ok=True)
+        with open(baseline_path, "w") as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Baseline written to {baseline_path}")
+
+    logger.removeHandler(file_handler)
+    file_handler.close()
+    if found:
+        sys.exit(1)
@@ -0,0 +1,364 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from contextlib import nullcontext
+
+# Declarative cleaning rules per TLC dataset. Each spec is compiled by
+# compile_rules into one vectorized reject code plus a projection to "schema":
+#   aliases   raw column name -> canonical name (applied before any rule)
+#   pickup / dropoff   timestamps that must fall inside the month, dropoff >= pickup
+#   required  columns that must be non-null (NaN counts as null)
+#   max       inclusive upper caps; nulls fail the cap
+#   excluded  codes that drop a row; nulls pass (use required to drop them)
+#   derived   column -> rule {"column", "in", "then", "else"} recomputed after filtering
+#   zones     output column -> (location ID column, lookup attribute)
+#   identity  output columns that identify a trip, hashed to find duplicates (dedup.py)
+#   schema    output columns and types; columns missing from the raw file are null
+cleaning_rules = {
+    "yellow": {
+        "file_prefix": "yellow_tripdata",
+        "aliases": {"airport_fee": "Airport_fee"},
+        "pickup": "tpep_pickup_datetime",
+        "dropoff": "tpep_dropoff_datetime",
+        "required": ["passenger_count", "RatecodeID", "store_and_fwd_flag",
+                     "congestion_surcharge", "Airport_fee", "payment_type"],
+        "max": {"tip_amount": 100, "trip_distance": 100},
+        "excluded": {"PULocationID": [265], "payment_type": [3, 4, 5]},
+        "derived": {"Airport_fee": {"column": "PULocationID", "in": [1, 132], "then": 5.0, "else": 0.0}},
+        "zones": {"Borough": ("PULocationID", "Borough")},
+        "identity": ["VendorID", "tpep_pickup_datetime", "tpep_dropoff_datetime", "PULocationID",
+                     "DOLocationID", "trip_distance", "fare_amount", "total_amount"],
+        "schema": pa.schema([
+            ("VendorID", pa.int64()),
+            ("tpep_pickup_datetime", pa.timestamp("ns")),
+            ("tpep_dropoff_datetime", pa.timestamp("ns")),
+            ("passenger_count", pa.float64()),
+            ("trip_distance", pa.float64()),
+            ("RatecodeID", pa.float64()),
+            ("PULocationID", pa.int64()),
+            ("DOLocationID", pa.int64()),
+            ("payment_type", pa.int64()),
+            ("fare_amount", pa.float64()),
+            ("tip_amount", pa.float64()),
+            ("improvement_surcharge", pa.float64()),
+            ("total_amount", pa.float64()),
+            ("congestion_surcharge", pa.float64()),
+            ("Airport_fee", pa.float64()),
+            ("cbd_congestion_fee", pa.float64()),
+            ("Borough", pa.string()),
+        ]),
+    },
+    "green": {
+        "file_prefix": "green_tripdata",
+        "aliases": {},
+        "pickup": "lpep_pickup_datetime",
+        "dropoff": "lpep_dropoff_datetime",
+        "required": ["passenger_count", "RatecodeID", "congestion_surcharge", "payment_type"],
+        "max": {"tip_amount": 100, "trip_distance": 100},
+        "excluded": {"PULocationID": [265], "payment_type": [3, 4, 5]},
+        "derived": {},
+        "zones": {"Borough": ("PULocationID", "Borough")},
+        "identity": ["VendorID", "lpep_pickup_datetime", "lpep_dropoff_datetime", "PULocationID",
+                     "DOLocationID", "trip_distance", "fare_amount", "total_amount"],
+        "schema": pa.schema([
+            ("VendorID", pa.int64()),
+            ("lpep_pickup_datetime", pa.timestamp("ns")),
+            ("lpep_dropoff_datetime", pa.timestamp("ns")),
+            ("passenger_count", pa.float64()),
+            ("trip_distance", pa.float64()),
+            ("RatecodeID", pa.float64()),
+            ("PULocationID", pa.int64()),
+            ("DOLocationID", pa.int64()),
+            ("payment_type", pa.int64()),
+            ("trip_type", pa.float64()),
+            ("fare_amount", pa.float64()),
+            ("tip_amount", pa.float64()),
+            ("improvement_surcharge", pa.float64()),
+            ("total_amount", pa.float64()),
+            ("congestion_surcharge", pa.float64()),
+            ("cbd_congestion_fee", pa.float64()),
+            ("Borough", pa.string()),
+        ]),
+    },
+    "fhv": {
+        "file_prefix": "fhv_tripdata",
+        "aliases": {"dropOff_datetime": "dropoff_datetime", "PUlocationID": "PULocationID",
+                    "DOlocationID": "DOLocationID"},
+        "pickup": "pickup_datetime",
+        "dropoff": "dropoff_datetime",
+        "required": ["dispatching_base_num"],
+        "max": {},
+        "excluded": {"PULocationID": [265]},
+        "derived": {},
+        "zones": {"Borough": ("PULocationID", "Borough")},
+        "identity": ["dispatching_base_num", "pickup_datetime", "dropoff_datetime", "PULocationID",
+                     "DOLocationID", "Affiliated_base_number"],
+        "schema": pa.schema([
+            ("dispatching_base_num", pa.string()),
+            ("pickup_datetime", pa.timestamp("ns")),
+            ("dropoff_datetime", pa.timestamp("ns")),
+            ("PULocationID", pa.int64()),
+            ("DOLocationID", pa.int64()),
+            ("SR_Flag", pa.int64()),
+            ("Affiliated_base_number", pa.string()),
+            ("Borough", pa.string()),
+        ]),
+    },
+    "hvfhv": {
+        "file_prefix": "fhvhv_tripdata",
+        "aliases": {"trip_miles": "trip_distance", "tips": "tip_amount", "airport_fee": "Airport_fee"},
+        "pickup": "pickup_datetime",
+        "dropoff": "dropoff_datetime",
+        "required": ["hvfhs_license_num", "PULocationID", "base_passenger_fare"],
+        "max": {"tip_amount": 100, "trip_distance": 100},
+        "excluded": {"PULocationID": [265]},
+        "derived": {},
+        "zones": {"Borough": ("PULocationID", "Borough")},
+        "identity": ["hvfhs_license_num", "dispatching_base_num", "pickup_datetime", "dropoff_datetime",
+                     "PULocationID", "DOLocationID", "trip_distance", "base_passenger_fare"],
+        "schema": pa.schema([
+            ("hvfhs_license_num", pa.string()),
+            ("dispatching_base_num", pa.string()),
+            ("request_datetime", pa.timestamp("ns")),
+            ("pickup_datetime", pa.timestamp("ns")),
+            ("dropoff_datetime", pa.timestamp("ns")),
+            ("PULocationID", pa.int64()),
+            ("DOLocationID", pa.int64()),
+            ("trip_distance", pa.float64()),
+            ("trip_time", pa.int64()),
+            ("base_passenger_fare", pa.float64()),
+            ("tolls", pa.float64()),
+            ("bcf", pa.float64()),
+            ("sales_tax", pa.float64()),
+            ("congestion_surcharge", pa.float64()),
+            ("Airport_fee", pa.float64()),
+            ("tip_amount", pa.float64()),
+            ("driver_pay", pa.float64()),
+            ("shared_request_flag", pa.string()),
+            ("shared_match_flag", pa.string()),
+            ("access_a_ride_flag", pa.string()),
+            ("wav_request_flag", pa.string()),
+            ("wav_match_flag", pa.string()),
+            ("cbd_congestion_fee", pa.float64()),
+            ("Borough", pa.string()),
+        ]),
+    },
+}
+
+
+# Narrow code and ID types for the compact output profile
+compact_types = {
+    "VendorID": pa.int8(),
+    "RatecodeID": pa.int8(),
+    "payment_type": pa.int8(),
+    "PULocationID": pa.int16(),
+    "DOLocationID": pa.int16(),
+}
+
+
+# Copy of a spec with the compact output schema: narrow codes and IDs, float32
+# amounts, microsecond timestamps and dictionary-encoded zone columns
+def with_compact_schema(spec):
+    fields = []
+    for field in spec["schema"]:
+        if field.name in compact_types:
+            field = field.with_type(compact_types[field.name])
+        elif field.name in spec["zones"]:
+            field = field.with_type(pa.dictionary(pa.int32(), pa.string()))
+        elif pa.types.is_timestamp(field.type):
+            field = field.with_type(pa.timestamp("us"))
+        elif pa.types.is_float64(field.type):
+            field = field.with_type(pa.float32())
+        fields.append(field)
+    return dict(spec, schema=pa.schema(fields))
+
+
+# Copy of a spec with extra lookup columns named <PU|DO>_<attribute>, e.g.
+# "DO_Borough" or "PU_service_zone", appended to its schema as strings
+def with_zone_columns(spec, names):
+    if not names:
+        return spec
+    spec = dict(spec, zones=dict(spec["zones"]))
+    fields = list(spec["schema"])
+    for name in names:
+        side, attribute = name.split("_", 1)
+        if side not in ("PU", "DO"):
+            raise ValueError(f"Zone column {name} must start with PU_ or DO_")
+        spec["zones"][name] = (f"{side}LocationID", attribute)
+        fields.append(pa.field(name, pa.string()))
+    spec["schema"] = pa.schema(fields)
+    return spec
+
+
+# Raw columns a spec needs (matched after renaming through its aliases)
+def source_columns(spec, raw_names):
+    wanted = set(spec["schema"].names) | set(spec["required"]) | set(spec["max"]) | set(spec["excluded"])
+    wanted |= {spec["pickup"], spec["dropoff"]}
+    wanted |= {rule["column"] for rule in spec["derived"].values()}
+    wanted |= {column for column, _ in spec["zones"].values()}
+    return [name for name in raw_names if spec["aliases"].get(name, name) in wanted]
+
+
+def rename_aliases(batch, aliases):
+    if not any(name in aliases for name in batch.schema.names):
+        return batch
+    return pa.RecordBatch.from_arrays(
+        batch.columns, names=[aliases.get(name, name) for name in batch.schema.names])
+
+
+# Month bounds [start, end) as int64 values in the unit of a timestamp column
+def month_bounds(month, ts_type):
+    start = pd.Timestamp(f"{month}-01")
+    end = start + pd.offsets.MonthBegin(1)
+    per_unit = {"s": 10**9, "ms": 10**6, "us": 10**3, "ns": 1}[ts_type.unit]
+    return start.value // per_unit, end.value // per_unit
+
+
+# Rejection reasons, one bit each (in this order) of the int16 reject code of a row
+reject_reasons = ["invalid_date", "out_of_month", "negative_duration", "null_field",
+                  "tip_cap", "distance_cap", "unknown_zone", "excluded_payment", "other"]
+# Reason per rule mask; null_<column> masks are null_field, unlisted masks other
+mask_reasons = {
+    "invalid_date": "invalid_date",
+    "out_of_month": "out_of_month",
+    "negative_duration": "negative_duration",
+    "tip_amount_cap": "tip_cap",
+    "trip_distance_cap": "distance_cap",
+    "excluded_PULocationID": "unknown_zone",
+    "excluded_payment_type": "excluded_payment",
+}
+# Masks computed from the timestamps: null only where a timestamp is null, which
+# invalid_date already reports
+date_masks = ("out_of_month", "negative_duration")
+
+
+def reason_bit(mask_name):
+    reason = "null_field" if mask_name.startswith("null_") else mask_reasons.get(mask_name, "other")
+    return 1 << reject_reasons.index(reason)
+
+
+# Reason names set in a reject code
+def decode_reasons(code):
+    return [reason for i, reason in enumerate(reject_reasons) if code & (1 << i)]
+
+
+def is_null(values):
+    return pc.is_null(values, nan_is_null=True)
+
+
+# Named keep-masks for every rule of a spec on one batch (True = row passes).
+# Nulls inside a mask mean "fails"; callers fill them with False.
+def rule_masks(spec, batch, month):
+    names = batch.schema.names
+    pickup = batch.column(spec["pickup"])
+    dropoff = batch.column(spec["dropoff"])
+    start, end = month_bounds(month, pickup.type)
+    pickup_i = pc.cast(pickup, pa.int64())
+    dropoff_i = pc.cast(dropoff, pa.int64())
+
+    masks = {
+        "invalid_date": pc.invert(pc.or_(pc.is_null(pickup), pc.is_null(dropoff))),
+        "out_of_month": pc.and_kleene(
+            pc.and_kleene(pc.greater_equal(pickup_i, start), pc.less(pickup_i, end)),
+            pc.and_kleene(pc.greater_equal(dropoff_i, start), pc.less(dropoff_i, end))),
+        "negative_duration": pc.greater_equal(dropoff_i, pickup_i),
+    }
+    for column in spec["required"]:
+        if column in names:
+            masks[f"null_{column}"] = pc.invert(is_null(batch.column(column)))
+    for column, cap in spec["max"].items():
+        if column in names:
+            masks[f"{column}_cap"] = pc.less_equal(batch.column(column), cap)
+    for column, codes in spec["excluded"].items():
+        if column in names:
+            values = batch.column(column)
+            masks[f"excluded_{column}"] = pc.fill_null(pc.invert(
+                pc.is_in(values, value_set=pa.array(codes, values.type))), True)
+    return masks
+
+
+# Cast (or null-fill) a column to its output type
+def project_column(batch, name, field):
+    if name not in batch.schema.names:
+        return pa.nulls(batch.num_rows, field.type)
+    return cast_column(batch.column(name), field.type)
+
+
+# Cast to an output type. NaN becomes null before float -> integer casts, and
+# timestamps may drop sub-microsecond digits (raw TLC files are microsecond)
+def cast_column(column, to_type):
+    if column.type == to_type:
+        return column
+    if pa.types.is_floating(column.type) and pa.types.is_integer(to_type):
+        column = pc.if_else(pc.is_nan(column), pa.scalar(None, column.type), column)
+    return pc.cast(column, to_type, safe=not pa.types.is_timestamp(to_type))
+
+
+def cast_table(table, schema):
+    return pa.Table.from_arrays(
+        [cast_column(table.column(field.name), field.type) for field in schema], schema=schema)
+
+
+# Compile a spec for one month into clean(batch) -> (table, stats): one int16 reject
+# code per row over all rules (a row is kept when it is 0), one filter, then zone
+# gathers, derived fields and projection.
+# zones is a zone_index.ZoneIndex; gathered columns stay dictionary-encoded if the schema says so.
+# timer(phase) is an optional context-manager factory timing the filter, join and project phases.
+# With quarantine, stats["rejected"] holds the rejected source rows plus their reject_reason code.
+def compile_rules(spec, month, zones, timer=None, quarantine=False):
+    schema = spec["schema"]
+    timer = timer or (lambda name: nullcontext())
+
+    def clean(batch):
+        with timer("filter"):
+            batch = rename_aliases(batch, spec["aliases"])
+            masks = rule_masks(spec, batch, month)
+            codes = None
+            for name, mask in masks.items():
+                failed = pc.if_else(pc.fill_null(mask, name in date_masks), pa.scalar(0, pa.int16()),
+                                    pa.scalar(reason_bit(name), pa.int16()))
+                codes = failed if codes is None else pc.bit_wise_or(codes, failed)
+            keep = pc.equal(codes, 0)
+            stats = {
+                "rows_in": batch.num_rows,
+                "invalid_date_rows": batch.num_rows - (pc.sum(masks["invalid_date"]).as_py() or 0),
+                # rule -> rows failing it (a row can fail several rules)
+                "rules_dropped": {name: batch.num_rows - (pc.sum(mask).as_py() or 0)
+                                  for name, mask in masks.items()},
+                # reason -> rejected rows with that reason set
+                "reject_reasons": dict.fromkeys(reject_reasons, 0),
+                "unmatched_zones": {},
+                "rejected": None,
+            }
+            for entry in pc.value_counts(codes).to_pylist():
+                for reason in decode_reasons(entry["values"]):
+                    stats["reject_reasons"][reason] += entry["counts"]
+            if quarantine:
+                rejected = pc.invert(keep)
+                stats["rejected"] = pa.Table.from_batches([batch.filter(rejected)]).append_column(
+                    "reject_reason", codes.filter(rejected))
+            batch = batch.filter(keep)
+
+        columns = {}
+        with timer("join"):
+            for output, (id_column, attribute) in spec["zones"].items():
+                ids = batch.column(id_column)
+                positions = zones.positions(ids)
+                columns[output] = zones.gather(ids, attribute, positions)
+                # output -> (rows without a value, location IDs without a value)
+                stats["unmatched_zones"][output] = zones.unmatched(ids, attribute, positions)
+
+        with timer("project"):
+            for output, rule in spec["derived"].items():
+                source = batch.column(rule["column"])
+                columns[output] = pc.if_else(pc.fill_null(pc.is_in(
+                    source, value_set=pa.array(rule["in"], source.type)), False), rule["then"], rule["else"])
+
+            table = pa.Table.from_arrays(
+                [cast_column(columns[field.name], field.type) if field.name in columns
+                 else project_column(batch, field.name, field) for field in schema],
+                schema=schema)
+        stats["rows_out"] = table.num_rows
+        return table, stats
+
+    return clean
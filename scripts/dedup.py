@@ -0,0 +1,229 @@
+import fcntl
+import hashlib
+import os
+import shutil
+from contextlib import contextmanager
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from cleaning_rules import month_bounds, project_column, rename_aliases
+
+# Duplicate trip detection within and across months. Each trip's identity columns
+# are hashed to 64 bits. Within a month, repeats are dropped as the cleaned rows
+# stream by (StreamDeduplicator), and the hashes of the kept trips are recorded as
+# the month's run, sorted and split into one file per hash partition:
+#   <root>/<dataset>/runs/<month>/p-<partition>.npy
+# A file resubmits an earlier month's trip with that month's pickup time, so the
+# cleaning rules reject it as out_of_month. Those rows are hashed from the raw batch
+# before cleaning (earlier_hashes) and looked up in the run of their pickup month only
+# (count_resubmitted), binary-searching memory-mapped partitions, so memory stays at
+# one month's Bloom filter whatever the number of months. Runs are replaced under an
+# exclusive per-dataset lock and read under a shared one; months must still be
+# processed in order (the pipeline chains them) for the earlier runs to exist.
+dedup_root = "data/state/dedup/"
+partitions = int(os.getenv("DEDUP_PARTITIONS", "64"))
+bloom_bits = int(os.getenv("DEDUP_BLOOM_MB", "32")) * 8 * 2**20  # Month filter, rounded down to a power of two
+bloom_hashes = 4
+null_hash = np.uint64(0x9E3779B97F4A7C15)
+
+
+# splitmix64 finalizer, element-wise on uint64 (wraps around)
+def mix(values):
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+# One column as uint64 values that do not depend on the output profile: integers and
+# microsecond timestamps as int64, floats as cents, strings through a stable digest
+# of their distinct values; nulls (and NaN) map to null_hash
+def column_values(column):
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    if pa.types.is_dictionary(column.type):
+        column = column.cast(column.type.value_type)
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        encoded = pc.dictionary_encode(column)
+        digests = np.array([int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "little")
+                            for value in encoded.dictionary.to_pylist()] + [int(null_hash)], dtype=np.uint64)
+        indices = pc.fill_null(encoded.indices, len(encoded.dictionary)).to_numpy(zero_copy_only=False)
+        return digests[indices]
+    if pa.types.is_timestamp(column.type):
+        column = pc.cast(column, pa.timestamp("us"), safe=False)
+    elif pa.types.is_floating(column.type):
+        column = pc.round(pc.multiply(pc.if_else(pc.is_nan(column), pa.scalar(None, column.type), column), 100))
+    values = pc.cast(column, pa.int64(), safe=False)
+    return np.where(pc.is_null(values).to_numpy(zero_copy_only=False), null_hash,
+                    pc.fill_null(values, 0).to_numpy(zero_copy_only=False).view(np.uint64))
+
+
+# 64-bit hash of each row over the given columns
+def row_hashes(batch, columns):
+    hashes = np.full(batch.num_rows, np.uint64(len(columns)), dtype=np.uint64)
+    for i, name in enumerate(columns):
+        salt = np.uint64((i + 1) * int(null_hash) % 2**64)
+        hashes = mix(hashes ^ mix(column_values(batch.column(name)) + salt))
+    return hashes
+
+
+class BloomFilter:
+    def __init__(self, bits):
+        self.mask = np.uint64((1 << (int(bits).bit_length() - 1)) - 1)
+        self.bits = np.zeros((int(self.mask) + 1) // 8, dtype=np.uint8)
+
+    # Bit positions per hash (double hashing over the two 32-bit halves)
+    def positions(self, hashes):
+        low, high = hashes & np.uint64(0xFFFFFFFF), hashes >> np.uint64(32)
+        return [(low + np.uint64(i) * high) & self.mask for i in range(bloom_hashes)]
+
+    def add(self, hashes):
+        for position in self.positions(hashes):
+            np.bitwise_or.at(self.bits, position >> np.uint64(3),
+                             np.left_shift(1, position & np.uint64(7)).astype(np.uint8))
+
+    def might_contain(self, hashes):
+        found = np.ones(len(hashes), dtype=bool)
+        for position in self.positions(hashes):
+            found &= ((self.bits[position >> np.uint64(3)] >> (position & np.uint64(7)).astype(np.uint8)) & 1).astype(bool)
+        return found
+
+
+# Rows of unique_hashes found in one of run_files (only candidates are looked up)
+def seen_before(unique_hashes, candidates, run_files):
+    seen = np.zeros(len(unique_hashes), dtype=bool)
+    for run_file in run_files:
+        lookup = np.flatnonzero(candidates & ~seen)
+        if not len(lookup) or not os.path.exists(run_file):
+            continue
+        run = np.load(run_file, mmap_mode="r")
+        values = unique_hashes[lookup]
+        index = np.minimum(np.searchsorted(run, values), len(run) - 1)
+        seen[lookup[run[index] == values]] = True
+    return seen
+
+
+# Per-dataset state lock: exclusive while a month's run is replaced, shared for lookups
+@contextmanager
+def state_lock(dataset_dir, exclusive):
+    os.makedirs(dataset_dir, exist_ok=True)
+    with open(os.path.join(dataset_dir, "lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# Identity hashes of the raw rows of a batch picked up before month, as {pickup month
+# ("YYYY-MM"): hashes}. The raw columns are renamed and cast as the cleaning rules
+# project them, so a resubmitted trip hashes as it did in its own month's run.
+def earlier_hashes(batch, spec, schema, month):
+    batch = rename_aliases(batch, spec["aliases"])
+    pickup = batch.column(spec["pickup"])
+    start, _ = month_bounds(month, pickup.type)
+    earlier = pc.fill_null(pc.less(pc.cast(pickup, pa.int64()), start), False)
+    if not pc.any(earlier).as_py():
+        return {}
+    rows = batch.filter(earlier)
+    identity = pa.table({name: project_column(rows, name, schema.field(name)) for name in spec["identity"]})
+    hashes = row_hashes(identity, spec["identity"])
+    pickup_months = pc.strftime(rows.column(spec["pickup"]), format="%Y-%m").to_numpy(zero_copy_only=False)
+    return {pickup_month: hashes[pickup_months == pickup_month] for pickup_month in np.unique(pickup_months)}
+
+
+# Rows of earlier_hashes output found in the run of their pickup month; months without
+# a run (not processed) count nothing
+def count_resubmitted(dataset, hashes_by_month, root=dedup_root):
+    dataset_dir = os.path.join(root, dataset)
+    found = 0
+    with state_lock(dataset_dir, exclusive=False):
+        for month, hashes in hashes_by_month.items():
+            run = os.path.join(dataset_dir, "runs", month)
+            if not len(hashes) or not os.path.isdir(run):
+                continue
+            parts = hashes % np.uint64(partitions)
+            for p in np.unique(parts):
+                values = hashes[parts == p]
+                found += int(seen_before(values, np.ones(len(values), dtype=bool),
+                                         [os.path.join(run, f"p-{int(p):03d}.npy")]).sum())
+    return found
+
+
+# Within-month deduplication of cleaned tables as they stream by, for every transform
+# path. keep_mask drops rows seen earlier in the month, batch by batch, keeping first
+# occurrences. Kept hashes are spilled as one sorted chunk per batch, and a Bloom
+# filter over the month so far screens which hashes need an exact lookup in them.
+# finish() records the month's run; abort() discards it.
+class StreamDeduplicator:
+    def __init__(self, dataset, month, columns, root=dedup_root):
+        self.month = month
+        self.columns = columns
+        self.dataset_dir = os.path.join(root, dataset)
+        self.run_dir = os.path.join(self.dataset_dir, "runs")
+        self.spill_dir = os.path.join(self.dataset_dir, f"stream-{month}")
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+        os.makedirs(self.spill_dir)
+        os.makedirs(self.run_dir, exist_ok=True)
+        self.month_bloom = BloomFilter(bloom_bits)
+        self.chunk_files = []
+        self.within_month = 0
+
+    # Boolean mask of the rows of a cleaned table to keep
+    def keep_mask(self, table):
+        hashes = row_hashes(table, self.columns)
+        order = np.argsort(hashes, kind="stable")
+        first = np.ones(len(hashes), dtype=bool)
+        first[1:] = hashes[order][1:] != hashes[order][:-1]
+        keep = np.zeros(len(hashes), dtype=bool)
+        keep[order[first]] = True
+        self.within_month += int((~first).sum())
+
+        # Repeats of rows kept from earlier batches of the month
+        rows = np.flatnonzero(keep)
+        values = hashes[rows]
+        repeated = seen_before(values, self.month_bloom.might_contain(values), self.chunk_files)
+        keep[rows[repeated]] = False
+        self.within_month += int(repeated.sum())
+
+        new_hashes = np.sort(values[~repeated])
+        if len(new_hashes):
+            chunk_file = os.path.join(self.spill_dir, f"chunk-{len(self.chunk_files):06d}.npy")
+            np.save(chunk_file, new_hashes)
+            self.chunk_files.append(chunk_file)
+            self.month_bloom.add(new_hashes)
+        return pa.array(keep)
+
+    # Partition the kept hashes into the month's run, replacing it under the state
+    # lock; returns the number of rows dropped as repeats within the month
+    def finish(self):
+        new_run = os.path.join(self.run_dir, f"{self.month}.tmp")
+        shutil.rmtree(new_run, ignore_errors=True)
+        os.makedirs(new_run)
+        try:
+            files = [open(os.path.join(self.spill_dir, f"p-{p:03d}.bin"), "wb") for p in range(partitions)]
+            try:
+                for chunk_file in self.chunk_files:
+                    chunk = np.load(chunk_file)
+                    part = (chunk % np.uint64(partitions)).astype(np.int64)
+                    order = np.argsort(part, kind="stable")
+                    bounds = np.cumsum(np.bincount(part, minlength=partitions))[:-1]
+                    for p, values in enumerate(np.split(chunk[order], bounds)):
+                        if len(values):
+                            values.tofile(files[p])
+            finally:
+                for f in files:
+                    f.close()
+            for p in range(partitions):
+                values = np.sort(np.fromfile(os.path.join(self.spill_dir, f"p-{p:03d}.bin"), dtype=np.uint64))
+                if len(values):
+                    np.save(os.path.join(new_run, f"p-{p:03d}.npy"), values)
+            with state_lock(self.dataset_dir, exclusive=True):
+                shutil.rmtree(os.path.join(self.run_dir, self.month), ignore_errors=True)
+                os.replace(new_run, os.path.join(self.run_dir, self.month))
+        finally:
+            shutil.rmtree(new_run, ignore_errors=True)
+            self.abort()
+        return self.within_month
+
+    def abort(self):
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
@@ -0,0 +1,218 @@
+import json
+import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from memory_budget import MemoryGovernor, row_bytes
+from metrics import compressed_bytes, timer
+from sampling import apply_estimates, estimate_totals, flatten, sample_summary
+
+# Check configuration per raw dataset. Every check runs on the same streamed
+# batch, and only the columns the checks reference are read from the file.
+dataset_checks = {
+    "yellow": {
+        "pickup": "tpep_pickup_datetime",
+        "dropoff": "tpep_dropoff_datetime",
+        "null_columns": [
+            "VendorID", "tpep_pickup_datetime", "tpep_dropoff_datetime", "passenger_count",
+            "trip_distance", "RatecodeID", "store_and_fwd_flag", "PULocationID", "DOLocationID",
+            "payment_type", "fare_amount", "extra", "mta_tax", "tip_amount", "tolls_amount",
+            "improvement_surcharge", "total_amount", "congestion_surcharge", "Airport_fee",
+            "cbd_congestion_fee"
+        ],
+        "valid_codes": {
+            "VendorID": [1, 2, 6, 7],
+            "payment_type": [0, 1, 2, 3, 4, 5, 6],
+            "RatecodeID": [1, 2, 3, 4, 5, 6, 99],
+        },
+        "thresholds": {"trip_distance": 100, "fare_amount": 1000, "tip_amount": 100},
+        "tip_analysis": False,
+    },
+    "green": {
+        "pickup": "lpep_pickup_datetime",
+        "dropoff": "lpep_dropoff_datetime",
+        "null_columns": [
+            "PULocationID", "tip_amount", "payment_type", "lpep_pickup_datetime",
+            "trip_distance", "lpep_dropoff_datetime", "fare_amount"
+        ],
+        "valid_codes": {},
+        "thresholds": {"tip_amount": 100, "trip_distance": 100},
+        "tip_analysis": True,
+    },
+}
+
+# Rows kept as examples for each threshold / duration check
+sample_size = 2
+location_ids = pa.array(range(1, 266))  # Valid TLC zone IDs
+# Report sections holding counts; a sampled scan scales these to the whole file
+count_sections = ["null_counts", "valid_codes", "above_threshold", "invalid_pu_location", "negative_duration",
+                  "payment_type_counts", "zero_tips", "flex_fare_tips", "borough_tips"]
+
+
+# Columns a check configuration needs from the file
+def needed_columns(checks, available):
+    columns = set(checks["null_columns"]) | set(checks["valid_codes"]) | set(checks["thresholds"])
+    columns |= {checks["pickup"], checks["dropoff"], "PULocationID", "payment_type"}
+    if checks["tip_analysis"]:
+        columns |= {"tip_amount", "fare_amount"}
+    return [col for col in available if col in columns]
+
+
+def new_report(checks, columns, num_rows):
+    return {
+        "rows": num_rows,
+        "columns": columns,
+        "missing_columns": [col for col in checks["null_columns"] if col not in columns],
+        "null_counts": {col: 0 for col in checks["null_columns"] if col in columns},
+        "valid_codes": {col: 0 for col in checks["valid_codes"] if col in columns},
+        "above_threshold": {col: 0 for col in checks["thresholds"] if col in columns},
+        "invalid_pu_location": 0,
+        "negative_duration": 0,
+        "payment_type_counts": {},
+        "zero_tips": {"credit": 0, "cash": 0},
+        "flex_fare_tips": {"sum": 0.0, "count": 0},
+        "borough_tips": {},
+        "unknown_borough_location_ids": [],
+        "samples": {},
+    }
+
+
+def add_samples(report, name, batch, mask, columns):
+    samples = report["samples"].setdefault(name, [])
+    if len(samples) >= sample_size:
+        return
+    rows = batch.filter(mask).select(
+        [col for col in columns if col in batch.schema.names]).slice(0, sample_size - len(samples))
+    samples.extend(rows.to_pylist())
+
+
+def count_true(mask):
+    return pc.sum(mask).as_py() or 0
+
+
+# Evaluate every configured check on one record batch and fold it into the report
+def scan_batch(report, batch, checks, zones):
+    names = batch.schema.names
+
+    for col in report["null_counts"]:
+        report["null_counts"][col] += batch.column(col).null_count
+
+    for col in report["valid_codes"]:
+        values = batch.column(col)
+        report["valid_codes"][col] += count_true(pc.is_in(
+            values, value_set=pa.array(checks["valid_codes"][col], values.type)))
+
+    for col in report["above_threshold"]:
+        mask = pc.fill_null(pc.greater(batch.column(col), checks["thresholds"][col]), False)
+        report["above_threshold"][col] += count_true(mask)
+        sample_columns = ([col, "payment_type", "PULocationID", "trip_distance"] if col == "tip_amount"
+                          else [col, "PULocationID", checks["pickup"]])
+        add_samples(report, f"{col}_above_threshold", batch, mask, sample_columns)
+
+    if checks["pickup"] in names and checks["dropoff"] in names:
+        mask = pc.fill_null(pc.less(batch.column(checks["dropoff"]), batch.column(checks["pickup"])), False)
+        report["negative_duration"] += count_true(mask)
+        add_samples(report, "negative_duration", batch, mask,
+                    [checks["pickup"], checks["dropoff"], "PULocationID"])
+
+    if "PULocationID" in names:
+        pu_ids = batch.column("PULocationID")
+        report["invalid_pu_location"] += count_true(pc.invert(
+            pc.is_in(pu_ids, value_set=location_ids.cast(pu_ids.type))))
+
+    if "payment_type" in names:
+        counts = pc.value_counts(batch.column("payment_type"))
+        for item in counts.to_pylist():
+            key = str(item["values"])
+            report["payment_type_counts"][key] = report["payment_type_counts"].get(key, 0) + item["counts"]
+
+    if checks["tip_analysis"] and {"tip_amount", "payment_type", "PULocationID"} <= set(names):
+        scan_tips(report, batch, zones)
+
+
+# Tip checks: zero tips by payment type, Flex Fare tips, and tips by pickup borough
+def scan_tips(report, batch, zones):
+    tips = batch.column("tip_amount")
+    payment_type = batch.column("payment_type")
+    zero_tip = pc.equal(tips, 0)
+    report["zero_tips"]["credit"] += count_true(pc.and_(pc.equal(payment_type, 1), zero_tip))
+    report["zero_tips"]["cash"] += count_true(pc.and_(pc.equal(payment_type, 2), zero_tip))
+
+    flex_tips = pc.filter(tips, pc.fill_null(pc.equal(payment_type, 0), False))
+    report["flex_fare_tips"]["sum"] += pc.sum(flex_tips).as_py() or 0.0
+    report["flex_fare_tips"]["count"] += len(flex_tips) - flex_tips.null_count
+
+    # Credit and cash trips, with their dictionary-encoded borough from the zone index
+    paid = batch.filter(pc.fill_null(pc.is_in(payment_type, value_set=pa.array([1, 2], payment_type.type)), False))
+    pu_ids = paid.column("PULocationID")
+    positions = zones.positions(pu_ids)
+    borough = zones.gather(pu_ids, "Borough", positions)
+    _, unknown_ids = zones.unmatched(pu_ids, "Borough", positions)
+    report["unknown_borough_location_ids"] = sorted(
+        set(report["unknown_borough_location_ids"]) | set(unknown_ids))
+
+    columns = {"Borough": borough, "tip_amount": paid.column("tip_amount")}
+    if "fare_amount" in paid.schema.names:
+        fare = paid.column("fare_amount")
+        columns["tip_percentage"] = pc.if_else(
+            pc.greater(fare, 0), pc.multiply(pc.divide(paid.column("tip_amount"), fare), 100), None)
+    grouped = pa.table(columns).group_by("Borough").aggregate(
+        [(col, agg) for col in columns if col != "Borough" for agg in ("sum", "count")])
+    for row in grouped.to_pylist():
+        if row["Borough"] is None:
+            continue
+        stats = report["borough_tips"].setdefault(row["Borough"], {})
+        for key, value in row.items():
+            if key != "Borough":
+                stats[key] = stats.get(key, 0) + (value or 0)
+
+
+def scan_batches(report, batches, checks, zones, metrics, sketches=None):
+    while True:
+        with timer(metrics, "read"):
+            batch = next(batches, None)
+        if batch is None:
+            break
+        with timer(metrics, "check"):
+            scan_batch(report, batch, checks, zones)
+        if sketches is not None:
+            with timer(metrics, "sketch"):
+                sketches.add(batch)
+
+
+# One streaming pass over a raw file with only the needed columns projected, in
+# batches sized to the memory budget. With row_groups (sampled for month), only those
+# row groups are scanned, one at a time, and the counts are scaled to the whole file
+# (intervals under report["sample"]). sketches (a SketchSet) also takes every batch read.
+def scan_file(path, checks, zones=None, metrics=None, row_groups=None, month=None, sketches=None):
+    parquet_file = pq.ParquetFile(path)
+    metadata = parquet_file.metadata
+    available = parquet_file.schema_arrow.names
+    columns = needed_columns(checks, available)
+    report = new_report(checks, available, metadata.num_rows)
+    governor = MemoryGovernor("scan", row_bytes(metadata, columns))
+    if row_groups is None:
+        scan_batches(report, governor.batches(parquet_file, columns=columns), checks, zones, metrics, sketches)
+    else:
+        clusters = []
+        for i in row_groups:
+            before = flatten({section: report[section] for section in count_sections})
+            scan_batches(report, governor.batches(parquet_file, [i], columns), checks, zones, metrics, sketches)
+            after = flatten({section: report[section] for section in count_sections})
+            clusters.append({name: value - before.get(name, 0) for name, value in after.items()})
+        estimates = estimate_totals(metadata, row_groups, clusters, checks["pickup"], month)
+        apply_estimates(report, {name: estimate for name, estimate in estimates.items()
+                                 if name.split(".")[0] in count_sections})
+        report["sample"] = sample_summary(metadata, row_groups, estimates)
+    if metrics is not None:
+        metrics.add("rows_in", sum(metadata.row_group(i).num_rows for i in row_groups)
+                    if row_groups is not None else metadata.num_rows)
+        metrics.add("bytes_read", compressed_bytes(metadata, row_groups, columns))
+    return report
+
+
+def write_report(report, path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, default=str)
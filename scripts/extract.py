@@ -0,0 +1,168 @@
+import pyarrow.parquet as pq
+import os
+import json
+import logging
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from metrics import StageMetrics
+from storage import open_storage
+
+# Configuration
+load_dotenv()
+base_url = os.getenv(
+    "TLC_BASE_URL", "https://d37ci6vzurychx.cloudfront.net/trip-data")
+raw_path = "data/raw/"
+log_path = "logs/extract/"
+months = os.getenv("TLC_MONTHS", "2025-01,2025-02,2025-03").split(",")
+datasets = os.getenv("TLC_DATASETS", "yellow,green,fhv,hvfhv").split(",")
+max_workers = int(os.getenv("EXTRACT_WORKERS", "8"))
+retries = 3
+block_size = 1 << 20  # Stream downloads 1 MB at a time
+timeout = 60
+storage = open_storage()  # Downloaded files are published through the storage layer (STORAGE_URL)
+
+# File name prefix per dataset on the TLC site
+file_prefixes = {
+    "yellow": "yellow_tripdata",
+    "green": "green_tripdata",
+    "fhv": "fhv_tripdata",
+    "hvfhv": "fhvhv_tripdata",
+}
+
+# Create log directory
+os.makedirs(log_path, exist_ok=True)
+
+# Configure logger
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+log_file = os.path.join(log_path, "extract.log")
+file_handler = logging.FileHandler(log_file)
+file_handler.setFormatter(logging.Formatter(
+    "%(asctime)s - %(levelname)s - %(message)s"))
+logger.addHandler(file_handler)
+
+
+# Size and ETag of the remote file
+def head(url):
+    request = urllib.request.Request(url, method="HEAD")
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return int(response.headers.get("Content-Length", -1)), response.headers.get("ETag")
+
+
+def read_meta(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_meta(path, meta):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(f"{path}.tmp", path)
+
+
+# Download url into part_file, resuming with a Range request when a partial
+# download of the same remote version (ETag) is already on disk
+def download_part(url, part_file, size, etag):
+    part_meta_file = f"{part_file}.meta.json"
+    offset = 0
+    if os.path.exists(part_file) and read_meta(part_meta_file) == {"size": size, "etag": etag}:
+        offset = os.path.getsize(part_file)
+    write_meta(part_meta_file, {"size": size, "etag": etag})
+    if 0 <= size == offset:
+        return
+
+    request = urllib.request.Request(url)
+    if offset:
+        request.add_header("Range", f"bytes={offset}-")
+        if etag:
+            request.add_header("If-Range", etag)
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        if offset and response.status != 206:
+            offset = 0  # Server ignored the range (file changed), start over
+        elif offset:
+            logger.info(f"Resuming {url} at byte {offset}")
+        with open(part_file, "ab" if offset else "wb") as f:
+            for block in iter(lambda: response.read(block_size), b""):
+                f.write(block)
+
+
+# Fetch one (dataset, month) file: skip when size and ETag are unchanged,
+# otherwise download to a .part file, validate the Parquet footer and rename
+def fetch(dataset, month):
+    file_name = f"{file_prefixes[dataset]}_{month}.parquet"
+    url = f"{base_url}/{file_name}"
+    output_dir = os.path.join(raw_path, month.split("-")[0], dataset)
+    output_file = os.path.join(output_dir, file_name)
+    part_file = f"{output_file}.part"
+    meta_file = f"{output_file}.meta.json"
+    os.makedirs(output_dir, exist_ok=True)
+    metrics = StageMetrics("extract", dataset=dataset, month=month)
+
+    for attempt in range(1, retries + 1):
+        try:
+            with metrics.phase("head"):
+                size, etag = head(url)
+            if read_meta(meta_file) == {"size": size, "etag": etag} and storage.size(output_file) == size:
+                logger.info(f"{output_file} unchanged, skipping")
+                return "skipped"
+
+            start = time.perf_counter()
+            with metrics.phase("download"):
+                download_part(url, part_file, size, etag)
+            downloaded = os.path.getsize(part_file)
+            if size >= 0 and downloaded != size:
+                raise IOError(
+                    f"Incomplete download: {downloaded} of {size} bytes")
+
+            # Validate by reading the Parquet footer before publishing the file
+            try:
+                with metrics.phase("validate"):
+                    metadata = pq.read_metadata(part_file)
+            except Exception:
+                os.remove(part_file)  # Complete but unreadable, do not resume from it
+                raise
+            os.replace(part_file, output_file)
+            with metrics.phase("upload"):
+                storage.put(output_file)
+            write_meta(meta_file, {"size": size, "etag": etag})
+            os.remove(f"{part_file}.meta.json")
+            elapsed = time.perf_counter() - start
+            metrics.add("bytes_written", downloaded)
+            metrics.add("rows_out", metadata.num_rows)
+            metrics.emit()
+            logger.info(
+                f"Downloaded {output_file}: {downloaded / 1e6:.1f} MB, {metadata.num_rows} rows in {elapsed:.1f}s")
+            return "downloaded"
+
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                logger.warning(f"{url} not published, skipping")
+                return "missing"
+            logger.warning(f"Attempt {attempt} failed for {url}: {e}")
+        except Exception as e:
+            logger.warning(f"Attempt {attempt} failed for {url}: {e}")
+        time.sleep(2 ** attempt)
+
+    logger.error(f"Failed to download {url} after {retries} attempts")
+    return "failed"
+
+
+if __name__ == "__main__":
+    jobs = [(dataset, month) for dataset in datasets for month in months]
+    logger.info(
+        f"Fetching {len(jobs)} files from {base_url} with {max_workers} workers")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda job: fetch(*job), jobs))
+    summary = {status: results.count(status) for status in set(results)}
+    logger.info(
+        f"Extract completed in {time.perf_counter() - start:.1f}s: {summary}")
+    print(f"Extract completed: {summary}")
+
+    logger.removeHandler(file_handler)
+    file_handler.close()
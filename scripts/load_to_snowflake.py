@@ -1,14 +1,23 @@
 import pandas as pd
-import snowflake.connector
+import pyarrow.parquet as pq
 import os
 import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from warehouse import ConnectionPool, batch_rows, connect_warehouse, yellow_table_columns
+from manifest import load_manifest, save_manifest
+from metrics import StageMetrics
+from memory_budget import MemoryGovernor, row_bytes
+from storage import open_storage
 
 # Configuration
 load_dotenv()
 processed_path = "data/processed/2025/yellow/"
 log_path = "logs/yellow/"
-months = ["2025-01", "2025-02", "2025-03"]
+months = os.getenv("TLC_MONTHS", "2025-01,2025-02,2025-03").split(",")
 
 # Snowflake configuration
 snowflake_config = {
@@ -21,7 +30,19 @@ snowflake_config = {
     "insecure_mode": True
 }
 SNOWFLAKE_TABLE = os.getenv("SNOWFLAKE_TABLE", "yellow_trips_2025")
-CHUNK_SIZE = 100000  # Process 100,000 rows per chunk
+LOAD_BACKEND = os.getenv("LOAD_BACKEND", "snowflake")  # "snowflake", "sqlite" or "duckdb"
+LOAD_METHOD = os.getenv("LOAD_METHOD", "insert")  # "insert" (executemany) or "bulk" (copy per month)
+LOCAL_DB_PATH = os.getenv("LOCAL_DB_PATH", "data/warehouse/tlc.db")
+LOCAL_DB_LATENCY = float(os.getenv("LOCAL_DB_LATENCY", "0"))  # Simulated seconds per statement for local backends
+# Months loaded in parallel, one connection each ("auto": every month); with a memory
+# budget (MEMORY_BUDGET_MB) this is the upper bound, and insert chunks follow the budget
+LOAD_CONCURRENCY = len(months) if os.getenv("LOAD_CONCURRENCY") == "auto" else int(os.getenv("LOAD_CONCURRENCY", "1"))
+MANIFEST_PATH = os.getenv("LOAD_MANIFEST_PATH", "data/state/load_manifest.json")
+FULL_RELOAD = os.getenv("FULL_RELOAD", "false").lower() == "true"  # Truncate and reload every month
+MONTH_COLUMN = "tpep_pickup_datetime"  # Rows belong to the month of their pickup
+TABLE_COLUMNS = [name for name, _ in yellow_table_columns]  # Extra processed columns are not loaded
+FUSED_QUEUE_BATCHES = int(os.getenv("FUSED_QUEUE_BATCHES", "8"))  # Cleaned batches in flight in fused mode
+storage = open_storage()  # Processed files are read through the storage layer (STORAGE_URL)
 
 # Create log directory
 os.makedirs(log_path, exist_ok=True)
@@ -35,83 +56,299 @@ file_handler.setFormatter(logging.Formatter(
     "%(asctime)s - %(levelname)s - %(message)s"))
 logger.addHandler(file_handler)
 
-try:
-    # Connect to Snowflake
-    conn = snowflake.connector.connect(**snowflake_config)
-    logger.info("Connected to Snowflake")
-
-    # Truncate table to remove existing data
-    truncate_table_query = f"""
-    TRUNCATE TABLE {SNOWFLAKE_TABLE}
-    """
-    conn.cursor().execute(truncate_table_query)
-    logger.info(f"Existing data in {SNOWFLAKE_TABLE} removed")
-
-    # Create table if not exists
-    create_table_query = f"""
-    CREATE TABLE IF NOT EXISTS {SNOWFLAKE_TABLE} (
-        VendorID INTEGER,
-        tpep_pickup_datetime TIMESTAMP_NTZ,
-        tpep_dropoff_datetime TIMESTAMP_NTZ,
-        passenger_count FLOAT,
-        trip_distance FLOAT,
-        RatecodeID FLOAT,
-        PULocationID INTEGER,
-        DOLocationID INTEGER,
-        payment_type INTEGER,
-        fare_amount FLOAT,
-        tip_amount FLOAT,
-        improvement_surcharge FLOAT,
-        total_amount FLOAT,
-        congestion_surcharge FLOAT,
-        Airport_fee FLOAT,
-        cbd_congestion_fee FLOAT,
-        Borough VARCHAR
-    )
-    """
-    conn.cursor().execute(create_table_query)
-    logger.info(f"Table {SNOWFLAKE_TABLE} created or verified")
-
-    # Load each file in chunks
-    for month in months:
-        input_file = f"{processed_path}/yellow_tripdata_{month}_cleaned.parquet"
-        if not os.path.exists(input_file):
-            logger.warning(f"{input_file} not found, skipping")
-            continue
-
-        logger.info(f"Loading {input_file} into {SNOWFLAKE_TABLE}")
-        df = pd.read_parquet(input_file)
-
-        # Convert datetime columns to ISO strings
-        df['tpep_pickup_datetime'] = df['tpep_pickup_datetime'].astype(str)
-        df['tpep_dropoff_datetime'] = df['tpep_dropoff_datetime'].astype(str)
-
-        # Prepare and execute chunked INSERT statements
-        cursor = conn.cursor()
-        sql = f"INSERT INTO {SNOWFLAKE_TABLE} ({', '.join(df.columns)}) VALUES ({', '.join(['%s'] * len(df.columns))})"
-        data_chunks = [df[i:i + CHUNK_SIZE].values.tolist()
-                       for i in range(0, len(df), CHUNK_SIZE)]
-        total_rows = 0
-
-        for i, chunk in enumerate(data_chunks):
-            cursor.executemany(sql, chunk)
-            conn.commit()
-            rows_in_chunk = len(chunk)
-            total_rows += rows_in_chunk
-            logger.info(
-                f"Loaded chunk {i + 1} of {len(data_chunks)} for {month}: {rows_in_chunk} rows")
+
+# [start, end) of a month as timestamp strings, used to delete or count its rows
+def month_range(month):
+    start = pd.Timestamp(f"{month}-01")
+    end = start + pd.offsets.MonthBegin(1)
+    return str(start), str(end)
+
+
+# Remove a month's rows so it can be reloaded (runs inside the caller's transaction)
+def delete_month(warehouse, month):
+    warehouse.delete_range(SNOWFLAKE_TABLE, MONTH_COLUMN, *month_range(month))
+
+
+# Row-insert path: chunked executemany with a commit per chunk. The month delete
+# shares a transaction with the first chunk, and each commit is recorded in the
+# manifest entry so an interrupted load resumes after the last committed row.
+# Chunks are read from the file one at a time, sized by the memory governor.
+def insert_month(warehouse, input_file, month, entry, on_commit, metrics, governor):
+    resume_at = entry["committed_rows"]
+    total_rows = resume_at
+    if resume_at == 0:
+        with metrics.phase("delete"):
+            delete_month(warehouse, month)
+    else:
+        logger.info(
+            f"Resuming {month} after {resume_at} of {entry['rows']} rows ({entry['committed_chunks']} chunks)")
+
+    chunks = governor.batches(pq.ParquetFile(input_file), columns=TABLE_COLUMNS)
+    offset = 0
+    while True:
+        with metrics.phase("read"):
+            batch = next(chunks, None)
+            if batch is None:
+                break
+            offset += batch.num_rows
+            if offset <= resume_at:
+                continue  # Committed before the interruption
+            batch = batch.slice(max(resume_at - (offset - batch.num_rows), 0))
+
+            # Rows with timestamps as ISO strings, formatted as in the bulk and fused paths
+            chunk = list(batch_rows(batch))
+        with metrics.phase("insert"):
+            warehouse.insert_rows(SNOWFLAKE_TABLE, batch.schema.names, chunk)
+        with metrics.phase("commit"):
+            warehouse.commit()
+        rows_in_chunk = len(chunk)
+        total_rows += rows_in_chunk
+        entry["committed_chunks"] += 1
+        entry["committed_rows"] = total_rows
+        on_commit()
+        logger.info(
+            f"Loaded chunk {entry['committed_chunks']} for {month}: {rows_in_chunk} rows ({total_rows} of {entry['rows']})")
+    return total_rows
+
+
+# Bulk path: delete the month and copy the processed Parquet file in one transaction
+def bulk_load_month(warehouse, input_file, month, entry, on_commit, metrics, governor):
+    with metrics.phase("delete"):
+        delete_month(warehouse, month)
+    with metrics.phase("copy"):
+        total_rows = warehouse.bulk_load(SNOWFLAKE_TABLE, input_file, TABLE_COLUMNS)
+    with metrics.phase("commit"):
+        warehouse.commit()
+    return total_rows
+
+
+# Fused path: the transform hands a month's cleaned tables to put() as it produces
+# them, and a loader thread on its own connection inserts them in one transaction
+# with the month's delete. The bounded queue holds the transform back when the
+# warehouse is slower. finish(commit) ends the stream and commits (or rolls back)
+# before the transform publishes anything; record(fingerprint) then writes the
+# manifest entry with the fingerprint of the processed file published alongside, or
+# None without one, so a later file load skips the month only if it would load the
+# same file.
+class MonthStream:
+    def __init__(self, month, queue_batches=FUSED_QUEUE_BATCHES):
+        self.month = month
+        self.queue = queue.Queue(maxsize=queue_batches)
+        self.metrics = StageMetrics("load", backend=LOAD_BACKEND, method="fused", month=month)
+        self.commit = False
+        self.ended = False
+        self.error = None
+        self.total_rows = 0
+        self.thread = threading.Thread(target=self.run, name=f"fused-load-{month}")
+        self.thread.start()
+
+    def put(self, table):
+        if self.error is not None:
+            raise RuntimeError(f"Fused load of {self.month} failed") from self.error
+        self.queue.put(table.select(TABLE_COLUMNS))
+
+    # Record batches from the queue until the end marker, which carries the commit decision
+    def batches(self):
+        while True:
+            item = self.queue.get()
+            if not isinstance(item, bool):
+                yield from item.to_batches()
+                continue
+            self.commit = item
+            self.ended = True
+            return
+
+    def run(self):
+        warehouse = None
+        try:
+            warehouse = connect_warehouse(LOAD_BACKEND, snowflake_config, LOCAL_DB_PATH, LOCAL_DB_LATENCY)
+            warehouse.create_table(SNOWFLAKE_TABLE, yellow_table_columns)
+            with self.metrics.phase("delete"):
+                delete_month(warehouse, self.month)
+            with self.metrics.phase("insert"):
+                self.total_rows = warehouse.insert_batches(SNOWFLAKE_TABLE, self.batches(), TABLE_COLUMNS)
+            with self.metrics.phase("commit"):
+                if self.commit:
+                    warehouse.commit()
+                else:
+                    warehouse.rollback()
+        except Exception as e:
+            self.error = e
+            if warehouse is not None:
+                warehouse.rollback()
+            # Keep draining so the transform never blocks on a full queue
+            while not self.ended:
+                self.ended = isinstance(self.queue.get(), bool)
+        finally:
+            if warehouse is not None:
+                warehouse.close()
+
+    # End the stream; returns the rows loaded, raises if the load failed
+    def finish(self, commit=True):
+        self.queue.put(commit)
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError(f"Fused load of {self.month} failed") from self.error
+        return self.total_rows if commit else 0
+
+    # Record the committed month in the load manifest
+    def record(self, fingerprint=None):
+        manifest = load_manifest(MANIFEST_PATH)
+        manifest.setdefault(SNOWFLAKE_TABLE, {})[self.month] = {
+            "fingerprint": fingerprint,
+            "rows": self.total_rows,
+            "method": "fused",
+            "chunk_size": None,
+            "committed_chunks": 0,
+            "committed_rows": self.total_rows,
+            "status": "complete",
+        }
+        save_manifest(MANIFEST_PATH, manifest)
+        self.metrics.add("rows_out", self.total_rows)
+        self.metrics.emit()
+        logger.info(f"Streamed {self.total_rows} rows for {self.month} into {SNOWFLAKE_TABLE}")
+        return self.total_rows
+
+
+# Decide how much of a month still needs loading, based on its manifest entry:
+# returns None when the month is already loaded from an identical file,
+# otherwise the entry to load into (fresh, or resumed when that is safe)
+def plan_month(warehouse, month, entry, fingerprint, num_rows, chunk_size):
+    if entry and entry["fingerprint"] == fingerprint:
+        if entry["status"] == "complete":
+            return None
+        # Resume only if the warehouse holds exactly the rows the manifest recorded
+        if (entry["method"] == "insert" and LOAD_METHOD == "insert"
+                and warehouse.count_range(SNOWFLAKE_TABLE, MONTH_COLUMN, *month_range(month)) == entry["committed_rows"]):
+            return entry
+    return {
+        "fingerprint": fingerprint,
+        "rows": num_rows,
+        "method": LOAD_METHOD,
+        "chunk_size": chunk_size,
+        "committed_chunks": 0,
+        "committed_rows": 0,
+        "status": "loading",
+    }
+
+
+# Plan and load one month on a pooled connection; returns the rows loaded (0 if skipped)
+def load_one_month(pool, manifest, manifest_lock, worker_stats, governor, month):
+    input_file = f"{processed_path}/yellow_tripdata_{month}_cleaned.parquet"
+    if not storage.exists(input_file):
+        logger.warning(f"{input_file} not found, skipping")
+        return 0
+
+    def checkpoint():
+        with manifest_lock:
+            save_manifest(MANIFEST_PATH, manifest)
+
+    worker = threading.current_thread().name
+    with pool.connection() as warehouse:
+        fingerprint = storage.fingerprint(input_file)
+        num_rows = storage.metadata(input_file).num_rows
+        with manifest_lock:
+            previous = manifest[SNOWFLAKE_TABLE].get(month)
+        entry = plan_month(warehouse, month, previous, fingerprint, num_rows, governor.planned_batch_rows)
+        if entry is None:
+            logger.info(f"{input_file} unchanged since last load, skipping")
+            return 0
+        with manifest_lock:
+            manifest[SNOWFLAKE_TABLE][month] = entry
+        checkpoint()
 
         logger.info(
-            f"Loaded {total_rows} rows from {input_file} into {SNOWFLAKE_TABLE}")
+            f"[{worker}] Loading {input_file} into {SNOWFLAKE_TABLE} ({LOAD_METHOD})")
+        load_month = bulk_load_month if LOAD_METHOD == "bulk" else insert_month
+        metrics = StageMetrics("load", backend=LOAD_BACKEND, method=LOAD_METHOD, month=month)
+        with metrics.phase("fetch"):
+            local_file = storage.fetch(input_file)  # Cached copy; unchanged months are not downloaded again
+        metrics.add("bytes_read", os.path.getsize(local_file))
+        start = time.perf_counter()
+        try:
+            total_rows = load_month(
+                warehouse, local_file, month, entry, checkpoint, metrics, governor)
+        except Exception:
+            warehouse.rollback()
+            raise
+        elapsed = time.perf_counter() - start
+
+    with manifest_lock:
+        entry["status"] = "complete"
+        entry["committed_rows"] = total_rows
+        stats = worker_stats.setdefault(worker, {"rows": 0, "seconds": 0.0})
+        stats["rows"] += total_rows
+        stats["seconds"] += elapsed
+    checkpoint()
+    metrics.add("rows_out", total_rows)
+    metrics.emit()
+    if total_rows != num_rows:
+        logger.warning(
+            f"Row count mismatch for {month}: file has {num_rows}, loaded {total_rows}")
+    logger.info(
+        f"[{worker}] Loaded {total_rows} rows from {input_file} into {SNOWFLAKE_TABLE} in {elapsed:.1f}s ({total_rows / max(elapsed, 1e-9):.0f} rows/s)")
+    return total_rows
+
 
-    logger.info("Data load completed")
+# Governor of the load: loader threads and rows per insert chunk, planned for the widest month
+def load_governor():
+    inputs = [f"{processed_path}/yellow_tripdata_{month}_cleaned.parquet" for month in months]
+    bytes_per_row = max((row_bytes(storage.metadata(input_file), TABLE_COLUMNS)
+                         for input_file in inputs if storage.exists(input_file)), default=1.0)
+    return MemoryGovernor("load", bytes_per_row, max_workers=LOAD_CONCURRENCY)
+
+
+if __name__ == "__main__":
+    governor = load_governor()
+    pool = ConnectionPool(lambda: connect_warehouse(
+        LOAD_BACKEND, snowflake_config, LOCAL_DB_PATH, LOCAL_DB_LATENCY), governor.workers)
+    try:
+        with pool.connection() as warehouse:
+            logger.info(f"Connected to {LOAD_BACKEND}")
+
+            # Create table if not exists
+            warehouse.create_table(SNOWFLAKE_TABLE, yellow_table_columns)
+            warehouse.commit()
+            logger.info(f"Table {SNOWFLAKE_TABLE} created or verified")
+
+            # Load manifest: one entry per (table, month)
+            manifest = load_manifest(MANIFEST_PATH)
+            loaded = manifest.setdefault(SNOWFLAKE_TABLE, {})
+
+            # Full reload: truncate table to remove existing data
+            if FULL_RELOAD:
+                warehouse.truncate(SNOWFLAKE_TABLE)
+                warehouse.commit()
+                loaded.clear()
+                save_manifest(MANIFEST_PATH, manifest)
+                logger.info(f"Existing data in {SNOWFLAKE_TABLE} removed")
+
+        # Load each new or changed file, up to LOAD_CONCURRENCY months at a time
+        # (fewer while memory is tight)
+        logger.info(f"Loading with {governor.describe()}")
+        manifest_lock = threading.Lock()
+        worker_stats = {}
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=governor.workers, thread_name_prefix="loader") as executor:
+            futures = []
+            for month in months:
+                governor.admit(futures)
+                futures.append(executor.submit(
+                    load_one_month, pool, manifest, manifest_lock, worker_stats, governor, month))
+            total_rows = sum(future.result() for future in futures)
+        elapsed = time.perf_counter() - start
+
+        for worker, stats in sorted(worker_stats.items()):
+            logger.info(
+                f"[{worker}] {stats['rows']} rows in {stats['seconds']:.1f}s ({stats['rows'] / max(stats['seconds'], 1e-9):.0f} rows/s)")
+        logger.info(
+            f"Data load completed: {total_rows} rows in {elapsed:.1f}s with {governor.workers} workers")
 
-except Exception as e:
-    logger.error(f"Error loading data: {e}", exc_info=True)
-finally:
-    if 'conn' in locals():
-        conn.close()
-        logger.info("Snowflake connection closed")
+    except Exception as e:
+        logger.error(f"Error loading data: {e}", exc_info=True)
+    finally:
+        pool.close()
+        logger.info(f"{LOAD_BACKEND} connections closed")
 
-logger.removeHandler(file_handler)
-file_handler.close()
+    logger.removeHandler(file_handler)
+    file_handler.close()
@@ -0,0 +1,49 @@
+import hashlib
+import json
+import os
+
+# Bytes at the end of a Parquet file: 4-byte footer length + "PAR1" magic
+PARQUET_TAIL_SIZE = 8
+
+
+# Cheap file fingerprint: size, mtime and a hash of the Parquet footer
+# (falls back to hashing the whole file for anything that is not Parquet)
+def file_fingerprint(path):
+    stat = os.stat(path)
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        if stat.st_size >= 2 * PARQUET_TAIL_SIZE:
+            f.seek(-PARQUET_TAIL_SIZE, os.SEEK_END)
+            tail = f.read(PARQUET_TAIL_SIZE)
+        else:
+            tail = b""
+        if tail[4:] == b"PAR1":
+            footer_len = int.from_bytes(tail[:4], "little")
+            f.seek(-(footer_len + PARQUET_TAIL_SIZE), os.SEEK_END)
+            digest.update(f.read(footer_len + PARQUET_TAIL_SIZE))
+        else:
+            f.seek(0)
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return {
+        "size": stat.st_size,
+        "mtime": int(stat.st_mtime),
+        "hash": digest.hexdigest(),
+    }
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+# Write via a temp file and rename so an interrupted run never leaves a torn manifest
+def save_manifest(path, manifest):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
@@ -0,0 +1,206 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+# Memory-budget governor: batch sizes and worker counts per stage from a memory
+# budget and the bytes per row estimated from the Parquet schema and footer. While a
+# stage runs, the resident memory of its process tree is sampled between batches;
+# above the high watermark the batch size halves and parallel stages hold back a
+# worker, below the low watermark both grow back towards the plan.
+#   MEMORY_BUDGET_MB   budget of one stage run; unset uses the container (cgroup) memory
+#                      limit when there is one, 0 turns the governor off (fixed sizes)
+#   MEMORY_PROCESS_MB  resident baseline of one stage process with pandas, pyarrow and
+#                      the zone lookup loaded (default 200)
+memory_budget_mb = os.getenv("MEMORY_BUDGET_MB", "")
+process_overhead = int(os.getenv("MEMORY_PROCESS_MB", "200")) * 2**20
+default_batch_rows = 100000  # Batch size without a budget, and the size a worker must afford
+min_batch_rows = 1000
+max_batch_rows = 1048576
+target_share = 0.75  # Share of the budget a plan fills, between the watermarks
+high_watermark = 0.85
+low_watermark = 0.6
+check_interval = 0.2  # Seconds between RSS samples
+page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+# Resident bytes per decoded Arrow byte of a batch in flight: the batch itself, its
+# masks and cleaned copy, and the pandas frames and Python rows of the pandas engine
+# and row inserts (measured on the yellow benchmark)
+stage_factors = {"scan": 2.0, "transform": 4.0, "transform_pandas": 7.0, "load": 18.0}
+
+
+# Memory limit of the container (cgroup v2 or v1), None when unlimited or unknown
+def container_limit():
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < 2**60:
+            return int(value)
+    return None
+
+
+def budget_bytes():
+    if memory_budget_mb:
+        return int(float(memory_budget_mb) * 2**20) or None
+    return container_limit()
+
+
+# Decoded Arrow bytes per row of the given columns: fixed-width types from the schema,
+# variable-width ones (strings) from the uncompressed page sizes in the footer
+def row_bytes(metadata, columns=None):
+    rows = max(metadata.num_rows, 1)
+    uncompressed = {}
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        for j in range(row_group.num_columns):
+            column = row_group.column(j)
+            uncompressed[column.path_in_schema] = uncompressed.get(column.path_in_schema, 0) \
+                + column.total_uncompressed_size
+    total = 0.0
+    for field in metadata.schema.to_arrow_schema():
+        if columns is not None and field.name not in columns:
+            continue
+        try:
+            width = field.type.bit_width / 8
+        except ValueError:
+            width = uncompressed.get(field.name, 0) / rows + 4  # Values plus 32-bit offsets
+        total += width + 1 / 8  # Validity bit
+    return max(total, 1.0)
+
+
+# (workers, batch rows) for a stage: as many workers (up to max_workers) as the
+# target share of the budget holds with a default-sized batch each, then the largest
+# batch that fits each worker's part. reserve is memory a worker holds besides its batch (e.g. buffered
+# output rows); with processes every worker and the parent pay the process baseline.
+def plan(stage, bytes_per_row, max_workers=1, processes=False, reserve=0, budget=None):
+    budget = budget_bytes() if budget is None else budget
+    if not budget:
+        return max_workers, default_batch_rows
+    row_cost = bytes_per_row * stage_factors[stage]
+    per_worker = default_batch_rows * row_cost + reserve + (process_overhead if processes else 0)
+    available = budget * target_share - process_overhead
+    workers = max(1, min(max_workers, int(available // per_worker)))
+    share = available / workers - reserve - (process_overhead if processes else 0)
+    batch_rows = int(min(max_batch_rows, max(min_batch_rows, share // row_cost)))
+    return workers, max(min_batch_rows, batch_rows - batch_rows % min_batch_rows)
+
+
+# Resident bytes of a process and all its descendants (None without /proc)
+def tree_rss_bytes(pid=None):
+    pid = pid or os.getpid()
+    parents = {}
+    try:
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    # Fields after the parenthesized command name: state, ppid, ...
+                    parents.setdefault(int(f.read().rsplit(")", 1)[1].split()[1]), []).append(int(entry))
+            except (OSError, IndexError, ValueError):
+                continue
+    except OSError:
+        return None
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(parents.get(current, []))
+        try:
+            with open(f"/proc/{current}/statm") as f:
+                total += int(f.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            continue
+    return total
+
+
+# Plan of one stage run, adjusted while it runs by check()
+class MemoryGovernor:
+    def __init__(self, stage, bytes_per_row, max_workers=1, processes=False, reserve=0, budget=None):
+        self.budget = budget_bytes() if budget is None else budget
+        self.bytes_per_row = bytes_per_row
+        self.planned_workers, self.planned_batch_rows = plan(
+            stage, bytes_per_row, max_workers, processes, reserve, self.budget)
+        self.workers = self.planned_workers
+        self.batch_rows = self.planned_batch_rows
+        self.backoffs = 0
+        self.peak_rss = 0
+        self.checked = 0.0
+
+    def describe(self):
+        if not self.budget:
+            return f"no memory budget, {self.workers} workers, {self.batch_rows} rows per batch"
+        return (f"memory budget {self.budget / 2**20:.0f} MiB, ~{self.bytes_per_row:.0f} B/row: "
+                f"{self.workers} workers, {self.batch_rows} rows per batch")
+
+    # Budget of one worker process: the budget less the parent's baseline, split
+    # across the planned workers (0, i.e. no budget, without one)
+    def share(self):
+        if not self.budget:
+            return 0
+        return int((self.budget - process_overhead) / self.planned_workers)
+
+    # Sample the RSS of the process tree: back off above the high watermark, recover
+    # below the low one; returns True when it backed off
+    def check(self):
+        now = time.monotonic()
+        if not self.budget or now - self.checked < check_interval:
+            return False
+        self.checked = now
+        used = tree_rss_bytes()
+        if used is None:
+            return False
+        self.peak_rss = max(self.peak_rss, used)
+        if used > high_watermark * self.budget:
+            self.batch_rows = max(min_batch_rows, self.batch_rows // 2)
+            self.workers = max(1, self.workers - 1)
+            self.backoffs += 1
+            return True
+        if used < low_watermark * self.budget:
+            self.batch_rows = min(self.planned_batch_rows, self.batch_rows * 2)
+            self.workers = min(self.planned_workers, self.workers + 1)
+        return False
+
+    # Block until fewer than the allowed workers of the submitted futures are running
+    def admit(self, futures):
+        while True:
+            self.check()
+            running = [future for future in futures if not future.done()]
+            if len(running) < self.workers:
+                return
+            wait(running, timeout=1.0, return_when=FIRST_COMPLETED)
+
+    # Record batches of the given row groups (all by default) at the current batch size.
+    # Reader batches span row groups, so when check() changes the size the open reader
+    # is sliced up to the end of its current row group and then reopened at the new
+    # size from the next row group; its rows decoded past that boundary are dropped.
+    def batches(self, parquet_file, row_groups=None, columns=None):
+        metadata = parquet_file.metadata
+        row_groups = list(range(metadata.num_row_groups) if row_groups is None else row_groups)
+        while row_groups:
+            batch_rows = self.batch_rows
+            ends = []  # Cumulative row counts at the end of each row group
+            for i in row_groups:
+                ends.append((ends[-1] if ends else 0) + metadata.row_group(i).num_rows)
+            handed = 0
+            finished = 0  # Row groups handed out completely
+            reopen = False
+            for batch in parquet_file.iter_batches(batch_size=batch_rows, row_groups=row_groups, columns=columns):
+                start = 0
+                while start < batch.num_rows and not reopen:
+                    size = self.batch_rows
+                    if size != batch_rows:
+                        size = min(size, ends[finished] - handed)
+                    piece = batch.slice(start, size)
+                    start += piece.num_rows
+                    handed += piece.num_rows
+                    while finished < len(ends) and ends[finished] <= handed:
+                        finished += 1
+                    yield piece
+                    self.check()
+                    reopen = self.batch_rows != batch_rows and finished > 0 and handed == ends[finished - 1]
+                if reopen:
+                    break
+            row_groups = row_groups[finished:] if reopen else []
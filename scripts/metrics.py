@@ -0,0 +1,131 @@
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager, nullcontext
+
+# Structured performance metrics per stage run: wall time per phase, counters
+# (rows, bytes), rows dropped per cleaning rule, rows/s and peak RSS. Summaries go to
+# logs/metrics/<stage>.jsonl or to a Prometheus textfile per stage and labels.
+metrics_format = os.getenv("METRICS_FORMAT", "jsonl")  # "jsonl", "prometheus" or "off"
+metrics_path = os.getenv("METRICS_PATH", "logs/metrics/")
+batch_metrics = os.getenv("METRICS_BATCHES", "false").lower() == "true"  # Per-batch JSON lines
+
+
+# Peak resident set size of this process and its finished children (ru_maxrss is KiB on Linux)
+def peak_rss_bytes():
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+
+
+# Compressed bytes of the row groups and columns a read touches
+def compressed_bytes(metadata, row_groups, columns):
+    total = 0
+    for i in row_groups if row_groups is not None else range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        for j in range(row_group.num_columns):
+            column = row_group.column(j)
+            if columns is None or column.path_in_schema in columns:
+                total += column.total_compressed_size
+    return total
+
+
+# Phase timer on an optional StageMetrics
+def timer(metrics, name):
+    return metrics.phase(name) if metrics is not None else nullcontext()
+
+
+class StageMetrics:
+    def __init__(self, stage, **labels):
+        self.stage = stage
+        self.labels = labels
+        self.phases = {}
+        self.counters = {}
+        self.rules = {}
+        self.peak_rss = 0
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def add(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    # Rows dropped per cleaning rule (a row can fail several rules)
+    def add_rules(self, dropped):
+        for rule, rows in dropped.items():
+            self.rules[rule] = self.rules.get(rule, 0) + rows
+
+    # Fold in the summary of a sub-task (e.g. a process-pool row-group range)
+    def merge(self, summary):
+        for name, seconds in summary["phases"].items():
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+        for name, value in summary["counters"].items():
+            self.add(name, value)
+        self.add_rules(summary["rules_dropped"])
+        self.peak_rss = max(self.peak_rss, summary["peak_rss_bytes"])
+
+    def summary(self):
+        wall = time.perf_counter() - self.started
+        rows = self.counters.get("rows_in", self.counters.get("rows_out", 0))
+        return {
+            "stage": self.stage,
+            "labels": self.labels,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "wall_seconds": round(wall, 6),
+            "phases": {name: round(seconds, 6) for name, seconds in self.phases.items()},
+            "counters": self.counters,
+            "rules_dropped": self.rules,
+            "rows_per_second": round(rows / wall, 1) if rows and wall > 0 else None,
+            "peak_rss_bytes": max(self.peak_rss, peak_rss_bytes()),
+        }
+
+    # One JSON line per batch, only with METRICS_BATCHES=true
+    def batch(self, **fields):
+        if batch_metrics and metrics_format != "off":
+            write_jsonl(self.stage, {"stage": self.stage, "labels": self.labels, "batch": fields})
+
+    def emit(self):
+        if metrics_format == "off":
+            return None
+        summary = self.summary()
+        if metrics_format == "prometheus":
+            write_prometheus(summary)
+        else:
+            write_jsonl(self.stage, summary)
+        return summary
+
+
+def write_jsonl(stage, record):
+    os.makedirs(metrics_path, exist_ok=True)
+    # Single appended line per record, so concurrent processes do not interleave
+    with open(os.path.join(metrics_path, f"{stage}.jsonl"), "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+# Prometheus textfile (node_exporter textfile collector), one file per stage and labels
+def write_prometheus(summary):
+    os.makedirs(metrics_path, exist_ok=True)
+    base_labels = {"stage": summary["stage"], **summary["labels"]}
+
+    def sample(name, value, **extra):
+        labels = ",".join(f'{key}="{label}"' for key, label in {**base_labels, **extra}.items())
+        return f"tlc_{name}{{{labels}}} {value}"
+
+    lines = [sample("stage_wall_seconds", summary["wall_seconds"]),
+             sample("stage_peak_rss_bytes", summary["peak_rss_bytes"])]
+    if summary["rows_per_second"] is not None:
+        lines.append(sample("stage_rows_per_second", summary["rows_per_second"]))
+    lines += [sample("stage_phase_seconds", seconds, phase=name) for name, seconds in summary["phases"].items()]
+    lines += [sample("stage_count", value, counter=name) for name, value in summary["counters"].items()]
+    lines += [sample("stage_rule_rows_dropped", rows, rule=name) for name, rows in summary["rules_dropped"].items()]
+    file_name = "_".join([summary["stage"]] + [str(label) for label in summary["labels"].values()])
+    path = os.path.join(metrics_path, f"{file_name}.prom")
+    with open(f"{path}.tmp", "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(f"{path}.tmp", path)
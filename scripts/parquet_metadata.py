@@ -0,0 +1,103 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+
+# Profile a Parquet file from its footer alone: row count, Arrow schema and, per
+# column, null count and min/max merged across row groups. A column's entry is
+# None when any row group lacks that statistic (see fill_missing_stats).
+def footer_profile(path):
+    metadata = pq.read_metadata(path)
+    schema = metadata.schema.to_arrow_schema()
+    profile = {
+        "num_rows": metadata.num_rows,
+        "num_row_groups": metadata.num_row_groups,
+        "schema": schema,
+        "null_counts": {},
+        "min": {},
+        "max": {},
+    }
+    for name in schema.names:
+        profile["null_counts"][name] = 0
+        profile["min"][name] = None
+        profile["max"][name] = None
+
+    missing_min_max = set()
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        for j in range(row_group.num_columns):
+            column = row_group.column(j)
+            name = column.path_in_schema
+            if name not in profile["null_counts"]:
+                continue  # Nested field, not profiled
+            stats = column.statistics
+            if stats is None or not stats.has_null_count:
+                profile["null_counts"][name] = None
+            elif profile["null_counts"][name] is not None:
+                profile["null_counts"][name] += stats.null_count
+            if stats is None or not stats.has_min_max:
+                # All-null row groups carry no min/max but do not hide values
+                if stats is None or not stats.has_null_count or stats.null_count != column.num_values:
+                    missing_min_max.add(name)
+                continue
+            if profile["min"][name] is None or stats.min < profile["min"][name]:
+                profile["min"][name] = stats.min
+            if profile["max"][name] is None or stats.max > profile["max"][name]:
+                profile["max"][name] = stats.max
+
+    for name in missing_min_max:
+        profile["min"][name] = None
+        profile["max"][name] = None
+    profile["missing_min_max"] = sorted(missing_min_max)
+    return profile
+
+
+# Columns whose null count or min/max the footer could not answer
+def missing_stats_columns(profile, columns):
+    return [name for name in columns if name in profile["null_counts"] and (
+        profile["null_counts"][name] is None or name in profile["missing_min_max"])]
+
+
+# Complete a footer profile for the given columns with a column-projected read,
+# only for the statistics the footer could not answer
+def fill_missing_stats(path, profile, columns):
+    needs_read = missing_stats_columns(profile, columns)
+    for name in needs_read:
+        null_count = 0
+        low = high = None
+        for batch in pq.ParquetFile(path).iter_batches(columns=[name]):
+            column = batch.column(0)
+            null_count += column.null_count
+            if pa.types.is_string(column.type) or pa.types.is_large_string(column.type) \
+                    or len(column) == column.null_count:
+                continue
+            bounds = pc.min_max(column)
+            if low is None or bounds["min"].as_py() < low:
+                low = bounds["min"].as_py()
+            if high is None or bounds["max"].as_py() > high:
+                high = bounds["max"].as_py()
+        profile["null_counts"][name] = null_count
+        profile["min"][name] = low
+        profile["max"][name] = high
+        if name in profile["missing_min_max"]:
+            profile["missing_min_max"].remove(name)
+    return needs_read
+
+
+
+# Row groups whose footer min/max of a timestamp column reach outside [low, high)
+# (bounds in the column's unit, see cleaning_rules.month_bounds): (index, min, max)
+# each; row groups without statistics are not reported
+def row_groups_outside(metadata, column, low, high):
+    names = [metadata.schema.column(j).path for j in range(metadata.num_columns)]
+    if column not in names:
+        return []
+    position = names.index(column)
+    outside = []
+    for i in range(metadata.num_row_groups):
+        stats = metadata.row_group(i).column(position).statistics
+        if stats is None or not stats.has_min_max:
+            continue
+        if stats.min_raw < low or stats.max_raw >= high:
+            outside.append((i, stats.min, stats.max))
+    return outside
@@ -0,0 +1,223 @@
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from memory_budget import MemoryGovernor, row_bytes
+
+# Hive-partitioned processed dataset:
+#   <root>/dataset=<dataset>/year=<yyyy>/month=<mm>[/pickup_date=<yyyy-mm-dd>]/part-00000.parquet
+# Rows are sorted by pickup time inside each partition, files carry column statistics,
+# page indexes and sorting_columns, and the exact set of location IDs per row group
+# is stored in the file metadata under zone_ids_key (pyarrow cannot write Parquet
+# bloom filters, and an exact set over 265 IDs is smaller than one anyway).
+# plan_scan prunes partitions and row groups only: pyarrow has no API to read the
+# page index, so selected row groups are read whole and filtered in memory. The page
+# indexes are written for engines that use them (DuckDB, Spark, Trino), and small
+# row groups (PARTITION_ROW_GROUP_SIZE) keep row-group pruning fine-grained.
+partitioned_root = "data/processed/partitioned/"
+zone_id_columns = ["PULocationID", "DOLocationID"]
+zone_ids_key = b"tlc.zone_ids"
+
+
+def month_dir(root, dataset, month):
+    year, month_num = month.split("-")
+    return os.path.join(root, f"dataset={dataset}", f"year={year}", f"month={month_num}")
+
+
+# Writer of one partition file from rows appended in pickup order: row groups of
+# row_group_size rows, and the location ID set of each row group in the file metadata
+class PartitionWriter:
+    def __init__(self, path, schema, pickup, row_group_size, compression, compression_level):
+        self.writer = pq.ParquetWriter(
+            path, schema, compression=compression, compression_level=compression_level,
+            write_statistics=True, write_page_index=True,
+            sorting_columns=[pq.SortingColumn(schema.get_field_index(pickup))])
+        self.row_group_size = row_group_size
+        self.pending = []
+        self.pending_rows = 0
+        self.zone_ids = {name: [] for name in zone_id_columns if name in schema.names}
+
+    def write(self, table):
+        self.pending.append(table)
+        self.pending_rows += table.num_rows
+        while self.pending_rows >= self.row_group_size:
+            self.flush(self.row_group_size)
+
+    def flush(self, rows):
+        table = pa.concat_tables(self.pending)
+        group = table.slice(0, rows)
+        for name, row_groups in self.zone_ids.items():
+            row_groups.append(pc.drop_null(pc.unique(group.column(name))).to_pylist())
+        self.writer.write_table(group, row_group_size=rows)
+        rest = table.slice(rows)
+        self.pending = [rest] if rest.num_rows else []
+        self.pending_rows = rest.num_rows
+
+    def close(self):
+        if self.pending_rows:
+            self.flush(self.pending_rows)
+        self.writer.add_key_value_metadata({zone_ids_key: json.dumps(self.zone_ids).encode()})
+        self.writer.close()
+
+
+# Spill a month file into one unsorted bucket file per pickup day, in batches sized
+# to the memory budget; returns {day (microseconds): bucket file} in day order.
+# Cleaned months have no null pickup times.
+def spill_days(path, buckets_dir, pickup):
+    os.makedirs(buckets_dir)
+    writers = {}
+    parquet_file = pq.ParquetFile(path)
+    try:
+        for batch in MemoryGovernor("scan", row_bytes(parquet_file.metadata)).batches(parquet_file):
+            if batch.column(pickup).null_count:
+                raise ValueError(f"{path} has null {pickup} values and cannot be partitioned by day")
+            days = pc.cast(pc.cast(pc.floor_temporal(batch.column(pickup), unit="day"), pa.timestamp("us")),
+                           pa.int64()).to_numpy()
+            order = np.argsort(days, kind="stable")
+            unique_days, starts = np.unique(days[order], return_index=True)
+            bounds = list(starts) + [batch.num_rows]
+            for j, day in enumerate(unique_days):
+                if day not in writers:
+                    writers[day] = pq.ParquetWriter(
+                        os.path.join(buckets_dir, f"{day}.parquet"), batch.schema, compression="none")
+                writers[day].write_batch(batch.take(order[bounds[j]:bounds[j + 1]]))
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return {day: os.path.join(buckets_dir, f"{day}.parquet") for day in sorted(writers)}
+
+
+# Sort one cleaned month file by pickup time and replace its partitions. partition_by
+# is "month" (one file per month) or "date" (one pickup_date partition per day). The
+# month is spilled into per-day buckets first, so only one day is held and sorted in
+# memory at a time; days are written in order, which keeps a month file sorted.
+def write_month_partitions(path, root, dataset, month, pickup, partition_by="month",
+                           row_group_size=50000, compression="snappy", compression_level=None):
+    target = month_dir(root, dataset, month)
+    staging = f"{target}.tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    buckets_dir = os.path.join(staging, "_buckets")
+    schema = pq.read_schema(path)
+    args = (schema, pickup, row_group_size, compression, compression_level)
+
+    writer = None
+    try:
+        if partition_by != "date":
+            writer = PartitionWriter(os.path.join(staging, "part-00000.parquet"), *args)
+        for day, bucket_file in spill_days(path, buckets_dir, pickup).items():
+            table = pq.read_table(bucket_file)
+            table = table.take(pc.sort_indices(table, [(pickup, "ascending")]))
+            os.remove(bucket_file)
+            if partition_by == "date":
+                day_dir = os.path.join(staging, f"pickup_date={pd.Timestamp(int(day), unit='us').date()}")
+                os.makedirs(day_dir)
+                day_writer = PartitionWriter(os.path.join(day_dir, "part-00000.parquet"), *args)
+                day_writer.write(table)
+                day_writer.close()
+            else:
+                writer.write(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    shutil.rmtree(buckets_dir)
+
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(staging, target)
+    return target
+
+
+# Partition files that can hold pickups in [start, end), pruned by month and pickup_date
+def partition_files(root, dataset, start=None, end=None):
+    start = pd.Timestamp(start) if start is not None else None
+    end = pd.Timestamp(end) if end is not None else None
+    files = []
+    dataset_dir = os.path.join(root, f"dataset={dataset}")
+    if not os.path.isdir(dataset_dir):
+        return files
+    for year_dir in sorted(os.listdir(dataset_dir)):
+        for month_name in sorted(os.listdir(os.path.join(dataset_dir, year_dir))):
+            if month_name.endswith(".tmp"):
+                continue
+            low = pd.Timestamp(f"{year_dir[5:]}-{month_name[6:]}-01")
+            if not overlaps(low, low + pd.offsets.MonthBegin(1), start, end):
+                continue
+            path = os.path.join(dataset_dir, year_dir, month_name)
+            for entry in sorted(os.listdir(path)):
+                if entry.startswith("pickup_date="):
+                    day = pd.Timestamp(entry[len("pickup_date="):])
+                    if not overlaps(day, day + pd.Timedelta(days=1), start, end):
+                        continue
+                    files += [os.path.join(path, entry, name) for name in sorted(os.listdir(os.path.join(path, entry)))]
+                elif entry.endswith(".parquet"):
+                    files.append(os.path.join(path, entry))
+    return files
+
+
+# [low, high) overlaps [start, end); None bounds are open
+def overlaps(low, high, start, end):
+    return (end is None or low < end) and (start is None or high > start)
+
+
+# Row groups to read per file after partition, pickup-statistics and zone-set
+# pruning (no page-level pruning), plus the compressed bytes selected and the size of the whole dataset
+def plan_scan(dataset, pickup, start=None, end=None, pu_ids=None, do_ids=None, root=partitioned_root):
+    wanted_ids = {"PULocationID": pu_ids, "DOLocationID": do_ids}
+    plan = []
+    selected_bytes = 0
+    total_bytes = sum(os.path.getsize(path) for path in partition_files(root, dataset))
+    for path in partition_files(root, dataset, start, end):
+        parquet_file = pq.ParquetFile(path)
+        metadata = parquet_file.metadata
+        pickup_index = parquet_file.schema_arrow.get_field_index(pickup)
+        zone_ids = json.loads((metadata.metadata or {}).get(zone_ids_key, b"{}"))
+        row_groups = []
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            size = sum(row_group.column(j).total_compressed_size for j in range(row_group.num_columns))
+            stats = row_group.column(pickup_index).statistics
+            if stats is not None and stats.has_min_max and not overlaps(
+                    pd.Timestamp(stats.min), pd.Timestamp(stats.max) + pd.Timedelta(microseconds=1),
+                    pd.Timestamp(start) if start is not None else None,
+                    pd.Timestamp(end) if end is not None else None):
+                continue
+            if any(ids is not None and name in zone_ids and not set(ids) & set(zone_ids[name][i])
+                   for name, ids in wanted_ids.items()):
+                continue
+            row_groups.append(i)
+            selected_bytes += size
+        if row_groups:
+            plan.append((path, row_groups))
+    return plan, selected_bytes, total_bytes
+
+
+# Read trips for a pickup window and/or PU/DO zones, reading only the planned row groups.
+# Zone lists of None do not filter; empty lists match no trips (as in plan_scan).
+def read_partitioned(dataset, pickup, start=None, end=None, pu_ids=None, do_ids=None,
+                     columns=None, root=partitioned_root):
+    plan, _, _ = plan_scan(dataset, pickup, start, end, pu_ids, do_ids, root)
+    read_columns = None if columns is None else list(dict.fromkeys(
+        columns + [pickup] + [name for name, ids in (("PULocationID", pu_ids), ("DOLocationID", do_ids))
+                              if ids is not None]))
+    tables = [pq.ParquetFile(path).read_row_groups(row_groups, columns=read_columns)
+              for path, row_groups in plan]
+    if not tables:
+        return None
+    table = pa.concat_tables(tables)
+
+    # Exact filter on the rows of the surviving row groups
+    keep = pa.array(np.ones(table.num_rows, dtype=bool))
+    pickup_type = table.schema.field(pickup).type
+    if start is not None:
+        keep = pc.and_(keep, pc.greater_equal(table.column(pickup), pa.scalar(pd.Timestamp(start), pickup_type)))
+    if end is not None:
+        keep = pc.and_(keep, pc.less(table.column(pickup), pa.scalar(pd.Timestamp(end), pickup_type)))
+    for name, ids in (("PULocationID", pu_ids), ("DOLocationID", do_ids)):
+        if ids is not None:
+            keep = pc.and_(keep, pc.is_in(table.column(name), value_set=pa.array(ids, table.schema.field(name).type)))
+    table = table.filter(pc.fill_null(keep, False))
+    return table.select(columns) if columns is not None else table
@@ -0,0 +1,329 @@
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dotenv import load_dotenv
+from manifest import file_fingerprint
+from storage import open_storage
+
+# Configuration
+load_dotenv()
+datasets = os.getenv("TLC_DATASETS", "yellow,green").split(",")
+months = os.getenv("TLC_MONTHS", "2025-01,2025-02,2025-03").split(",")
+selected_stages = os.getenv(
+    "PIPELINE_STAGES", "analyze,verify_green,transform,verify_processed,verify_borough,load").split(",")
+cpu_budget = int(os.getenv("PIPELINE_CPUS", str(os.cpu_count() or 1)))
+memory_budget_mb = int(os.getenv("PIPELINE_MEMORY_MB", "8192"))
+force = os.getenv("PIPELINE_FORCE", "false").lower() == "true"  # Rerun nodes even if up to date
+dry_run = os.getenv("PIPELINE_DRY_RUN", "false").lower() == "true"  # Log the plan only
+fused_load = os.getenv("FUSED_LOAD", "false").lower() == "true"  # The transform loads the warehouse itself
+load_config = ["LOAD_BACKEND", "LOAD_METHOD", "SNOWFLAKE_TABLE", "LOCAL_DB_PATH"]
+state_path = "data/state/pipeline/"
+log_path = "logs/pipeline/"
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+
+file_prefixes = {"yellow": "yellow_tripdata", "green": "green_tripdata",
+                 "fhv": "fhv_tripdata", "hvfhv": "fhvhv_tripdata"}
+raw_file = "data/raw/2025/{dataset}/{prefix}_{month}.parquet"
+processed_file = "data/processed/2025/{dataset}/{prefix}_{month}_cleaned.parquet"
+lookup_file = "data/raw/2025/lookup/taxi_zone_lookup.csv"
+stored_files = [raw_file, processed_file]  # Live in the storage layer (STORAGE_URL), the rest stays local
+storage = open_storage()
+
+# Stages run per (dataset, month) node, in dependency order:
+#   script     stage script, run with TLC_DATASET(S) and TLC_MONTHS set to the node's
+#   datasets   datasets the stage applies to
+#   after      upstream stages (dropped when not selected; their outputs are still inputs)
+#   chained    also runs after the stage's node for the previous month (cross-month state)
+#   inputs / outputs   paths fingerprinted into the node key / required after a run
+#   config     environment variables that change the stage's outputs
+#   skip       the stage's work is done by another stage, so it has no nodes
+#   cpus, memory_mb   scheduler weights (memory_mb is also the stage's MEMORY_BUDGET_MB);
+#                     lock serializes nodes sharing a resource
+stages = {
+    "extract": {
+        "script": "extract.py", "datasets": list(file_prefixes), "after": [],
+        "inputs": [], "outputs": [raw_file],
+        "config": ["TLC_BASE_URL"], "cpus": 1, "memory_mb": 256,
+    },
+    "analyze": {
+        "script": "analyze_raw_yellow.py", "datasets": ["yellow"], "after": ["extract"],
+        "inputs": [raw_file], "outputs": ["logs/yellow/dq_yellow_{month}.json"],
+        "config": ["ANALYZE_MODE", "SAMPLE_FRACTION", "SAMPLE_SEED", "SAMPLE_STRATIFY", "SKETCHES", "SKETCH_DRIFT_PSI"],
+        "cpus": 1, "memory_mb": 512,
+    },
+    "verify_green": {
+        "script": "verify_green.py", "datasets": ["green"], "after": ["extract"],
+        "inputs": [raw_file, lookup_file], "outputs": ["logs/green/dq_green_{month}.json"],
+        "config": ["SAMPLE_FRACTION", "SAMPLE_SEED", "SAMPLE_STRATIFY", "SKETCHES", "SKETCH_DRIFT_PSI"],
+        "cpus": 1, "memory_mb": 512,
+    },
+    "transform": {
+        "script": "transform_yellow.py", "datasets": list(file_prefixes), "after": ["extract"],
+        "chained": os.getenv("DEDUP", "false").lower() == "true",  # Resubmissions look up earlier months' runs
+        "inputs": [raw_file, lookup_file], "outputs": [processed_file],
+        "config": ["TRANSFORM_ENGINE", "TRANSFORM_WORKERS", "ZONE_COLUMNS", "OUTPUT_PROFILE", "QUARANTINE",
+                   "PARQUET_COMPRESSION", "PARQUET_COMPRESSION_LEVEL", "ROW_GROUP_SIZE",
+                   "PARTITIONED_OUTPUT", "PARTITION_ROW_GROUP_SIZE", "ROLLUPS", "SKETCHES", "SKETCH_DRIFT_PSI",
+                   "DEDUP", "DEDUP_PARTITIONS", "DEDUP_BLOOM_MB", "SAMPLE_FRACTION", "SAMPLE_SEED", "SAMPLE_STRATIFY",
+                   "FUSED_LOAD", "PERSIST_PROCESSED", "FUSED_QUEUE_BATCHES"] + (load_config if fused_load else []),
+        "cpus": (os.cpu_count() or 1) if os.getenv("TRANSFORM_WORKERS") == "auto" else int(os.getenv("TRANSFORM_WORKERS", "1")),
+        "memory_mb": 2048,
+    },
+    "verify_processed": {
+        "script": "verify_processed.py", "datasets": ["yellow"], "after": ["transform"],
+        "inputs": [processed_file], "outputs": [],
+        "config": ["VERIFY_MODE", "OUTPUT_PROFILE"], "cpus": 1, "memory_mb": 512,
+    },
+    "verify_borough": {
+        "script": "verify_borough.py", "datasets": ["yellow"], "after": ["transform"],
+        "inputs": ["data/rollups/{dataset}/hourly_zone/{month}.parquet", lookup_file], "outputs": [],
+        "config": [], "cpus": 1, "memory_mb": 256,
+    },
+    "load": {
+        "script": "load_to_snowflake.py", "datasets": ["yellow"], "after": ["verify_processed"],
+        "inputs": [processed_file], "outputs": [],
+        "config": load_config, "skip": fused_load,  # FUSED_LOAD: loaded by the transform
+        "cpus": 1, "memory_mb": 1024, "lock": "warehouse",
+    },
+}
+
+# Create directories
+os.makedirs(state_path, exist_ok=True)
+os.makedirs(log_path, exist_ok=True)
+
+# Configure logger
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+log_file = os.path.join(log_path, "pipeline.log")
+file_handler = logging.FileHandler(log_file)
+file_handler.setFormatter(logging.Formatter(
+    "%(asctime)s - %(levelname)s - %(message)s"))
+logger.addHandler(file_handler)
+
+
+def node_id(stage, dataset, month):
+    return f"{stage}/{dataset}/{month}"
+
+
+def node_paths(paths, dataset, month):
+    return [path.format(dataset=dataset, prefix=file_prefixes[dataset], month=month) for path in paths]
+
+
+# Fingerprint of a node's input or output file (template is its unformatted path), None if missing
+def path_fingerprint(template, path):
+    if template in stored_files:
+        return storage.fingerprint(path)
+    return file_fingerprint(path) if os.path.exists(path) else None
+
+
+def path_exists(template, path):
+    return storage.exists(path) if template in stored_files else os.path.exists(path)
+
+
+# Upstream nodes of a node, limited to the selected stages; a chained stage also
+# follows its node for the closest earlier month of node_months
+def upstream(stage, dataset, month, selected, node_months=None):
+    after = [node_id(before, dataset, month) for before in stages[stage]["after"]
+             if before in selected and dataset in stages[before]["datasets"]]
+    earlier = [other for other in node_months or months if other < month]
+    if stages[stage].get("chained") and earlier:
+        after.append(node_id(stage, dataset, max(earlier)))
+    return after
+
+
+# Nodes for the selected stages, datasets and months, in dependency order
+def build_nodes(selected=None, node_datasets=None, node_months=None):
+    selected = selected or selected_stages
+    nodes = {}
+    for stage in stages:
+        if stage not in selected or stages[stage].get("skip"):
+            continue
+        for dataset in node_datasets or datasets:
+            if dataset not in stages[stage]["datasets"]:
+                continue
+            for month in node_months or months:
+                nodes[node_id(stage, dataset, month)] = {
+                    "stage": stage, "dataset": dataset, "month": month,
+                    "after": upstream(stage, dataset, month, selected, node_months)}
+    return nodes
+
+
+# Hash of a script and the sibling modules it imports (also inside functions), recursively
+def code_fingerprint(script, seen=None):
+    seen = set() if seen is None else seen
+    digest = hashlib.sha256()
+    path = os.path.join(scripts_dir, script)
+    if script in seen or not os.path.exists(path):
+        return ""
+    seen.add(script)
+    with open(path, "rb") as f:
+        source = f.read()
+    digest.update(source)
+    for module in re.findall(rb"^\s*(?:from|import)\s+(\w+)", source, re.MULTILINE):
+        digest.update(code_fingerprint(f"{module.decode()}.py", seen).encode())
+    return digest.hexdigest()
+
+
+def state_file(node):
+    return os.path.join(state_path, node.replace("/", "__") + ".json")
+
+
+def load_state(node):
+    try:
+        with open(state_file(node)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(node, state):
+    path = state_file(node)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+# Key of a node: its code, config, input file fingerprints and upstream keys
+def node_key(node, upstream_keys):
+    spec = stages[node["stage"]]
+    inputs = {path: path_fingerprint(template, path) for template, path in
+              zip(spec["inputs"], node_paths(spec["inputs"], node["dataset"], node["month"]))}
+    key = {
+        "code": code_fingerprint(spec["script"]),
+        "config": {name: os.getenv(name) for name in spec["config"]},
+        "inputs": inputs,
+        "upstream": upstream_keys,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def outputs_exist(node):
+    spec = stages[node["stage"]]
+    return all(path_exists(template, path) for template, path in
+               zip(spec["outputs"], node_paths(spec["outputs"], node["dataset"], node["month"])))
+
+
+def up_to_date(node, key):
+    return not force and load_state(node_id(node["stage"], node["dataset"], node["month"])).get("key") == key \
+        and outputs_exist(node)
+
+
+# Run one node's stage script; returns "ok" or "failed"
+def run_node(node, key):
+    name = node_id(node["stage"], node["dataset"], node["month"])
+    spec = stages[node["stage"]]
+    env = dict(os.environ, TLC_DATASET=node["dataset"], TLC_DATASETS=node["dataset"], TLC_MONTHS=node["month"],
+               MEMORY_BUDGET_MB=str(spec["memory_mb"]))
+    start = time.time()
+    with open(os.path.join(log_path, name.replace("/", "__") + ".log"), "w") as output:
+        returncode = subprocess.run([sys.executable, os.path.join(scripts_dir, spec["script"])],
+                                    env=env, stdout=output, stderr=subprocess.STDOUT).returncode
+    elapsed = time.time() - start
+    if returncode != 0:
+        logger.error(f"{name} failed with exit code {returncode} after {elapsed:.1f}s")
+        return "failed"
+    if not outputs_exist(node):
+        logger.error(f"{name} finished without its outputs after {elapsed:.1f}s")
+        return "failed"
+    save_state(name, {"key": key, "seconds": round(elapsed, 3), "finished": time.strftime("%Y-%m-%dT%H:%M:%S")})
+    logger.info(f"{name} done in {elapsed:.1f}s")
+    return "ok"
+
+
+# Run a single node outside the local scheduler (used by the Airflow DAG); upstream
+# keys come from the upstream nodes' recorded state
+def run_single(stage, dataset, month, selected=None):
+    selected = selected or list(stages)
+    if stages[stage].get("skip"):
+        logger.info(f"{node_id(stage, dataset, month)} done by another stage, skipping")
+        return "skipped"
+    node = {"stage": stage, "dataset": dataset, "month": month,
+            "after": upstream(stage, dataset, month, selected)}
+    key = node_key(node, {before: load_state(before).get("key") for before in node["after"]})
+    if up_to_date(node, key):
+        logger.info(f"{node_id(stage, dataset, month)} up to date, skipping")
+        return "cached"
+    return run_node(node, key)
+
+
+# Local scheduler: starts every node whose upstream nodes succeeded, within the CPU
+# and memory budgets and resource locks; up-to-date nodes are skipped
+def run_graph(nodes):
+    pending = dict(nodes)
+    results = {}
+    keys = {}
+    running = {}
+    used = {"cpus": 0, "memory_mb": 0}
+    locks = set()
+
+    with ThreadPoolExecutor(max_workers=max(cpu_budget, 1)) as executor:
+        while pending or running:
+            progress = True
+            while progress:
+                progress = False
+                for name, node in list(pending.items()):
+                    if any(before not in results for before in node["after"]):
+                        continue
+                    if any(results[before] in ("failed", "blocked") for before in node["after"]):
+                        results[name] = "blocked"
+                        logger.warning(f"{name} blocked by a failed upstream node")
+                    else:
+                        spec = stages[node["stage"]]
+                        key = keys.get(name) or node_key(node, {before: keys[before] for before in node["after"]})
+                        keys[name] = key
+                        if up_to_date(node, key):
+                            results[name] = "cached"
+                            logger.info(f"{name} up to date, skipping")
+                        elif dry_run:
+                            results[name] = "planned"
+                            logger.info(f"{name} would run")
+                        else:
+                            cpus = min(spec["cpus"], cpu_budget)
+                            fits = (used["cpus"] + cpus <= cpu_budget
+                                    and used["memory_mb"] + spec["memory_mb"] <= memory_budget_mb)
+                            if (not fits and running) or spec.get("lock") in locks:
+                                continue
+                            used["cpus"] += cpus
+                            used["memory_mb"] += spec["memory_mb"]
+                            if spec.get("lock"):
+                                locks.add(spec["lock"])
+                            logger.info(f"{name} started")
+                            running[executor.submit(run_node, node, key)] = (name, cpus, spec)
+                            del pending[name]
+                            continue
+                    del pending[name]
+                    progress = True
+
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, cpus, spec = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    logger.error(f"{name} failed: {e}", exc_info=True)
+                    results[name] = "failed"
+                used["cpus"] -= cpus
+                used["memory_mb"] -= spec["memory_mb"]
+                locks.discard(spec.get("lock"))
+    return results
+
+
+if __name__ == "__main__":
+    nodes = build_nodes()
+    logger.info(f"Pipeline: {len(nodes)} nodes, {cpu_budget} CPUs, {memory_budget_mb} MB")
+    results = run_graph(nodes)
+    summary = {status: sum(1 for result in results.values() if result == status)
+               for status in sorted(set(results.values()))}
+    logger.info(f"Pipeline finished: {summary}")
+    logger.removeHandler(file_handler)
+    file_handler.close()
+    if any(result in ("failed", "blocked") for result in results.values()):
+        sys.exit(1)
@@ -0,0 +1,175 @@
+import os
+import re
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+# Query API over the processed files data/processed/<year>/<dataset>/<prefix>_<month>_cleaned.parquet.
+# Every file is one fragment of an Arrow dataset with "dataset" and "month" as
+# partition values, so filters on them skip whole files, other predicates are pushed
+# down to Parquet row-group statistics, and only the projected columns are decoded.
+# Scans and aggregations run on Arrow's thread pool (QUERY_THREADS caps it).
+#
+#   query("yellow", months=["2025-01", "2025-02"], filter=[("tip_amount", ">", 20)],
+#         group_by=["month", "Borough"], aggregations=[("tip_amount", "mean"), (None, "count_all")])
+processed_root = "data/processed/"
+query_threads = int(os.getenv("QUERY_THREADS", "0"))  # 0 = one thread per CPU
+processed_name = re.compile(r"_(\d{4}-\d{2})_cleaned\.parquet$")
+# Aggregate partials every this many rows, and combine partials once this many are pending
+partial_rows = 1000000
+combine_every = 16
+# How partial aggregates of each function combine; mean is kept as sum and count
+combine_functions = {"sum": "sum", "min": "min", "max": "max", "count": "sum", "count_all": "sum"}
+
+
+# Processed files per dataset -> [(month, path)], limited to months when given
+def processed_files(dataset, months=None, root=processed_root):
+    files = []
+    if not os.path.isdir(root):
+        return files
+    for year in sorted(os.listdir(root)):
+        dataset_dir = os.path.join(root, year, dataset)
+        if not year.isdigit() or not os.path.isdir(dataset_dir):
+            continue
+        for name in sorted(os.listdir(dataset_dir)):
+            match = processed_name.search(name)
+            if match and (months is None or match.group(1) in months):
+                files.append((match.group(1), os.path.join(dataset_dir, name)))
+    return files
+
+
+# One schema for files written with different output profiles (e.g. compact int8 codes
+# and dictionary strings next to standard int64 and string): numbers widen, and a
+# column that is dictionary-encoded in only some files reads as its plain values
+def common_schema(schemas):
+    types = {}
+    for schema in schemas:
+        for field in schema:
+            types.setdefault(field.name, set()).add(field.type)
+    plain = [pa.schema([field.with_type(field.type.value_type)
+                        if pa.types.is_dictionary(field.type) and len(types[field.name]) > 1 else field
+                        for field in schema], metadata=schema.metadata) for schema in schemas]
+    return pa.unify_schemas(plain, promote_options="permissive")
+
+
+# Arrow dataset over the processed months of one or more datasets, with "dataset"
+# and "month" string columns taken from each file's partition expression
+def processed_dataset(datasets, months=None, root=processed_root):
+    datasets = [datasets] if isinstance(datasets, str) else list(datasets)
+    children = []
+    for dataset in datasets:
+        files = processed_files(dataset, months, root)
+        if not files:
+            continue
+        schema = common_schema([pq.read_schema(path) for _, path in files])
+        schema = schema.append(pa.field("dataset", pa.string())).append(pa.field("month", pa.string()))
+        children.append(ds.FileSystemDataset.from_paths(
+            [os.path.abspath(path) for _, path in files], schema=schema, format=ds.ParquetFileFormat(),
+            filesystem=pafs.LocalFileSystem(),
+            partitions=[(pc.field("dataset") == dataset) & (pc.field("month") == month) for month, _ in files]))
+    if not children:
+        raise FileNotFoundError(f"No processed files for {datasets} under {root}")
+    if len(children) == 1:
+        return children[0]
+    # Datasets differ in columns (e.g. tpep_ vs lpep_ pickup); missing columns read as null
+    return ds.dataset(children, schema=common_schema([child.schema for child in children]))
+
+
+# Filters as a compute expression or pyarrow.parquet DNF tuples, e.g.
+# [("PULocationID", "in", [132, 138]), ("tip_amount", ">", 20)]
+def filter_expression(filter):
+    if filter is None or isinstance(filter, pc.Expression):
+        return filter
+    return pq.filters_to_expression(filter)
+
+
+def output_name(column, function):
+    return function if column is None else f"{column}_{function}"
+
+
+# Partial aggregations for (column, function) pairs; mean becomes sum and count
+def partial_aggregations(aggregations):
+    partial = []
+    for column, function in aggregations:
+        if function not in combine_functions and function != "mean":
+            raise ValueError(f"Unsupported aggregation {function}; use mean or one of {list(combine_functions)}")
+        for part in (["sum", "count"] if function == "mean" else [function]):
+            target = [] if column is None else column
+            if (target, part) not in partial:
+                partial.append((target, part))
+    return partial
+
+
+# Sum/min/max partial aggregates of the same groups into one
+def combine(tables, group_by, partial):
+    table = pa.concat_tables(tables)
+    if len(tables) == 1:
+        return table
+    names = [output_name(column or None, function) for column, function in partial]
+    combined = table.group_by(group_by).aggregate(
+        [(name, combine_functions[function]) for name, (_, function) in zip(names, partial)])
+    return combined.rename_columns(
+        [name.rsplit("_", 1)[0] if name.rsplit("_", 1)[0] in names else name for name in combined.column_names])
+
+
+# Final columns: group keys, then one column per requested aggregation
+def finish_aggregation(table, group_by, aggregations):
+    columns = {key: table.column(key) for key in group_by}
+    for column, function in aggregations:
+        if function == "mean":
+            total = pc.cast(table.column(f"{column}_sum"), pa.float64())
+            count = table.column(f"{column}_count")
+            columns[f"{column}_mean"] = pc.if_else(
+                pc.equal(count, 0), pa.scalar(None, pa.float64()), pc.divide(total, pc.cast(count, pa.float64())))
+        else:
+            columns[output_name(column, function)] = table.column(output_name(column, function))
+    return pa.table(columns)
+
+
+# Scan processed data for one or more datasets and months (all stored months when None).
+#   columns        projection (ignored when aggregating)
+#   filter         compute expression or DNF tuples, pushed down into the scan
+#   group_by / aggregations   keys and (column, function) pairs; functions are sum, min,
+#                  max, count, mean and count_all (column None). Batches are aggregated
+#                  as they stream, so only the partial groups are held in memory.
+#   order_by / limit   applied to the result
+def query(datasets, months=None, columns=None, filter=None, group_by=None, aggregations=None,
+          order_by=None, limit=None, root=processed_root):
+    if query_threads:
+        pa.set_cpu_count(query_threads)
+    dataset = processed_dataset(datasets, months, root)
+    expression = filter_expression(filter)
+
+    if not aggregations and not group_by:
+        scanner = dataset.scanner(columns=columns, filter=expression, use_threads=True)
+        table = scanner.head(limit) if limit is not None and order_by is None else scanner.to_table()
+    else:
+        group_by = list(group_by or [])
+        aggregations = list(aggregations or [(None, "count_all")])
+        partial = partial_aggregations(aggregations)
+        needed = list(dict.fromkeys(group_by + [column for column, _ in aggregations if column is not None]))
+        scanner = dataset.scanner(columns=needed, filter=expression, use_threads=True)
+        partials = []
+        pending = []
+        pending_rows = 0
+        for batch in scanner.to_batches():
+            if batch.num_rows:
+                pending.append(batch)
+                pending_rows += batch.num_rows
+            if pending_rows >= partial_rows:
+                partials.append(pa.Table.from_batches(pending).group_by(group_by).aggregate(partial))
+                pending, pending_rows = [], 0
+                if len(partials) >= combine_every:
+                    partials = [combine(partials, group_by, partial)]
+        if pending or not partials:
+            partials.append(pa.Table.from_batches(
+                pending, schema=scanner.projected_schema).group_by(group_by).aggregate(partial))
+        table = finish_aggregation(combine(partials, group_by, partial), group_by, aggregations)
+
+    if order_by is not None:
+        table = table.sort_by(order_by)
+    if limit is not None:
+        table = table.slice(0, limit)
+    return table
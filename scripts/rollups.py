@@ -0,0 +1,123 @@
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# Pre-aggregated cubes over cleaned trips, one Parquet file per dataset, cube and month:
+#   <root>/<dataset>/<cube>/<month>.parquet
+# Every cell holds the trip count plus sum, sum of squares and non-null count of each
+# measure, so means and variances can be recombined across cells and months.
+# The DO dimension lives only in the OD matrix: a full hour x PU x DO x payment
+# cube has nearly as many cells as a month has trips.
+rollup_root = "data/rollups/"
+cubes = {
+    "hourly_zone": ["pickup_hour", "PULocationID", "payment_type"],
+    "od_matrix": ["PULocationID", "DOLocationID"],
+}
+measures = ["trip_distance", "trip_minutes", "fare_amount", "tip_amount", "total_amount"]
+# Re-aggregate pending partial cubes once this many have accumulated
+combine_every = 16
+
+
+# Key and measure columns derived from a cleaned table
+def rollup_columns(table, pickup, dropoff):
+    columns = {"pickup_hour": pc.cast(pc.hour(table.column(pickup)), pa.int8())}
+    for name in ("PULocationID", "DOLocationID", "payment_type"):
+        if name in table.column_names:
+            columns[name] = table.column(name)
+    duration = pc.subtract(pc.cast(table.column(dropoff), pa.timestamp("us")),
+                           pc.cast(table.column(pickup), pa.timestamp("us")))
+    columns["trip_minutes"] = pc.divide(pc.cast(pc.cast(duration, pa.int64()), pa.float64()), 60e6)
+    for name in measures:
+        if name in table.column_names:
+            values = pc.cast(table.column(name), pa.float64())
+            columns[name] = pc.if_else(pc.is_nan(values), pa.scalar(None, pa.float64()), values)
+    return pa.table(columns)
+
+
+# One group_by per cube over a cleaned batch -> {cube: partial cube}
+def aggregate_batch(table, pickup, dropoff):
+    columns = rollup_columns(table, pickup, dropoff)
+    present = [name for name in measures if name in columns.column_names]
+    columns = columns.append_column("trips", pa.array(np.ones(columns.num_rows, dtype=np.int64)))
+    for name in present:
+        columns = columns.append_column(f"{name}_sq", pc.multiply(columns.column(name), columns.column(name)))
+    partials = {}
+    for cube, keys in cubes.items():
+        keys = [key for key in keys if key in columns.column_names]
+        aggregated = columns.group_by(keys).aggregate(
+            [("trips", "sum")]
+            + [(name, "sum") for name in present]
+            + [(f"{name}_sq", "sum") for name in present]
+            + [(name, "count") for name in present])
+        partials[cube] = aggregated.rename_columns(
+            [name.replace("_sq_sum", "_sumsq").replace("trips_sum", "trips") for name in aggregated.column_names])
+    return partials
+
+
+# Sum partial cubes of the same cube into one
+def combine(tables):
+    table = pa.concat_tables(tables)
+    if len(tables) == 1:
+        return table
+    values = [name for name in table.column_names
+              if name == "trips" or name.endswith(("_sum", "_sumsq", "_count"))]
+    keys = [name for name in table.column_names if name not in values]
+    aggregated = table.group_by(keys).aggregate([(name, "sum") for name in values])
+    return aggregated.rename_columns(
+        [name[:-len("_sum")] if name[:-len("_sum")] in values else name for name in aggregated.column_names])
+
+
+# Accumulates partial cubes for a month: add() per cleaned batch, merge() across
+# row-group ranges, result() for the combined cubes
+class RollupBuilder:
+    def __init__(self, pickup, dropoff):
+        self.pickup = pickup
+        self.dropoff = dropoff
+        self.partials = {cube: [] for cube in cubes}
+
+    def add(self, table):
+        for cube, partial in aggregate_batch(table, self.pickup, self.dropoff).items():
+            self.partials[cube].append(partial)
+            if len(self.partials[cube]) >= combine_every:
+                self.partials[cube] = [combine(self.partials[cube])]
+
+    # Take rows back out (e.g. duplicates found after the month was written)
+    def remove(self, table):
+        for cube, partial in aggregate_batch(table, self.pickup, self.dropoff).items():
+            negated = [pc.negate(column) if name == "trips" or name.endswith(("_sum", "_sumsq", "_count"))
+                       else column for name, column in zip(partial.column_names, partial.columns)]
+            self.partials[cube].append(pa.table(negated, names=partial.column_names))
+
+    def merge(self, other):
+        for cube, partials in other.partials.items():
+            self.partials[cube] = [combine(self.partials[cube] + partials)] if self.partials[cube] or partials else []
+
+    def result(self):
+        results = {cube: combine(partials) for cube, partials in self.partials.items() if partials}
+        return {cube: table.filter(pc.greater(table.column("trips"), 0)) for cube, table in results.items()}
+
+
+# Replace the month's cube files
+def write_rollups(results, root, dataset, month):
+    for cube, table in results.items():
+        cube_dir = os.path.join(root, dataset, cube)
+        os.makedirs(cube_dir, exist_ok=True)
+        path = os.path.join(cube_dir, f"{month}.parquet")
+        pq.write_table(table, f"{path}.tmp", compression="zstd")
+        os.replace(f"{path}.tmp", path)
+
+
+# Read one cube for the given months (all stored months when None), with a month column
+def read_rollup(cube, dataset="yellow", months=None, root=rollup_root):
+    cube_dir = os.path.join(root, dataset, cube)
+    if months is None:
+        months = sorted(name[:-len(".parquet")] for name in os.listdir(cube_dir) if name.endswith(".parquet"))
+    tables = []
+    for month in months:
+        path = os.path.join(cube_dir, f"{month}.parquet")
+        if os.path.exists(path):
+            table = pq.read_table(path)
+            tables.append(table.append_column("month", pa.array([month] * table.num_rows)))
+    return pa.concat_tables(tables) if tables else None
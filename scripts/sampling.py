@@ -0,0 +1,192 @@
+import datetime
+import hashlib
+import math
+import os
+
+# Deterministic row-group sampling for fast development runs. A seeded subset of
+# each file's row groups is read (optionally stratified by the pickup day in the
+# row-group statistics, or by position when stray pickups hide it), and counts
+# measured on it are scaled to the whole file with a stratified ratio estimator;
+# each row group is one sampled cluster.
+#   SAMPLE_FRACTION   share of row groups to read; 0 (default) or 1 reads the whole file
+#   SAMPLE_SEED       seed of the row-group choice (default 0)
+#   SAMPLE_STRATIFY   "day" (default) samples within each pickup day, "none" across the file
+sample_fraction = float(os.getenv("SAMPLE_FRACTION", "0"))
+sample_seed = int(os.getenv("SAMPLE_SEED", "0"))
+sample_stratify = os.getenv("SAMPLE_STRATIFY", "day")
+confidence = 0.95
+z_score = 1.959964  # Two-sided normal quantile for the confidence level
+
+
+def sampling_enabled(fraction=None):
+    fraction = sample_fraction if fraction is None else fraction
+    return 0 < fraction < 1
+
+
+# Naive UTC datetime of a statistics value, None when it is not a timestamp
+def naive_utc(value):
+    if not isinstance(value, datetime.datetime):
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+# Stratum of every row group: the pickup day ("YYYY-MM-DD") its statistics point to
+# inside the month. A min or max outside the month is a stray pickup and is ignored:
+# the row group is the day of its other bound, or of its midpoint without strays. When
+# any row group has strays at both ends its day is unknown, and the whole file is
+# stratified by position instead (see position_strata). None when the pickup column
+# has no statistics, the row group lies outside the month, or stratification is off.
+def row_group_strata(metadata, column, month, stratify=None, fraction=None):
+    stratify = sample_stratify if stratify is None else stratify
+    names = [metadata.schema.column(j).path for j in range(metadata.num_columns)]
+    if stratify != "day" or column not in names:
+        return [None] * metadata.num_row_groups
+    position = names.index(column)
+    year, month_num = (int(part) for part in month.split("-"))
+    month_start = datetime.datetime(year, month_num, 1)
+    month_end = datetime.datetime(year + month_num // 12, month_num % 12 + 1, 1)
+    strata = []
+    for i in range(metadata.num_row_groups):
+        stats = metadata.row_group(i).column(position).statistics
+        has_stats = stats is not None and stats.has_min_max
+        low = naive_utc(stats.min) if has_stats else None
+        high = naive_utc(stats.max) if has_stats else None
+        if low is None or high is None or high < month_start or low >= month_end:
+            strata.append(None)
+            continue
+        low_stray, high_stray = low < month_start, high >= month_end
+        if low_stray and high_stray:
+            return position_strata(metadata.num_row_groups, fraction)
+        day = high if low_stray else low if high_stray else low + (high - low) / 2
+        strata.append(day.date().isoformat())
+    return strata
+
+
+# Strata of consecutive row groups ("position-<k>"), about one sampled row group each:
+# TLC files are written roughly in pickup order, so position stands in for the day
+def position_strata(num_row_groups, fraction=None):
+    fraction = sample_fraction if fraction is None else fraction
+    count = max(1, min(num_row_groups, int(fraction * num_row_groups)))
+    return [f"position-{i * count // num_row_groups}" for i in range(num_row_groups)]
+
+
+# Stable rank of a row group under a seed, so adding row groups never reshuffles the rest
+def rank(seed, index):
+    return hashlib.blake2b(f"{seed}:{index}".encode(), digest_size=8).digest()
+
+
+# Seeded subset of row groups: in each stratum the lowest-ranked
+# ceil(fraction * row groups), at least one, returned in file order
+def select_row_groups(metadata, column, month, fraction=None, seed=None, stratify=None):
+    fraction = sample_fraction if fraction is None else fraction
+    seed = sample_seed if seed is None else seed
+    if not sampling_enabled(fraction):
+        return list(range(metadata.num_row_groups))
+    strata = {}
+    for i, stratum in enumerate(row_group_strata(metadata, column, month, stratify, fraction)):
+        strata.setdefault(stratum, []).append(i)
+    selected = []
+    for members in strata.values():
+        members = sorted(members, key=lambda i: rank(seed, i))
+        selected.extend(members[:max(1, math.ceil(fraction * len(members)))])
+    return sorted(selected)
+
+
+# Totals of counters over the whole file from per-row-group sample values.
+# values holds one {counter: value} dict per selected row group; returns
+# {counter: (estimate, low, high)} at the configured confidence. Within a stratum
+# the total is rows * (sum of values / sampled rows); its variance comes from the
+# residuals of the sampled row groups, with a finite population correction. Strata
+# with a single sampled row group borrow the residual variance of the whole sample.
+def estimate_totals(metadata, row_groups, values, column, month, stratify=None, fraction=None):
+    strata = row_group_strata(metadata, column, month, stratify, fraction)
+    group_rows = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+    names = sorted({name for sample in values for name in sample})
+    sampled = {}
+    for i, sample in zip(row_groups, values):
+        sampled.setdefault(strata[i], []).append((group_rows[i], sample))
+    population = {}
+    for i, stratum in enumerate(strata):
+        count, rows = population.get(stratum, (0, 0))
+        population[stratum] = (count + 1, rows + group_rows[i])
+
+    sampled_rows = sum(rows for members in sampled.values() for rows, _ in members)
+    estimates = {}
+    for name in names:
+        pooled_ratio = sum(sample.get(name, 0) for members in sampled.values()
+                           for _, sample in members) / max(sampled_rows, 1)
+        pooled_variance = residual_variance(
+            [(rows, sample.get(name, 0)) for members in sampled.values() for rows, sample in members], pooled_ratio)
+        total = variance = observed = 0.0
+        for stratum, members in sampled.items():
+            clusters, stratum_rows = population[stratum]
+            pairs = [(rows, sample.get(name, 0)) for rows, sample in members]
+            rows_read = sum(rows for rows, _ in pairs)
+            value_sum = sum(value for _, value in pairs)
+            observed += value_sum
+            if not rows_read:
+                continue
+            ratio = value_sum / rows_read
+            total += stratum_rows * ratio
+            spread = residual_variance(pairs, ratio) if len(pairs) > 1 else pooled_variance
+            mean_rows = rows_read / len(pairs)
+            variance += (stratum_rows / mean_rows) ** 2 * (1 - len(pairs) / clusters) * spread / len(pairs)
+        margin = z_score * math.sqrt(variance)
+        estimates[name] = (total, max(total - margin, observed), total + margin)
+    return estimates
+
+
+# Sample variance of the residuals value - ratio * rows over the sampled row groups
+def residual_variance(pairs, ratio):
+    if len(pairs) < 2:
+        return 0.0
+    return sum((value - ratio * rows) ** 2 for rows, value in pairs) / (len(pairs) - 1)
+
+
+# Numeric leaves of a nested counter dict as {"a.b": value}
+def flatten(counters, prefix=""):
+    flat = {}
+    for key, value in counters.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+# Replace the flattened counters in a nested dict with their estimates
+# (integer counters stay integers)
+def apply_estimates(counters, estimates, prefix=""):
+    for key, value in counters.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            apply_estimates(value, estimates, f"{name}.")
+        elif name in estimates and not isinstance(value, bool):
+            estimate = estimates[name][0]
+            counters[key] = round(estimate) if isinstance(value, int) else estimate
+
+
+# Sample summary stored with scaled results
+def sample_summary(metadata, row_groups, estimates):
+    return {
+        "fraction": sample_fraction,
+        "seed": sample_seed,
+        "stratify": sample_stratify,
+        "row_groups": row_groups,
+        "row_groups_total": metadata.num_row_groups,
+        "rows_read": sum(metadata.row_group(i).num_rows for i in row_groups),
+        "rows_total": metadata.num_rows,
+        "confidence": confidence,
+        "intervals": {name: [round(low, 2), round(high, 2)] for name, (_, low, high) in estimates.items()},
+    }
+
+
+# "<estimate> (95% CI <low>-<high>)" for a counter of a sampled result, or the value itself
+def describe(value, sample, name):
+    if sample is None or name not in sample["intervals"]:
+        return f"{value}"
+    low, high = sample["intervals"][name]
+    return f"~{value} ({confidence:.0%} CI {low:.0f}-{high:.0f})"
@@ -0,0 +1,411 @@
+import base64
+import json
+import math
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from dedup import mix, row_hashes
+
+# Mergeable distribution sketches per (dataset, month, column), built as a by-product
+# of the DQ scanner (raw files) and the transform (cleaned files) and kept in a small
+# store, one JSON file per dataset, source and month:
+#   <root>/<dataset>/<source>/<month>.json      source: "raw" or "clean"
+# Every part merges by addition, so any range of months is summarized, and months
+# are compared for drift, without rereading data:
+#   quantiles  log-spaced buckets (DDSketch): every quantile within 1% of its true value
+#   distinct   HyperLogLog over 2^12 registers (about 1.6% standard error) for measures
+#              (in cents) and trips; exact for codes and zones
+#   histogram  counts over fixed bins for measures, per value for codes and zones
+build_sketches = os.getenv("SKETCHES", "true").lower() == "true"  # SKETCHES=false skips them
+sketch_root = "data/sketches/"
+relative_accuracy = 0.01
+gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+log_gamma = math.log(gamma)
+hll_precision = 12
+drift_psi = float(os.getenv("SKETCH_DRIFT_PSI", "0.2"))  # Population stability index that flags drift
+drift_quantiles = [0.5, 0.9, 0.99]
+
+# Measures with quantile sketches; bins are the histogram's inner edges (values below
+# the first edge and from the last edge up get their own bins). trip_minutes comes
+# from the pickup and dropoff times.
+measure_bins = {
+    "fare_amount": [0, 5, 10, 15, 20, 30, 40, 50, 75, 100, 200, 1000],
+    "tip_amount": [0, 0.01, 1, 2, 3, 5, 10, 20, 50, 100],
+    "total_amount": [0, 10, 15, 20, 30, 40, 60, 80, 100, 200, 1000],
+    "trip_distance": [0, 0.5, 1, 2, 3, 5, 10, 20, 50, 100],
+    "trip_minutes": [0, 5, 10, 15, 20, 30, 45, 60, 120, 180],
+}
+# Codes and zones with exact per-value counts
+categorical_columns = ["VendorID", "RatecodeID", "payment_type", "PULocationID", "DOLocationID"]
+
+
+# Relative-error quantile sketch: counts per log-spaced bucket of |value|, kept apart
+# for positive and negative values, plus the values too close to zero to bucket
+class QuantileSketch:
+    min_indexable = 1e-9
+
+    def __init__(self):
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    @staticmethod
+    def bucket_counts(values):
+        if not len(values):
+            return []
+        keys = np.ceil(np.log(values) / log_gamma).astype(np.int64)
+        low = keys.min()
+        counts = np.bincount(keys - low)
+        used = np.flatnonzero(counts)
+        return zip((used + low).tolist(), counts[used].tolist())
+
+    # Fold in finite values (sign=-1 takes them back out; min and max are kept)
+    def add(self, values, sign=1):
+        if not len(values):
+            return
+        positive = values[values > self.min_indexable]
+        negative = -values[values < -self.min_indexable]
+        for store, part in ((self.positive, positive), (self.negative, negative)):
+            for key, count in self.bucket_counts(part):
+                store[key] = store.get(key, 0) + sign * count
+        self.zeros += sign * (len(values) - len(positive) - len(negative))
+        self.count += sign * len(values)
+        self.sum += sign * float(values.sum())
+        if sign > 0:
+            self.min = min(self.min, float(values.min()))
+            self.max = max(self.max, float(values.max()))
+
+    def merge(self, other):
+        for store, other_store in ((self.positive, other.positive), (self.negative, other.negative)):
+            for key, count in other_store.items():
+                store[key] = store.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    # Value at rank q (0-1), within relative_accuracy of the exact quantile
+    def quantile(self, q):
+        if self.count <= 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        buckets = ([(-2 * gamma ** key / (gamma + 1), count) for key, count in sorted(self.negative.items(), reverse=True)]
+                   + [(0.0, self.zeros)]
+                   + [(2 * gamma ** key / (gamma + 1), count) for key, count in sorted(self.positive.items())])
+        for value, count in buckets:
+            seen += count
+            if seen > rank:
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.sum, "zeros": self.zeros,
+                "min": self.min if self.count else None, "max": self.max if self.count else None,
+                "positive": sorted([key, count] for key, count in self.positive.items() if count),
+                "negative": sorted([key, count] for key, count in self.negative.items() if count)}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls()
+        sketch.positive = {key: count for key, count in data["positive"]}
+        sketch.negative = {key: count for key, count in data["negative"]}
+        sketch.zeros, sketch.count, sketch.sum = data["zeros"], data["count"], data["sum"]
+        sketch.min = math.inf if data["min"] is None else data["min"]
+        sketch.max = -math.inf if data["max"] is None else data["max"]
+        return sketch
+
+
+# HyperLogLog distinct count over 64-bit hashes
+class HyperLogLog:
+    def __init__(self, precision=hll_precision):
+        self.precision = precision
+        self.registers = np.zeros(2 ** precision, dtype=np.uint8)
+
+    # The top bits of a hash pick the register, which keeps the highest position of the
+    # first set bit in the rest (from the float64 exponent; off by one in ~2^-53 of hashes)
+    def add(self, hashes):
+        if not len(hashes):
+            return
+        index = hashes >> np.uint64(64 - self.precision)
+        exponents = (hashes << np.uint64(self.precision)).astype(np.float64).view(np.uint64) >> np.uint64(52)
+        ranks = np.clip(1087 - exponents.astype(np.int16), 1, 64 - self.precision + 1).astype(np.uint8)
+        higher = ranks > self.registers[index]
+        np.maximum.at(self.registers, index[higher], ranks[higher])
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self):
+        m = len(self.registers)
+        raw = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        empty = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and empty:
+            return round(m * math.log(m / empty))  # Linear counting for small cardinalities
+        return round(raw)
+
+    def to_dict(self):
+        return base64.b64encode(self.registers.tobytes()).decode()
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls()
+        sketch.registers = np.frombuffer(base64.b64decode(data), dtype=np.uint8).copy()
+        sketch.precision = int(math.log2(len(sketch.registers)))
+        return sketch
+
+
+# Hashes of measure values in cents for HyperLogLog (as the dedup keys: independent of
+# float32 or float64 output)
+def value_hashes(values):
+    return mix(np.round(values * 100).astype(np.int64).view(np.uint64) + np.uint64(0x632BE59BD9B4E019))
+
+
+# Sketches of one column: null count and either a quantile sketch, a binned histogram
+# and distinct values (measures) or per-value counts (codes)
+class ColumnSketch:
+    def __init__(self, bins=None):
+        self.bins = bins
+        self.nulls = 0
+        self.distinct = HyperLogLog() if bins is not None else None
+        self.quantiles = QuantileSketch() if bins is not None else None
+        self.histogram = [0] * (len(bins) + 1) if bins is not None else None
+        self.values = {} if bins is None else None
+
+    # Fold in an Arrow array (sign=-1 takes its values back out; distinct counts keep them)
+    def add(self, column, sign=1):
+        if self.bins is not None:
+            values = pc.cast(column, pa.float64()).to_numpy(zero_copy_only=False)
+            finite = values[np.isfinite(values)]
+            self.nulls += sign * (len(values) - len(finite))
+            self.quantiles.add(finite, sign)
+            below = [0] + [int(np.count_nonzero(finite < edge)) for edge in self.bins] + [len(finite)]
+            self.histogram = [count + sign * (high - low) for count, low, high in zip(self.histogram, below, below[1:])]
+            if sign > 0:
+                self.distinct.add(value_hashes(finite))
+        else:
+            self.nulls += sign * column.null_count
+            for item in pc.value_counts(column.drop_null()).to_pylist():
+                key = value_key(item["values"])
+                self.values[key] = self.values.get(key, 0) + sign * item["counts"]
+
+    def merge(self, other):
+        if self.bins != other.bins:
+            raise ValueError(f"Histogram bins differ: {self.bins} and {other.bins}")
+        self.nulls += other.nulls
+        if self.bins is not None:
+            self.distinct.merge(other.distinct)
+            self.quantiles.merge(other.quantiles)
+            self.histogram = [a + b for a, b in zip(self.histogram, other.histogram)]
+        else:
+            for key, count in other.values.items():
+                self.values[key] = self.values.get(key, 0) + count
+
+    def distinct_count(self):
+        if self.bins is not None:
+            return self.distinct.estimate()
+        return sum(1 for count in self.values.values() if count > 0)
+
+    # Share of the non-null values per histogram bin or value
+    def distribution(self):
+        counts = dict(enumerate(self.histogram)) if self.bins is not None else self.values
+        total = sum(counts.values())
+        return {key: count / total for key, count in counts.items()} if total else {}
+
+    def to_dict(self):
+        data = {"nulls": self.nulls}
+        if self.bins is not None:
+            data.update(bins=self.bins, histogram=self.histogram, quantiles=self.quantiles.to_dict(),
+                        distinct=self.distinct.to_dict())
+        else:
+            data["values"] = {key: count for key, count in self.values.items() if count}
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data.get("bins"))
+        sketch.nulls = data["nulls"]
+        if sketch.bins is not None:
+            sketch.distinct = HyperLogLog.from_dict(data["distinct"])
+            sketch.histogram = data["histogram"]
+            sketch.quantiles = QuantileSketch.from_dict(data["quantiles"])
+        else:
+            sketch.values = dict(data["values"])
+        return sketch
+
+
+# Stable key of a code: integral floats (e.g. RatecodeID 1.0) as integers
+def value_key(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+# Sketches of one month: add() per batch (raw or cleaned), merge() across row-group
+# ranges or months, remove() for rows dropped afterwards (e.g. duplicates). With
+# identity columns, distinct trips are counted too.
+class SketchSet:
+    def __init__(self, pickup=None, dropoff=None, identity=None):
+        self.pickup = pickup
+        self.dropoff = dropoff
+        self.identity = identity
+        self.rows = 0
+        self.columns = {}
+        self.trips = HyperLogLog() if identity else None
+
+    # Columns of a batch to sketch, with trip_minutes derived from pickup and dropoff
+    def sketched(self, table):
+        names = table.schema.names
+        columns = {name: table.column(name) for name in measure_bins if name in names}
+        if self.pickup in names and self.dropoff in names:
+            duration = pc.subtract(pc.cast(table.column(self.dropoff), pa.timestamp("us")),
+                                   pc.cast(table.column(self.pickup), pa.timestamp("us")))
+            columns["trip_minutes"] = pc.divide(pc.cast(pc.cast(duration, pa.int64()), pa.float64()), 60e6)
+        columns.update({name: table.column(name) for name in categorical_columns if name in names})
+        return columns
+
+    def add(self, table, sign=1):
+        self.rows += sign * table.num_rows
+        for name, column in self.sketched(table).items():
+            if isinstance(column, pa.ChunkedArray):
+                column = column.combine_chunks()
+            if name not in self.columns:
+                self.columns[name] = ColumnSketch(measure_bins.get(name))
+            self.columns[name].add(column, sign)
+        if self.trips is not None and sign > 0 and set(self.identity) <= set(table.schema.names):
+            self.trips.add(row_hashes(table, self.identity))
+
+    def remove(self, table):
+        self.add(table, sign=-1)
+
+    def merge(self, other):
+        self.rows += other.rows
+        for name, sketch in other.columns.items():
+            if name in self.columns:
+                self.columns[name].merge(sketch)
+            else:
+                self.columns[name] = ColumnSketch.from_dict(sketch.to_dict())
+        if other.trips is not None:
+            if self.trips is None:
+                self.trips = HyperLogLog()
+            self.trips.merge(other.trips)
+
+    # Per column: rows, nulls, distinct values, mean and quantiles of measures
+    def summary(self, quantiles=(0.5, 0.9, 0.99)):
+        result = {"rows": self.rows}
+        if self.trips is not None:
+            result["distinct_trips"] = self.trips.estimate()
+        for name, sketch in sorted(self.columns.items()):
+            column = {"nulls": sketch.nulls, "distinct": sketch.distinct_count()}
+            if sketch.quantiles is not None:
+                column["mean"] = sketch.quantiles.sum / sketch.quantiles.count if sketch.quantiles.count else None
+                column.update({f"p{round(q * 100)}": sketch.quantiles.quantile(q) for q in quantiles})
+            result[name] = column
+        return result
+
+    def to_dict(self):
+        return {"rows": self.rows, "trips": self.trips.to_dict() if self.trips is not None else None,
+                "columns": {name: sketch.to_dict() for name, sketch in self.columns.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketches = cls()
+        sketches.rows = data["rows"]
+        sketches.trips = HyperLogLog.from_dict(data["trips"]) if data["trips"] is not None else None
+        sketches.columns = {name: ColumnSketch.from_dict(column) for name, column in data["columns"].items()}
+        return sketches
+
+
+def sketch_path(dataset, source, month, root=sketch_root):
+    return os.path.join(root, dataset, source, f"{month}.json")
+
+
+# Replace the stored sketches of a month
+def save_sketches(sketches, dataset, source, month, root=sketch_root):
+    path = sketch_path(dataset, source, month, root)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(sketches.to_dict(), f)
+    os.replace(f"{path}.tmp", path)
+
+
+def load_sketches(dataset, source, month, root=sketch_root):
+    path = sketch_path(dataset, source, month, root)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return SketchSet.from_dict(json.load(f))
+
+
+def stored_months(dataset, source, root=sketch_root):
+    source_dir = os.path.join(root, dataset, source)
+    if not os.path.isdir(source_dir):
+        return []
+    return sorted(name[:-len(".json")] for name in os.listdir(source_dir) if name.endswith(".json"))
+
+
+# Sketches of every stored month in [start, end] (inclusive, "YYYY-MM"; open when None)
+# merged into one, e.g. a quarter or a year
+def merge_range(dataset, source, start=None, end=None, root=sketch_root):
+    merged = SketchSet()
+    for month in stored_months(dataset, source, root):
+        if (start is None or month >= start) and (end is None or month <= end):
+            merged.merge(load_sketches(dataset, source, month, root))
+    return merged
+
+
+# Population stability index between two distributions ({bin or value: share})
+def psi(expected, actual, floor=1e-4):
+    total = 0.0
+    for key in set(expected) | set(actual):
+        e, a = max(expected.get(key, 0.0), floor), max(actual.get(key, 0.0), floor)
+        total += (a - e) * math.log(a / e)
+    return total
+
+
+# Column-by-column comparison of two sketch sets: PSI of the histograms, relative
+# change of the measure quantiles and of the distinct counts; "drift" is set when
+# the PSI reaches SKETCH_DRIFT_PSI
+def compare(previous, current):
+    results = {}
+    for name in sorted(set(previous.columns) & set(current.columns)):
+        before, after = previous.columns[name], current.columns[name]
+        result = {"psi": round(psi(before.distribution(), after.distribution()), 4),
+                  "distinct": [before.distinct_count(), after.distinct_count()]}
+        if before.quantiles is not None:
+            result["quantiles"] = {f"p{round(q * 100)}": [before.quantiles.quantile(q), after.quantiles.quantile(q)]
+                                   for q in drift_quantiles}
+        result["drift"] = result["psi"] >= drift_psi
+        results[name] = result
+    return results
+
+
+# Compare a month with the stored month before it; None when there is none
+def compare_previous(dataset, source, month, sketches, root=sketch_root):
+    earlier = [stored for stored in stored_months(dataset, source, root) if stored < month]
+    if not earlier:
+        return None, None
+    return earlier[-1], compare(load_sketches(dataset, source, earlier[-1], root), sketches)
+
+
+# One-line description of a column's comparison, for logs
+def describe_change(name, result):
+    text = f"{name}: PSI {result['psi']:.3f}, distinct {result['distinct'][0]} -> {result['distinct'][1]}"
+    for label, (before, after) in result.get("quantiles", {}).items():
+        if before is not None and after is not None:
+            text += f", {label} {before:.2f} -> {after:.2f}"
+    return text
+
+
+# Store a month's sketches, returning the stored month before it and the comparison
+# with it (None, None for the first month)
+def record_month(sketches, dataset, source, month, root=sketch_root):
+    previous, changes = compare_previous(dataset, source, month, sketches, root)
+    save_sketches(sketches, dataset, source, month, root)
+    return previous, changes
@@ -0,0 +1,321 @@
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow.parquet as pq
+from manifest import file_fingerprint
+
+# Where raw and processed data live. Scripts keep their local layout
+# (data/raw/2025/yellow/..., data/processed/2025/yellow/...) as the object key:
+#   STORAGE_URL=""                       local files (default)
+#   STORAGE_URL="s3://bucket/prefix"     S3 or an S3-compatible store (S3_ENDPOINT_URL for MinIO)
+# S3 reads go through a read-through cache under STORAGE_CACHE_PATH that holds each
+# object as a sparse file plus the byte ranges fetched so far: Parquet readers fetch
+# the footer and then only the column chunks they project, with ranged GETs in
+# parallel, and the least recently used objects are evicted beyond STORAGE_CACHE_MB.
+storage_url = os.getenv("STORAGE_URL", "")
+s3_endpoint_url = os.getenv("S3_ENDPOINT_URL") or None
+cache_path = os.getenv("STORAGE_CACHE_PATH", "data/cache/")
+cache_bytes = int(os.getenv("STORAGE_CACHE_MB", "4096")) * 2**20
+storage_threads = int(os.getenv("STORAGE_THREADS", "8"))  # Concurrent ranged GETs and multipart uploads
+part_bytes = int(os.getenv("STORAGE_PART_MB", "8")) * 2**20  # Ranged GET and upload part size
+min_upload_part_bytes = 5 * 2**20  # S3 minimum for every multipart part but the last
+footer_bytes = 64 * 2**10  # First guess at the Parquet footer size
+coalesce_bytes = 2**20  # Column chunks closer than this are fetched in one request
+
+
+# Local files: every operation works on the path itself
+class LocalStorage:
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def size(self, path):
+        return os.path.getsize(path) if os.path.exists(path) else None
+
+    # Fingerprint of the stored file for change detection, or None if it does not exist
+    def fingerprint(self, path):
+        return file_fingerprint(path) if os.path.exists(path) else None
+
+    def metadata(self, path):
+        return pq.read_metadata(path)
+
+    # Local path to read; columns and row_groups limit what a remote store fetches
+    def fetch(self, path, columns=None, row_groups=None):
+        return path
+
+    # Publish a finished local file at its key
+    def put(self, path):
+        pass
+
+    def remove(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# Merge sorted (start, end) ranges that overlap or lie within gap bytes
+def coalesce(ranges, gap=0):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + gap:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+# Parts of ranges not covered by fetched (both sorted and coalesced)
+def subtract(ranges, fetched):
+    missing = []
+    for start, end in ranges:
+        for fetched_start, fetched_end in fetched:
+            if fetched_end <= start or fetched_start >= end:
+                continue
+            if fetched_start > start:
+                missing.append([start, fetched_start])
+            start = max(start, fetched_end)
+        if start < end:
+            missing.append([start, end])
+    return missing
+
+
+# Byte ranges of the column chunks of the given top-level columns (all when None)
+# in the given row groups (all when None)
+def column_chunk_ranges(metadata, columns, row_groups=None):
+    ranges = []
+    for i in row_groups if row_groups is not None else range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        for j in range(row_group.num_columns):
+            column = row_group.column(j)
+            if columns is not None and column.path_in_schema.split(".")[0] not in columns:
+                continue
+            start = column.data_page_offset
+            if column.has_dictionary_page and column.dictionary_page_offset:
+                start = min(start, column.dictionary_page_offset)
+            ranges.append([start, start + column.total_compressed_size])
+    return ranges
+
+
+# One cached object: a sparse file with the object's size and a JSON sidecar with
+# its ETag, the fetched ranges and when it was last used (complete=True adopts a
+# file already in place)
+class CacheEntry:
+    def __init__(self, path, size, etag, complete=False):
+        self.path = path
+        self.meta_file = f"{path}.json"
+        self.size = size
+        self.etag = etag
+        self.ranges = [[0, size]] if complete else []
+        if not complete and os.path.exists(self.meta_file):
+            with open(self.meta_file) as f:
+                meta = json.load(f)
+            if meta["etag"] == etag and meta["size"] == size and os.path.exists(path):
+                self.ranges = meta["ranges"]
+        if not self.ranges and os.path.exists(path):
+            os.remove(path)  # Stale version of the object
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Open without truncating: concurrent readers of the same object share the file
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+
+    def missing(self, ranges):
+        return subtract(coalesce(ranges), self.ranges)
+
+    def write(self, offset, data):
+        fd = os.open(self.path, os.O_WRONLY)
+        try:
+            os.pwrite(fd, data, offset)
+        finally:
+            os.close(fd)
+
+    def read(self, start, end):
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def save(self, ranges):
+        self.ranges = coalesce(self.ranges + ranges)
+        meta = {"etag": self.etag, "size": self.size, "ranges": self.ranges, "used": time.time()}
+        with open(f"{self.meta_file}.tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(f"{self.meta_file}.tmp", self.meta_file)
+
+
+# S3 or S3-compatible object store through boto3, with the local read-through cache
+class S3Storage:
+    def __init__(self, url, endpoint_url=None, cache_root=cache_path, cache_limit=cache_bytes):
+        import boto3
+        from botocore.config import Config
+        self.client = boto3.client("s3", endpoint_url=endpoint_url,
+                                   config=Config(max_pool_connections=max(storage_threads, 10)))
+        self.bucket, _, self.prefix = url[len("s3://"):].partition("/")
+        self.prefix = self.prefix.strip("/")
+        self.cache_root = cache_root
+        self.cache_limit = cache_limit
+
+    def key(self, path):
+        path = os.path.normpath(os.path.relpath(path) if os.path.isabs(path) else path).replace(os.sep, "/")
+        return f"{self.prefix}/{path}" if self.prefix else path
+
+    def cache_file(self, path):
+        return os.path.join(self.cache_root, self.bucket, self.key(path))
+
+    # (size, ETag) of the object, or None if it does not exist
+    def head(self, path):
+        from botocore.exceptions import ClientError
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=self.key(path))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return response["ContentLength"], response["ETag"]
+
+    def exists(self, path):
+        return self.head(path) is not None
+
+    def size(self, path):
+        head = self.head(path)
+        return head[0] if head is not None else None
+
+    # Size and ETag stand in for the local fingerprint, so cached copies never look changed
+    def fingerprint(self, path):
+        head = self.head(path)
+        return {"size": head[0], "etag": head[1]} if head is not None else None
+
+    def get_range(self, key, start, end):
+        response = self.client.get_object(Bucket=self.bucket, Key=key, Range=f"bytes={start}-{end - 1}")
+        return response["Body"].read()
+
+    # Fetch missing ranges into the entry, split into parts and downloaded concurrently
+    def fill(self, entry, key, ranges):
+        missing = entry.missing(ranges)
+        if not missing:
+            return 0
+        missing = coalesce(missing, coalesce_bytes)
+        parts = [(offset, min(offset + part_bytes, end))
+                 for start, end in missing for offset in range(start, end, part_bytes)]
+
+        def fetch_part(part):
+            entry.write(part[0], self.get_range(key, *part))
+
+        with ThreadPoolExecutor(max_workers=storage_threads) as executor:
+            list(executor.map(fetch_part, parts))
+        entry.save(missing)
+        return sum(end - start for start, end in missing)
+
+    def entry(self, path):
+        head = self.head(path)
+        if head is None:
+            raise FileNotFoundError(f"s3://{self.bucket}/{self.key(path)} not found")
+        return CacheEntry(self.cache_file(path), *head)
+
+    # Footer-only fetch: the object's ranges stay cached for later column reads
+    def metadata(self, path):
+        entry = self.entry(path)
+        self.fill_footer(entry, self.key(path))
+        entry.save([])
+        return pq.read_metadata(entry.path)
+
+    def fill_footer(self, entry, key):
+        self.fill(entry, key, [[max(entry.size - footer_bytes, 0), entry.size]])
+        footer_length = int.from_bytes(entry.read(entry.size - 8, entry.size - 4), "little")
+        self.fill(entry, key, [[max(entry.size - 8 - footer_length, 0), entry.size]])
+
+    # Local path of a cached copy that holds the footer and the column chunks of
+    # columns in row_groups (the whole object when both are None); only missing
+    # ranges are downloaded
+    def fetch(self, path, columns=None, row_groups=None):
+        entry = self.entry(path)
+        key = self.key(path)
+        if columns is None and row_groups is None:
+            self.fill(entry, key, [[0, entry.size]])
+        else:
+            self.fill_footer(entry, key)
+            self.fill(entry, key, column_chunk_ranges(pq.read_metadata(entry.path),
+                                                      set(columns) if columns is not None else None, row_groups))
+        entry.save([])
+        self.evict(keep=entry.path)
+        return entry.path
+
+    # Upload a finished local file to its key (multipart with concurrent parts above
+    # one part size), then move it into the cache as a complete entry
+    def put(self, path):
+        key = self.key(path)
+        size = os.path.getsize(path)
+        upload_part_bytes = max(part_bytes, min_upload_part_bytes)
+        if size <= upload_part_bytes:
+            with open(path, "rb") as f:
+                self.client.put_object(Bucket=self.bucket, Key=key, Body=f.read())
+        else:
+            upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=key)["UploadId"]
+
+            def upload_part(number):
+                offset = (number - 1) * upload_part_bytes
+                with open(path, "rb") as f:
+                    f.seek(offset)
+                    body = f.read(min(upload_part_bytes, size - offset))
+                response = self.client.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                                   PartNumber=number, Body=body)
+                return {"PartNumber": number, "ETag": response["ETag"]}
+
+            try:
+                with ThreadPoolExecutor(max_workers=storage_threads) as executor:
+                    numbers = range(1, (size + upload_part_bytes - 1) // upload_part_bytes + 1)
+                    parts = list(executor.map(upload_part, numbers))
+                self.client.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                                      MultipartUpload={"Parts": parts})
+            except Exception:
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+                raise
+
+        cache_file = self.cache_file(path)
+        self.drop(cache_file)
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        shutil.move(path, cache_file)
+        CacheEntry(cache_file, size, self.head(path)[1], complete=True).save([])
+        self.evict(keep=cache_file)
+
+    def remove(self, path):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(path))
+        self.drop(self.cache_file(path))
+
+    def drop(self, cache_file):
+        for name in (cache_file, f"{cache_file}.json"):
+            if os.path.exists(name):
+                os.remove(name)
+
+    # Remove least recently used entries until the fetched bytes fit the cache limit
+    def evict(self, keep=None):
+        entries = []
+        for directory, _, names in os.walk(self.cache_root):
+            for name in names:
+                if not name.endswith(".json"):
+                    continue
+                meta_file = os.path.join(directory, name)
+                try:
+                    with open(meta_file) as f:
+                        meta = json.load(f)
+                except (OSError, ValueError):
+                    continue  # Being replaced by another process
+                entries.append((meta["used"], sum(end - start for start, end in meta["ranges"]),
+                                meta_file[:-len(".json")]))
+        total = sum(size for _, size, _ in entries)
+        for _, size, cache_file in sorted(entries):
+            if total <= self.cache_limit:
+                break
+            if cache_file != keep:
+                self.drop(cache_file)
+                total -= size
+
+
+def open_storage(url=storage_url, endpoint_url=s3_endpoint_url):
+    if not url:
+        return LocalStorage()
+    if url.startswith("s3://"):
+        return S3Storage(url, endpoint_url)
+    raise ValueError(f"Unsupported STORAGE_URL {url}; use an s3:// URL or leave it empty for local files")
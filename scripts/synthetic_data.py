@@ -0,0 +1,355 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import os
+import logging
+import time
+from cleaning_rules import cleaning_rules
+
+# Deterministic synthetic TLC raw files with the published yellow, green and HVFHV
+# schemas, written where extract.py puts real downloads:
+#   data/raw/<year>/<dataset>/<prefix>_<month>.parquet
+# The same seed, rows and row group size always produce the same files.
+rows = int(os.getenv("SYNTH_ROWS", "1000000"))  # Rows per dataset and month
+seed = int(os.getenv("SYNTH_SEED", "0"))
+anomaly_rate = float(os.getenv("SYNTH_ANOMALY_RATE", "0.002"))  # Share of rows per anomaly kind
+row_group_size = int(os.getenv("SYNTH_ROW_GROUP_SIZE", "1000000"))  # Rows generated and written at a time
+datasets = os.getenv("TLC_DATASETS", "yellow,green,hvfhv").split(",")
+months = os.getenv("TLC_MONTHS", "2025-01,2025-02,2025-03").split(",")
+raw_path = "data/raw/"
+lookup_path = "data/raw/2025/lookup/taxi_zone_lookup.csv"
+log_path = "logs/synthetic/"
+zone_count = 263  # Real zones; 264 (Unknown) and 265 (Outside of NYC) only come from anomalies
+
+# Raw file schemas as published by the TLC for 2025
+raw_schemas = {
+    "yellow": pa.schema([
+        ("VendorID", pa.int32()),
+        ("tpep_pickup_datetime", pa.timestamp("us")),
+        ("tpep_dropoff_datetime", pa.timestamp("us")),
+        ("passenger_count", pa.int64()),
+        ("trip_distance", pa.float64()),
+        ("RatecodeID", pa.int64()),
+        ("store_and_fwd_flag", pa.string()),
+        ("PULocationID", pa.int32()),
+        ("DOLocationID", pa.int32()),
+        ("payment_type", pa.int64()),
+        ("fare_amount", pa.float64()),
+        ("extra", pa.float64()),
+        ("mta_tax", pa.float64()),
+        ("tip_amount", pa.float64()),
+        ("tolls_amount", pa.float64()),
+        ("improvement_surcharge", pa.float64()),
+        ("total_amount", pa.float64()),
+        ("congestion_surcharge", pa.float64()),
+        ("Airport_fee", pa.float64()),
+        ("cbd_congestion_fee", pa.float64()),
+    ]),
+    "green": pa.schema([
+        ("VendorID", pa.int32()),
+        ("lpep_pickup_datetime", pa.timestamp("us")),
+        ("lpep_dropoff_datetime", pa.timestamp("us")),
+        ("store_and_fwd_flag", pa.string()),
+        ("RatecodeID", pa.int64()),
+        ("PULocationID", pa.int32()),
+        ("DOLocationID", pa.int32()),
+        ("passenger_count", pa.int64()),
+        ("trip_distance", pa.float64()),
+        ("fare_amount", pa.float64()),
+        ("extra", pa.float64()),
+        ("mta_tax", pa.float64()),
+        ("tip_amount", pa.float64()),
+        ("tolls_amount", pa.float64()),
+        ("ehail_fee", pa.float64()),
+        ("improvement_surcharge", pa.float64()),
+        ("total_amount", pa.float64()),
+        ("payment_type", pa.int64()),
+        ("trip_type", pa.int64()),
+        ("congestion_surcharge", pa.float64()),
+        ("cbd_congestion_fee", pa.float64()),
+    ]),
+    "hvfhv": pa.schema([
+        ("hvfhs_license_num", pa.string()),
+        ("dispatching_base_num", pa.string()),
+        ("originating_base_num", pa.string()),
+        ("request_datetime", pa.timestamp("us")),
+        ("on_scene_datetime", pa.timestamp("us")),
+        ("pickup_datetime", pa.timestamp("us")),
+        ("dropoff_datetime", pa.timestamp("us")),
+        ("PULocationID", pa.int32()),
+        ("DOLocationID", pa.int32()),
+        ("trip_miles", pa.float64()),
+        ("trip_time", pa.int64()),
+        ("base_passenger_fare", pa.float64()),
+        ("tolls", pa.float64()),
+        ("bcf", pa.float64()),
+        ("sales_tax", pa.float64()),
+        ("congestion_surcharge", pa.float64()),
+        ("airport_fee", pa.float64()),
+        ("tips", pa.float64()),
+        ("driver_pay", pa.float64()),
+        ("shared_request_flag", pa.string()),
+        ("shared_match_flag", pa.string()),
+        ("access_a_ride_flag", pa.string()),
+        ("wav_request_flag", pa.string()),
+        ("wav_match_flag", pa.string()),
+        ("cbd_congestion_fee", pa.float64()),
+    ]),
+}
+
+# Injected anomalies, each hitting anomaly_rate of the rows:
+#   bad_date            null pickup or dropoff timestamp
+#   out_of_month        trip shifted into the previous or next month
+#   negative_duration   dropoff before pickup
+#   unknown_zone        PULocationID 264 or 265
+#   excluded_payment    payment_type 3, 4 or 5 (yellow and green)
+#   tip_outlier / distance_outlier   values far above the $100 / 100 mile caps
+anomalies = ["bad_date", "out_of_month", "negative_duration", "unknown_zone",
+             "excluded_payment", "tip_outlier", "distance_outlier"]
+
+# Create log directory
+os.makedirs(log_path, exist_ok=True)
+
+# Configure logger
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+log_file = os.path.join(log_path, "synthetic_data.log")
+file_handler = logging.FileHandler(log_file)
+file_handler.setFormatter(logging.Formatter(
+    "%(asctime)s - %(levelname)s - %(message)s"))
+logger.addHandler(file_handler)
+
+
+# Zone lookup with the real file's layout, for workspaces without a downloaded one
+def write_lookup(path):
+    boroughs = ["Manhattan", "Queens", "Brooklyn", "Bronx", "Staten Island"]
+    records = [(1, "EWR", "Newark Airport", "EWR")]
+    for location_id in range(2, zone_count + 1):
+        borough = boroughs[location_id % len(boroughs)]
+        service_zone = "Yellow Zone" if borough == "Manhattan" else "Boro Zone"
+        if location_id in (132, 138):
+            service_zone = "Airports"
+        records.append((location_id, borough, f"Zone {location_id}", service_zone))
+    records += [(264, "Unknown", "N/A", "N/A"), (265, "N/A", "Outside of NYC", "N/A")]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pd.DataFrame(records, columns=["LocationID", "Borough", "Zone", "service_zone"]).to_csv(path, index=False)
+
+
+# Skewed zone popularity, fixed per seed so every chunk and month shares it
+def zone_weights():
+    weights = np.random.default_rng([seed]).pareto(1.2, zone_count) + 0.05
+    return weights / weights.sum()
+
+
+def nullable(values, mask):
+    return pa.array(values, mask=mask)
+
+
+def flags(rng, n, values, p):
+    return pc.take(pa.array(values, pa.string()), pa.array(rng.choice(len(values), n, p=p)))
+
+
+# Shared trip core: timestamps, zones, distance, duration and fare
+def trip_core(rng, n, month, weights):
+    start = pd.Timestamp(f"{month}-01")
+    end = start + pd.offsets.MonthBegin(1)
+    start_us, end_us = start.value // 1000, end.value // 1000
+    minutes = np.clip(rng.lognormal(2.5, 0.6, n), 1, 180)
+    distance = np.round(np.clip(minutes / 60 * rng.normal(12, 4, n), 0.1, None), 2)
+    pickup = rng.integers(start_us, end_us - 180 * 60 * 10**6, n)
+    dropoff = pickup + (minutes * 60 * 10**6).astype(np.int64)
+    pu = rng.choice(zone_count, n, p=weights).astype(np.int32) + 1
+    do = rng.choice(zone_count, n, p=weights).astype(np.int32) + 1
+    fare = np.round(3.0 + 2.5 * distance + 0.5 * minutes, 2)
+    return {"pickup": pickup, "dropoff": dropoff, "minutes": minutes, "distance": distance,
+            "pu": pu, "do": do, "fare": fare}
+
+
+# Rows hit by each anomaly kind, disjoint so counts stay exact
+def anomaly_rows(rng, n):
+    kinds = rng.random(n)
+    return {kind: (kinds >= i * anomaly_rate) & (kinds < (i + 1) * anomaly_rate)
+            for i, kind in enumerate(anomalies)}
+
+
+def apply_anomalies(rng, core, hits, payment_type, tip, month_span_us):
+    n = len(core["pickup"])
+    shift = np.where(rng.random(n) < 0.5, -month_span_us, month_span_us)
+    core["pickup"] = np.where(hits["out_of_month"], core["pickup"] + shift, core["pickup"])
+    core["dropoff"] = np.where(hits["out_of_month"], core["dropoff"] + shift, core["dropoff"])
+    core["dropoff"] = np.where(hits["negative_duration"],
+                               core["pickup"] - rng.integers(60, 3600, n) * 10**6, core["dropoff"])
+    core["pu"] = np.where(hits["unknown_zone"], rng.integers(264, 266, n).astype(np.int32), core["pu"])
+    core["distance"] = np.where(hits["distance_outlier"], np.round(rng.uniform(100.5, 5000, n), 2),
+                                core["distance"])
+    if payment_type is not None:
+        payment_type[hits["excluded_payment"]] = rng.integers(3, 6, int(hits["excluded_payment"].sum()))
+    tip[hits["tip_outlier"]] = np.round(rng.uniform(100.5, 1000, int(hits["tip_outlier"].sum())), 2)
+    bad_pickup = hits["bad_date"] & (rng.random(n) < 0.5)
+    return bad_pickup, hits["bad_date"] & ~bad_pickup
+
+
+def timestamps(values, mask):
+    return pa.array(values, mask=mask).cast(pa.timestamp("us"))
+
+
+def card_tips(rng, fare, payment_type):
+    return np.where(payment_type == 1, np.round(fare * rng.uniform(0.1, 0.3, len(fare)), 2), 0.0)
+
+
+def yellow_chunk(rng, n, month, weights, month_span_us):
+    core = trip_core(rng, n, month, weights)
+    payment_type = rng.choice([0, 1, 2, 3, 4], n, p=[0.05, 0.76, 0.15, 0.02, 0.02])
+    tip = card_tips(rng, core["fare"], payment_type)
+    bad_pickup, bad_dropoff = apply_anomalies(
+        rng, core, anomaly_rows(rng, n), payment_type, tip, month_span_us)
+    # Flex Fare trips (payment_type 0) carry nulls in the dispatch fields, as in real files
+    flex = payment_type == 0
+    extra = rng.choice([0.0, 1.0, 2.5], n)
+    tolls = np.where(rng.random(n) < 0.05, 6.94, 0.0)
+    congestion = np.where(rng.random(n) < 0.9, 2.5, 0.0)
+    airport_fee = np.where(np.isin(core["pu"], [132, 138]), 1.75, 0.0)
+    cbd_fee = np.where(rng.random(n) < 0.6, 0.75, 0.0)
+    total = np.round(core["fare"] + extra + 0.5 + tip + tolls + 1.0 + congestion + airport_fee + cbd_fee, 2)
+    return pa.Table.from_arrays([
+        pa.array(rng.choice([1, 2, 6, 7], n, p=[0.25, 0.73, 0.01, 0.01]).astype(np.int32)),
+        timestamps(core["pickup"], bad_pickup),
+        timestamps(core["dropoff"], bad_dropoff),
+        nullable(rng.choice([0, 1, 2, 3, 4, 5, 6], n, p=[0.01, 0.74, 0.15, 0.04, 0.02, 0.02, 0.02]), flex),
+        pa.array(core["distance"]),
+        nullable(rng.choice([1, 2, 3, 4, 5, 99], n, p=[0.93, 0.04, 0.005, 0.005, 0.01, 0.01]), flex),
+        pc.if_else(pa.array(flex), pa.scalar(None, pa.string()), flags(rng, n, ["N", "Y"], [0.995, 0.005])),
+        pa.array(core["pu"]),
+        pa.array(core["do"]),
+        pa.array(payment_type),
+        pa.array(core["fare"]),
+        pa.array(extra),
+        pa.array(np.full(n, 0.5)),
+        pa.array(tip),
+        pa.array(tolls),
+        pa.array(np.full(n, 1.0)),
+        pa.array(total),
+        nullable(congestion, flex),
+        nullable(airport_fee, flex),
+        pa.array(cbd_fee),
+    ], schema=raw_schemas["yellow"])
+
+
+def green_chunk(rng, n, month, weights, month_span_us):
+    core = trip_core(rng, n, month, weights)
+    payment_type = rng.choice([1, 2, 3, 4], n, p=[0.6, 0.36, 0.02, 0.02])
+    tip = card_tips(rng, core["fare"], payment_type)
+    bad_pickup, bad_dropoff = apply_anomalies(
+        rng, core, anomaly_rows(rng, n), payment_type, tip, month_span_us)
+    # Some green trips have no payment, rate or trip type recorded (nulls, as in real files)
+    dispatch = rng.random(n) < 0.03
+    extra = rng.choice([0.0, 1.0, 2.5], n)
+    congestion = np.where(rng.random(n) < 0.2, 2.75, 0.0)
+    total = np.round(core["fare"] + extra + 0.5 + tip + 1.0 + congestion, 2)
+    return pa.Table.from_arrays([
+        pa.array(rng.choice([1, 2], n, p=[0.1, 0.9]).astype(np.int32)),
+        timestamps(core["pickup"], bad_pickup),
+        timestamps(core["dropoff"], bad_dropoff),
+        pc.if_else(pa.array(dispatch), pa.scalar(None, pa.string()), flags(rng, n, ["N", "Y"], [0.998, 0.002])),
+        nullable(rng.choice([1, 2, 5], n, p=[0.95, 0.01, 0.04]), dispatch),
+        pa.array(core["pu"]),
+        pa.array(core["do"]),
+        nullable(rng.choice([1, 2, 3, 5], n, p=[0.85, 0.1, 0.02, 0.03]), dispatch),
+        pa.array(core["distance"]),
+        pa.array(core["fare"]),
+        pa.array(extra),
+        pa.array(np.full(n, 0.5)),
+        pa.array(tip),
+        pa.array(np.zeros(n)),
+        pa.nulls(n, pa.float64()),
+        pa.array(np.full(n, 1.0)),
+        pa.array(total),
+        nullable(payment_type, dispatch),
+        nullable(rng.choice([1, 2], n, p=[0.97, 0.03]), dispatch),
+        nullable(congestion, dispatch),
+        pa.array(np.where(rng.random(n) < 0.1, 0.75, 0.0)),
+    ], schema=raw_schemas["green"])
+
+
+def hvfhv_chunk(rng, n, month, weights, month_span_us):
+    core = trip_core(rng, n, month, weights)
+    tip = np.where(rng.random(n) < 0.2, np.round(core["fare"] * rng.uniform(0.1, 0.25, n), 2), 0.0)
+    bad_pickup, bad_dropoff = apply_anomalies(rng, core, anomaly_rows(rng, n), None, tip, month_span_us)
+    uber = rng.random(n) < 0.72
+    request = core["pickup"] - rng.integers(60, 900, n) * 10**6
+    on_scene = np.where(uber, request + rng.integers(30, 600, n) * 10**6, 0)
+    fare = np.round(core["fare"] * 1.3, 2)
+    return pa.Table.from_arrays([
+        pc.if_else(pa.array(uber), "HV0003", "HV0005"),
+        pc.if_else(pa.array(uber), "B03404", "B03406"),
+        pc.if_else(pa.array(uber), "B03404", pa.scalar(None, pa.string())),
+        timestamps(request, None),
+        timestamps(on_scene, ~uber),
+        timestamps(core["pickup"], bad_pickup),
+        timestamps(core["dropoff"], bad_dropoff),
+        pa.array(core["pu"]),
+        pa.array(core["do"]),
+        pa.array(core["distance"]),
+        pa.array((core["minutes"] * 60).astype(np.int64)),
+        pa.array(fare),
+        pa.array(np.where(rng.random(n) < 0.05, 6.94, 0.0)),
+        pa.array(np.round(fare * 0.0275, 2)),
+        pa.array(np.round(fare * 0.08875, 2)),
+        pa.array(np.where(rng.random(n) < 0.6, 2.75, 0.0)),
+        pa.array(np.where(np.isin(core["pu"], [132, 138]), 2.5, 0.0)),
+        pa.array(tip),
+        pa.array(np.round(fare * 0.7 + tip, 2)),
+        flags(rng, n, ["N", "Y"], [0.97, 0.03]),
+        flags(rng, n, ["N", "Y"], [0.99, 0.01]),
+        flags(rng, n, ["N", " "], [0.99, 0.01]),
+        flags(rng, n, ["N", "Y"], [0.99, 0.01]),
+        flags(rng, n, ["N", "Y"], [0.95, 0.05]),
+        pa.array(np.where(rng.random(n) < 0.6, 1.5, 0.0)),
+    ], schema=raw_schemas["hvfhv"])
+
+
+chunk_builders = {"yellow": yellow_chunk, "green": green_chunk, "hvfhv": hvfhv_chunk}
+
+
+def output_file(dataset, month):
+    prefix = cleaning_rules[dataset]["file_prefix"]
+    return os.path.join(raw_path, month.split("-")[0], dataset, f"{prefix}_{month}.parquet")
+
+
+# Write one synthetic (dataset, month) file, row group by row group; each row group
+# has its own generator seeded by (seed, dataset, month, row group)
+def generate_month(dataset, month, num_rows=None):
+    num_rows = rows if num_rows is None else num_rows
+    path = output_file(dataset, month)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    weights = zone_weights()
+    month_span_us = 32 * 86400 * 10**6
+    dataset_no = list(raw_schemas).index(dataset)
+    year, month_no = (int(part) for part in month.split("-"))
+    with pq.ParquetWriter(f"{path}.tmp", raw_schemas[dataset]) as writer:
+        for group, offset in enumerate(range(0, num_rows, row_group_size)):
+            rng = np.random.default_rng([seed, dataset_no, year, month_no, group])
+            n = min(row_group_size, num_rows - offset)
+            writer.write_table(chunk_builders[dataset](rng, n, month, weights, month_span_us),
+                               row_group_size=row_group_size)
+    os.replace(f"{path}.tmp", path)
+    return path
+
+
+if __name__ == "__main__":
+    if not os.path.exists(lookup_path):
+        write_lookup(lookup_path)
+        logger.info(f"Wrote synthetic zone lookup {lookup_path}")
+    for dataset in datasets:
+        if dataset not in chunk_builders:
+            logger.warning(f"No synthetic generator for {dataset}, skipping")
+            continue
+        for month in months:
+            start = time.perf_counter()
+            path = generate_month(dataset, month)
+            logger.info(f"Generated {path}: {rows} rows in {time.perf_counter() - start:.1f}s")
+            print(f"Generated {dataset} {month}")
+    logger.removeHandler(file_handler)
+    file_handler.close()
@@ -1,161 +1,767 @@
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
 import os
 import logging
+import time
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
+from cleaning_rules import (cleaning_rules, compile_rules, source_columns, with_zone_columns,
+                            with_compact_schema, cast_table, reject_reasons)
+from zone_index import ZoneIndex
+from partitioned_dataset import partitioned_root, write_month_partitions
+from rollups import RollupBuilder, rollup_root, write_rollups
+from sketches import SketchSet, build_sketches, describe_change, record_month, sketch_root
+from metrics import StageMetrics, compressed_bytes, timer
+from dedup import StreamDeduplicator, count_resubmitted, earlier_hashes
+from memory_budget import MemoryGovernor, row_bytes
+from sampling import describe, estimate_totals, flatten, sample_fraction, sampling_enabled, sample_summary, \
+    select_row_groups
+from storage import open_storage
 
 # Configuration
 load_dotenv()
-raw_path = "data/raw/2025/yellow/"
-processed_path = "data/processed/2025/yellow/"
+dataset = os.getenv("TLC_DATASET", "yellow")  # "yellow", "green", "fhv" or "hvfhv"
+raw_path = f"data/raw/2025/{dataset}/"
+processed_path = f"data/processed/2025/{dataset}/"
 lookup_path = "data/raw/2025/lookup/taxi_zone_lookup.csv"
-log_path = "logs/yellow/"
-months = ["2025-01", "2025-02", "2025-03"]
-chunk_size = 100000
+log_path = f"logs/{dataset}/"
+months = os.getenv("TLC_MONTHS", "2025-01,2025-02,2025-03").split(",")
+engine = os.getenv("TRANSFORM_ENGINE", "pandas")  # "pandas" (yellow only) or "arrow"
+# >1 enables the process pool, "auto" one worker per CPU; with a memory budget
+# (MEMORY_BUDGET_MB) this is the upper bound, and batch sizes follow the budget
+workers_setting = os.getenv("TRANSFORM_WORKERS", "1")
+workers = os.cpu_count() or 1 if workers_setting == "auto" else int(workers_setting)
+row_groups_per_task = int(os.getenv("TRANSFORM_ROW_GROUPS_PER_TASK", "2"))
+# Extra lookup columns, e.g. "DO_Borough,PU_Zone,DO_Zone,PU_service_zone"
+zone_columns = [name for name in os.getenv("ZONE_COLUMNS", "").split(",") if name]
+output_profile = os.getenv("OUTPUT_PROFILE", "standard")  # "standard" or "compact"
+
+# Parquet writer settings per output profile; row_group_size None writes one row group per batch
+output_profiles = {
+    "standard": {"compression": "snappy", "compression_level": None, "row_group_size": None},
+    "compact": {"compression": "zstd", "compression_level": 6, "row_group_size": 1000000},
+}
+writer_settings = dict(output_profiles[output_profile])
+if os.getenv("PARQUET_COMPRESSION"):
+    writer_settings["compression"] = os.getenv("PARQUET_COMPRESSION")
+if os.getenv("PARQUET_COMPRESSION_LEVEL"):
+    writer_settings["compression_level"] = int(os.getenv("PARQUET_COMPRESSION_LEVEL"))
+if os.getenv("ROW_GROUP_SIZE"):
+    writer_settings["row_group_size"] = int(os.getenv("ROW_GROUP_SIZE"))
+# Also write a hive-partitioned copy sorted by pickup time: "" (off), "month" or "date"
+partitioned_output = os.getenv("PARTITIONED_OUTPUT", "")
+partition_row_group_size = int(os.getenv("PARTITION_ROW_GROUP_SIZE", "50000"))
+build_rollups = os.getenv("ROLLUPS", "true").lower() == "true"  # Demand/OD cubes under data/rollups
+# Write rejected rows with their reject_reason code to data/quarantine (arrow engine)
+quarantine = os.getenv("QUARANTINE", "false").lower() == "true"
+quarantine_path = f"data/quarantine/2025/{dataset}/"
+quarantine_settings = {"compression": "zstd", "compression_level": 6, "row_group_size": 250000}
+# Drop trips repeated within a month and count resubmissions of earlier months' trips (state in data/state/dedup)
+dedup = os.getenv("DEDUP", "false").lower() == "true"
+
+# Raw input and processed output through the storage layer (STORAGE_URL)
+storage = open_storage()
+
+# FUSED_LOAD=true streams each month's cleaned batches straight into the warehouse
+# (load_to_snowflake settings) while it is transformed; PERSIST_PROCESSED=false then
+# skips writing the processed Parquet file
+fused_load = os.getenv("FUSED_LOAD", "false").lower() == "true"
+persist_processed = os.getenv("PERSIST_PROCESSED", "true").lower() == "true"
+
+# SAMPLE_FRACTION cleans a seeded subset of row groups per month for fast rule
+# iteration: output goes to data/sample/ and stays local, the month's counts are
+# scaled up with confidence intervals, and state-changing steps (dedup runs,
+# rollups, sketches, partitions) are skipped
+sampling = sampling_enabled()
+if sampling:
+    processed_path = f"data/sample/processed/2025/{dataset}/"
+    quarantine_path = f"data/sample/quarantine/2025/{dataset}/"
+    build_rollups = build_sketches = dedup = False
+    partitioned_output = ""
+
+# Cleaning rules and output schema for the dataset
+rules = with_zone_columns(cleaning_rules[dataset], zone_columns)
+if output_profile == "compact":
+    rules = with_compact_schema(rules)
+output_schema = rules["schema"]
+file_prefix = rules["file_prefix"]
 
 # Create directories
 os.makedirs(processed_path, exist_ok=True)
+if quarantine:
+    os.makedirs(quarantine_path, exist_ok=True)
 os.makedirs(log_path, exist_ok=True)
 
 # Configure logger
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-log_file = os.path.join(log_path, "transform_yellow.log")
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())  # DEBUG adds sample row dumps
+log_file = os.path.join(log_path, f"transform_{dataset}.log")
 file_handler = logging.FileHandler(log_file)
 file_handler.setFormatter(logging.Formatter(
     "%(asctime)s - %(levelname)s - %(message)s"))
 logger.addHandler(file_handler)
 
-# Load taxi zone lookup
+# Load taxi zone lookup into a dense LocationID index
 try:
     lookup = pd.read_csv(lookup_path)
     logger.info(f"Taxi zone lookup loaded: {lookup.columns.tolist()}")
     logger.info(
         f"Unique Boroughs in lookup: {lookup['Borough'].unique().tolist()}")
+    zones = ZoneIndex(lookup)
 except Exception as e:
     logger.error(f"Failed to load {lookup_path}: {e}", exc_info=True)
     exit()
 
-for month in months:
-    input_file = f"{raw_path}/yellow_tripdata_{month}.parquet"
-    output_file = f"{processed_path}/yellow_tripdata_{month}_cleaned.parquet"
+# The pandas engine only implements the yellow rules with the PU Borough, and
+# rejection reasons come from the arrow engine's reject codes
+if engine == "pandas" and (dataset != "yellow" or zone_columns or quarantine):
+    logger.warning(
+        f"pandas engine only supports yellow without ZONE_COLUMNS or QUARANTINE, using arrow for {dataset}")
+    engine = "arrow"
+
+# The warehouse table holds yellow trips, and a sample must never be loaded
+if fused_load and (dataset != "yellow" or sampling):
+    logger.warning(f"FUSED_LOAD only supports full yellow runs, transforming {dataset} without loading")
+    fused_load = False
+if fused_load:
+    from load_to_snowflake import MonthStream
+    if workers > 1:
+        logger.warning("FUSED_LOAD streams one month at a time in-process, ignoring TRANSFORM_WORKERS")
+# Partitions are written from the processed file
+if not persist_processed and (not fused_load or partitioned_output):
+    logger.warning("PERSIST_PROCESSED=false requires FUSED_LOAD without PARTITIONED_OUTPUT, writing processed files")
+    persist_processed = True
+
+
+# Apply the yellow cleaning rules to one batch, returns (cleaned chunk, invalid date rows)
+def clean_chunk(df_chunk, month):
+    year, month_num = (int(part) for part in month.split('-'))
+    invalid_date_rows = 0
+
+    # Convert and filter dates with explicit ns precision
+    df_chunk['tpep_pickup_datetime'] = pd.to_datetime(
+        df_chunk['tpep_pickup_datetime'], errors='coerce', unit='ns')
+    df_chunk['tpep_dropoff_datetime'] = pd.to_datetime(
+        df_chunk['tpep_dropoff_datetime'], errors='coerce', unit='ns')
+    invalid_dates = df_chunk[df_chunk['tpep_pickup_datetime'].isna(
+    ) | df_chunk['tpep_dropoff_datetime'].isna()]
+    if not invalid_dates.empty:
+        logger.warning(
+            f"Invalid dates in {month}: {len(invalid_dates)} rows")
+        invalid_date_rows += len(invalid_dates)
+    df_chunk = df_chunk.dropna(
+        subset=['tpep_pickup_datetime', 'tpep_dropoff_datetime'])
+    df_chunk = df_chunk[(df_chunk['tpep_pickup_datetime'].dt.year == year) &
+                        (df_chunk['tpep_pickup_datetime'].dt.month == month_num) &
+                        (df_chunk['tpep_dropoff_datetime'].dt.year == year) &
+                        (df_chunk['tpep_dropoff_datetime'].dt.month == month_num)]
+
+    # Handle nulls (drop rows with nulls in key fields tied to Flex Fare)
+    df_chunk = df_chunk.dropna(subset=['passenger_count', 'RatecodeID', 'store_and_fwd_flag',
+                                       'congestion_surcharge', 'Airport_fee'])
+
+    # Filter outliers and invalid PULocationID
+    df_chunk = df_chunk[df_chunk["tip_amount"] <= 100]
+    df_chunk = df_chunk[df_chunk["trip_distance"] <= 100]
+    df_chunk = df_chunk[df_chunk["tpep_dropoff_datetime"]
+                        >= df_chunk["tpep_pickup_datetime"]]
+    df_chunk = df_chunk[df_chunk["PULocationID"]
+                        != 265]  # Exclude unknown zone
+
+    # Exclude payment_type 3,4,5 and nulls
+    df_chunk = df_chunk[~df_chunk["payment_type"].isin([3, 4, 5])]
+    df_chunk = df_chunk[df_chunk["payment_type"].notnull()]
+
+    # Gather Borough from the zone index as a categorical column
+    pu_ids = pa.array(df_chunk["PULocationID"], from_pandas=True)
+    positions = zones.positions(pu_ids)
+    df_chunk["Borough"] = zones.gather(pu_ids, "Borough", positions).to_pandas().values
+    unknown_borough_count, unmatched_pu = zones.unmatched(pu_ids, "Borough", positions)
+    if len(unmatched_pu) > 0:
+        logger.warning(
+            f"Unmatched PULocationIDs in {month}: {unmatched_pu}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f"Sample rows with unmatched PULocationIDs:\n{df_chunk[df_chunk['PULocationID'].isin(unmatched_pu)].head().to_string()}")
+    if unknown_borough_count > 0:
+        logger.warning(
+            f"Unknown Borough values in {month}: {unknown_borough_count} rows")
+
+    # Calculate Airport_fee
+    df_chunk['Airport_fee'] = np.where(
+        df_chunk['PULocationID'].isin([1, 132]), 5.0, 0.0)
+
+    # Drop unneeded columns
+    df_chunk = df_chunk.drop(
+        columns=['store_and_fwd_flag', 'mta_tax', 'extra', 'tolls_amount'])
+
+    return df_chunk, invalid_date_rows
+
+
+# Pandas engine: clean a record batch with clean_chunk, return (table, invalid date
+# rows, None); its sequential filters carry no rejection reasons
+def clean_batch_pandas(batch, month, metrics=None):
+    with timer(metrics, "clean"):
+        df_chunk, invalid_date_rows = clean_chunk(batch.to_pandas(), month)
+        pandas_schema = cleaning_rules["yellow"]["schema"]
+        table = pa.Table.from_pandas(
+            df_chunk[pandas_schema.names], schema=pandas_schema, preserve_index=False)
+        return cast_table(table, output_schema), invalid_date_rows, None
+
+
+# Arrow engine: the dataset's declarative rules compiled into one reject code and one
+# filter; returns (table, invalid date rows, rule stats with reject_reasons and rejected)
+def clean_batch_arrow(batch, month, metrics=None):
+    table, stats = compile_rules(rules, month, zones, metrics.phase if metrics else None, quarantine)(batch)
+    if metrics is not None:
+        metrics.add_rules(stats["rules_dropped"])
+        for reason, rows in stats["reject_reasons"].items():
+            metrics.add(f"rejected_{reason}", rows)
+    invalid_date_rows = stats["invalid_date_rows"]
+    if invalid_date_rows:
+        logger.warning(f"Invalid dates in {month}: {invalid_date_rows} rows")
+    for output, (unknown_rows, unmatched_ids) in stats["unmatched_zones"].items():
+        id_column = rules["zones"][output][0]
+        if unmatched_ids:
+            logger.warning(f"Unmatched {id_column}s in {month}: {unmatched_ids}")
+        if unknown_rows > 0:
+            logger.warning(f"Unknown {output} values in {month}: {unknown_rows} rows")
+    return table, invalid_date_rows, stats
+
+
+clean_batch = clean_batch_arrow if engine == "arrow" else clean_batch_pandas
+
+
+# Columns the engine reads from a raw file with the given columns (None: all)
+def input_columns(names):
+    return source_columns(rules, names) if engine == "arrow" else None
+
+
+# Local copy of a raw file holding the columns the engine reads (of row_groups when given)
+def fetch_input(input_file, row_groups=None):
+    names = storage.metadata(input_file).schema.to_arrow_schema().names
+    return storage.fetch(input_file, input_columns(names), row_groups)
+
+
+# Per-column null counts (NaN counted as null, as pandas does)
+def count_nulls(table):
+    return {name: table.column(name).null_count if not pa.types.is_floating(table.column(name).type)
+            else pc.sum(pc.is_null(table.column(name), nan_is_null=True)).as_py() or 0
+            for name in table.column_names}
+
+
+# Rows without a null in any column
+def count_valid_rows(table, null_counts):
+    cols_with_nulls = [name for name, count in null_counts.items() if count]
+    if not cols_with_nulls:
+        return table.num_rows
+    has_null = pc.is_null(table.column(cols_with_nulls[0]), nan_is_null=True)
+    for name in cols_with_nulls[1:]:
+        has_null = pc.or_(has_null, pc.is_null(
+            table.column(name), nan_is_null=True))
+    return table.num_rows - (pc.sum(has_null).as_py() or 0)
+
+
+# ParquetWriter with the profile's compression that regroups written tables into
+# row groups of row_group_size rows (or writes each table as is when unset).
+# Quarantine files pass their own schema and quarantine_settings.
+class RowGroupWriter:
+    def __init__(self, path, schema=None, settings=None):
+        settings = settings or writer_settings
+        self.writer = pq.ParquetWriter(
+            path, schema or output_schema, compression=settings["compression"],
+            compression_level=settings["compression_level"])
+        self.row_group_size = settings["row_group_size"]
+        self.pending = []
+        self.pending_rows = 0
+
+    def write_table(self, table):
+        if self.row_group_size is None:
+            self.writer.write_table(table)
+            return
+        self.pending.append(table)
+        self.pending_rows += table.num_rows
+        if self.pending_rows >= self.row_group_size:
+            self.flush(final=False)
+
+    # Write full row groups; keep the remainder pending unless final
+    def flush(self, final):
+        if not self.pending:
+            return
+        combined = pa.concat_tables(self.pending)
+        full = combined.num_rows if final else combined.num_rows - combined.num_rows % self.row_group_size
+        if full:
+            self.writer.write_table(combined.slice(0, full), row_group_size=self.row_group_size)
+        self.pending = [combined.slice(full)] if full < combined.num_rows else []
+        self.pending_rows = combined.num_rows - full
+
+    def close(self):
+        self.flush(final=True)
+        self.writer.close()
+
+
+# Governor of transform tasks reading bytes_per_row from the raw file; a task also
+# holds the output rows ROW_GROUP_SIZE keeps buffered
+def transform_governor(bytes_per_row, budget=None, max_workers=1, processes=False):
+    reserve = (writer_settings["row_group_size"] or 0) * bytes_per_row
+    return MemoryGovernor("transform_pandas" if engine == "pandas" else "transform", bytes_per_row,
+                          max_workers, processes, reserve, budget)
+
+
+# Clean a range of row groups from one raw file into part_file (rejected rows into
+# rejected_file with QUARANTINE), return the counters (stats["metrics"] holds the
+# range's metrics summary). duplicates (a StreamDeduplicator) drops repeated trips
+# before they are written; with DEDUP, stats["earlier_hashes"] collects the identity
+# hashes of raw rows picked up in earlier months. In fused mode cleaned tables also go
+# to sink, and part_file may be None.
+# budget is the task's share of the memory budget (the whole budget when None).
+def transform_row_groups(month, input_file, row_groups, part_file, rejected_file=None, sink=None,
+                         duplicates=None, budget=None):
+    metrics = StageMetrics("transform", dataset=dataset, month=month)
+    collect_samples = logger.isEnabledFor(logging.DEBUG)
+    stats = {
+        "total_rows": 0,
+        "valid_rows": 0,
+        "invalid_date_rows": 0,
+        "dropped_rows": 0,
+        "reject_reasons": dict.fromkeys(reject_reasons, 0) if engine == "arrow" else None,
+        "null_counts": dict.fromkeys(output_schema.names, 0),
+        "first_rows": None,
+        "last_rows": None,
+        "rollups": RollupBuilder(rules["pickup"], rules["dropoff"]) if build_rollups else None,
+        "sketches": SketchSet(rules["pickup"], rules["dropoff"], rules["identity"]) if build_sketches else None,
+        "earlier_hashes": {} if dedup else None,
+    }
+    writer = None
+    rejected_writer = None
 
     try:
-        if not os.path.exists(input_file):
+        # Stream row groups batch by batch; each cleaned batch is written immediately
+        parquet_file = pq.ParquetFile(input_file)
+        columns = input_columns(parquet_file.schema_arrow.names)
+        metrics.add("bytes_read", compressed_bytes(parquet_file.metadata, row_groups, columns))
+        governor = transform_governor(row_bytes(parquet_file.metadata, columns), budget)
+        logger.debug(f"Transforming {month} row groups {row_groups}: {governor.describe()}")
+        batches = governor.batches(parquet_file, row_groups, columns)
+        while True:
+            batch_start = time.perf_counter()
+            with metrics.phase("read"):
+                batch = next(batches, None)
+            if batch is None:
+                break
+            if stats["earlier_hashes"] is not None:
+                with metrics.phase("dedup"):
+                    for pickup_month, hashes in earlier_hashes(batch, rules, output_schema, month).items():
+                        stats["earlier_hashes"].setdefault(pickup_month, []).append(hashes)
+            table, chunk_invalid_dates, rule_stats = clean_batch(batch, month, metrics)
+            if duplicates is not None and table.num_rows:
+                with metrics.phase("dedup"):
+                    table = table.filter(duplicates.keep_mask(table))
+            stats["invalid_date_rows"] += chunk_invalid_dates
+            stats["dropped_rows"] += batch.num_rows - table.num_rows
+            metrics.add("rows_in", batch.num_rows)
+            metrics.add("rows_out", table.num_rows)
+            if rule_stats is not None:
+                for reason, rows in rule_stats["reject_reasons"].items():
+                    stats["reject_reasons"][reason] += rows
+                rejected = rule_stats["rejected"]
+                if rejected is not None and rejected.num_rows and rejected_file is not None:
+                    with metrics.phase("quarantine"):
+                        if rejected_writer is None:
+                            rejected_writer = RowGroupWriter(rejected_file, rejected.schema, quarantine_settings)
+                        rejected_writer.write_table(rejected)
+            if table.num_rows == 0:
+                continue
+
+            # Running QA totals
+            with metrics.phase("qa"):
+                chunk_null_counts = count_nulls(table)
+                for name, count in chunk_null_counts.items():
+                    stats["null_counts"][name] += count
+                stats["valid_rows"] += count_valid_rows(table, chunk_null_counts)
+                stats["total_rows"] += table.num_rows
+                if collect_samples:
+                    if stats["first_rows"] is None:
+                        stats["first_rows"] = table.slice(0, 5).to_pandas()
+                    stats["last_rows"] = pd.concat(
+                        [stats["last_rows"], table.slice(max(table.num_rows - 5, 0)).to_pandas()]).tail()
+
+            if stats["rollups"] is not None:
+                with metrics.phase("rollup"):
+                    stats["rollups"].add(table)
+            if stats["sketches"] is not None:
+                with metrics.phase("sketch"):
+                    stats["sketches"].add(table)
+
+            # Save cleaned batch
+            if part_file is not None:
+                with metrics.phase("write"):
+                    if writer is None:
+                        writer = RowGroupWriter(part_file)
+                    writer.write_table(table)
+            if sink is not None:
+                with metrics.phase("stream"):
+                    sink(table)
+            metrics.batch(month=month, rows_in=batch.num_rows, rows_out=table.num_rows,
+                          seconds=round(time.perf_counter() - batch_start, 6))
+    finally:
+        if writer is not None:
+            with metrics.phase("write"):
+                writer.close()
+        if rejected_writer is not None:
+            with metrics.phase("quarantine"):
+                rejected_writer.close()
+
+    if part_file is not None and os.path.exists(part_file):
+        metrics.add("bytes_written", os.path.getsize(part_file))
+    if rejected_file is not None and os.path.exists(rejected_file):
+        metrics.add("quarantine_bytes", os.path.getsize(rejected_file))
+    metrics.add("memory_backoffs", governor.backoffs)
+    stats["metrics"] = metrics.summary()
+    return stats
+
+
+# Combine counters from row-group ranges of the same month, in file order
+def merge_stats(stats_list):
+    merged = {
+        "total_rows": sum(stats["total_rows"] for stats in stats_list),
+        "valid_rows": sum(stats["valid_rows"] for stats in stats_list),
+        "invalid_date_rows": sum(stats["invalid_date_rows"] for stats in stats_list),
+        "dropped_rows": sum(stats["dropped_rows"] for stats in stats_list),
+        "reject_reasons": ({reason: sum(stats["reject_reasons"][reason] for stats in stats_list)
+                            for reason in reject_reasons} if engine == "arrow" else None),
+        "null_counts": dict.fromkeys(output_schema.names, 0),
+        "first_rows": None,
+        "last_rows": None,
+        "rollups": RollupBuilder(rules["pickup"], rules["dropoff"]) if build_rollups else None,
+        "sketches": SketchSet(rules["pickup"], rules["dropoff"], rules["identity"]) if build_sketches else None,
+        "earlier_hashes": {} if dedup else None,
+    }
+    for stats in stats_list:
+        for pickup_month, hashes in (stats["earlier_hashes"] or {}).items():
+            merged["earlier_hashes"].setdefault(pickup_month, []).extend(hashes)
+        if merged["rollups"] is not None:
+            merged["rollups"].merge(stats["rollups"])
+        if merged["sketches"] is not None:
+            merged["sketches"].merge(stats["sketches"])
+        for name, count in stats["null_counts"].items():
+            merged["null_counts"][name] += count
+        if merged["first_rows"] is None:
+            merged["first_rows"] = stats["first_rows"]
+        if stats["last_rows"] is not None:
+            merged["last_rows"] = pd.concat(
+                [merged["last_rows"], stats["last_rows"]]).tail()
+    return merged
+
+
+# Concatenate ordered part files into one file, row group by row group; duplicates
+# (a StreamDeduplicator) drops repeated trips on the way, taking them out of stats
+def merge_parts(part_files, merged_file, settings=None, duplicates=None, stats=None):
+    writer = None
+    try:
+        for part_file in part_files:
+            if not os.path.exists(part_file):
+                continue  # Range had no rows after filtering
+            part = pq.ParquetFile(part_file)
+            for i in range(part.num_row_groups):
+                table = part.read_row_group(i)
+                if duplicates is not None:
+                    keep = duplicates.keep_mask(table)
+                    remove_rows(table.filter(pc.invert(keep)), stats)
+                    table = table.filter(keep)
+                if writer is None:
+                    writer = RowGroupWriter(merged_file, part.schema_arrow, settings)
+                if table.num_rows:
+                    writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    return writer is not None
+
+
+# Take rows dropped after counting out of the QA counters, rollups and sketches
+# (distinct counts keep them: HyperLogLog registers cannot be decremented)
+def remove_rows(removed, stats):
+    if not removed.num_rows:
+        return
+    removed_nulls = count_nulls(removed)
+    for name, count in removed_nulls.items():
+        stats["null_counts"][name] -= count
+    stats["valid_rows"] -= count_valid_rows(removed, removed_nulls)
+    if stats["rollups"] is not None:
+        stats["rollups"].remove(removed)
+    if stats["sketches"] is not None:
+        stats["sketches"].remove(removed)
+    stats["total_rows"] -= removed.num_rows
+    stats["dropped_rows"] += removed.num_rows
+
+
+# Replace the month's quarantine file with the run's rejected rows (or drop a stale one)
+def finish_quarantine(month, rejected_tmp):
+    quarantine_file = f"{quarantine_path}/{file_prefix}_{month}_rejected.parquet"
+    if os.path.exists(rejected_tmp):
+        os.replace(rejected_tmp, quarantine_file)
+        logger.info(f"Quarantined rejected rows for {month} in {quarantine_file}")
+    elif os.path.exists(quarantine_file):
+        os.remove(quarantine_file)
+
+
+# QA logging for a finished month, then move the output into place and emit the
+# month's metrics (task summaries folded into month_metrics). With DEDUP, stats
+# carries the rows dropped as repeats within the month in stats["duplicates"]; fused
+# months may have no output file.
+def finish_month(month, tmp_file, output_file, stats, month_metrics):
+    if stats["reject_reasons"] is not None:
+        logger.info(f"Rejected rows by reason in {month}: "
+                    f"{ {reason: rows for reason, rows in stats['reject_reasons'].items() if rows} }")
+    written = os.path.exists(tmp_file)
+    if not written and not stats["total_rows"]:
+        logger.warning(f"No data after filtering for {month}")
+        month_metrics.emit()
+        return
+
+    if dedup:
+        # Resubmitted trips were already rejected as out_of_month; they are counted here
+        with month_metrics.phase("dedup"):
+            resubmitted = count_resubmitted(dataset, {pickup_month: np.concatenate(hashes) for pickup_month, hashes
+                                                      in stats["earlier_hashes"].items()})
+        month_metrics.add("duplicates_within_month", stats["duplicates"])
+        month_metrics.add("duplicates_cross_month", resubmitted)
+        logger.info(f"Duplicates in {month}: {stats['duplicates']} repeated within the month, "
+                    f"{resubmitted} resubmitted from earlier months (rejected as out of month)")
+    if written:
+        os.replace(tmp_file, output_file)
+
+    # QA check
+    total_rows = stats["total_rows"]
+    if any(stats["null_counts"].values()):
+        logger.warning(
+            f"Null values per column in {month}: {stats['null_counts']}")
+    if total_rows != stats["valid_rows"]:
+        logger.warning(
+            f"Data quality issue in {month}: {total_rows - stats['valid_rows']} rows dropped due to nulls")
+
+    # Log sample data (collected only at DEBUG level)
+    if stats["first_rows"] is not None:
+        logger.debug(
+            f"First 5 rows in {month}:\n{stats['first_rows'].to_string()}")
+        logger.debug(
+            f"Last 5 rows in {month}:\n{stats['last_rows'].to_string()}")
+
+    logger.info(
+        f"{f'Saved {output_file}' if written else f'Streamed {month} without a processed file'}, total rows: {total_rows}, clean rows: {total_rows}, dropped rows: {stats['dropped_rows']}, invalid date rows: {stats['invalid_date_rows']}")
+
+    if stats["rollups"] is not None:
+        with month_metrics.phase("rollup_write"):
+            write_rollups(stats["rollups"].result(), rollup_root, dataset, month)
+        logger.info(f"Updated rollups for {month} in {rollup_root}{dataset}")
+
+    if stats["sketches"] is not None:
+        with month_metrics.phase("sketch_write"):
+            previous, changes = record_month(stats["sketches"], dataset, "clean", month)
+        logger.info(f"Stored distribution sketches for {month} in {sketch_root}{dataset}")
+        for name, change in (changes or {}).items():
+            if change["drift"]:
+                logger.warning(f"Distribution drift in {month} since {previous}: {describe_change(name, change)}")
+
+    if partitioned_output:
+        with month_metrics.phase("partition"):
+            target = write_month_partitions(
+                output_file, partitioned_root, dataset, month, rules["pickup"],
+                partitioned_output, partition_row_group_size,
+                writer_settings["compression"], writer_settings["compression_level"])
+        logger.info(f"Wrote {partitioned_output} partitions for {month} to {target}")
+
+    if written:
+        month_metrics.add("output_bytes", os.path.getsize(output_file))
+    if written and not sampling:
+        with month_metrics.phase("upload"):
+            storage.put(output_file)
+    summary = month_metrics.emit()
+    if summary is not None:
+        logger.info(
+            f"Metrics for {month}: {summary['wall_seconds']:.2f}s, {summary['rows_per_second']} rows/s, phases {summary['phases']}")
+
+
+def transform_month(month):
+    input_file = f"{raw_path}/{file_prefix}_{month}.parquet"
+    output_file = f"{processed_path}/{file_prefix}_{month}_cleaned.parquet"
+    tmp_file = f"{output_file}.tmp"
+    rejected_tmp = f"{quarantine_path}/{file_prefix}_{month}_rejected.parquet.tmp"
+
+    try:
+        if not storage.exists(input_file):
             logger.warning(f"{input_file} not found, skipping")
-            continue
-
-        logger.info(f"Transforming {input_file}")
-        chunks = []
-        total_rows = 0
-        invalid_date_rows = 0
-        dropped_rows = 0
-
-        # Process in chunks
-        for batch in pq.read_table(input_file).to_batches(max_chunksize=chunk_size):
-            df_chunk = batch.to_pandas()
-
-            # Convert and filter dates with explicit ns precision
-            df_chunk['tpep_pickup_datetime'] = pd.to_datetime(
-                df_chunk['tpep_pickup_datetime'], errors='coerce', unit='ns')
-            df_chunk['tpep_dropoff_datetime'] = pd.to_datetime(
-                df_chunk['tpep_dropoff_datetime'], errors='coerce', unit='ns')
-            invalid_dates = df_chunk[df_chunk['tpep_pickup_datetime'].isna(
-            ) | df_chunk['tpep_dropoff_datetime'].isna()]
-            if not invalid_dates.empty:
-                logger.warning(
-                    f"Invalid dates in {month}: {len(invalid_dates)} rows")
-                invalid_date_rows += len(invalid_dates)
-            df_chunk = df_chunk.dropna(
-                subset=['tpep_pickup_datetime', 'tpep_dropoff_datetime'])
-            df_chunk = df_chunk[(df_chunk['tpep_pickup_datetime'].dt.year == 2025) &
-                                (df_chunk['tpep_pickup_datetime'].dt.month == int(month.split('-')[1])) &
-                                (df_chunk['tpep_dropoff_datetime'].dt.year == 2025) &
-                                (df_chunk['tpep_dropoff_datetime'].dt.month == int(month.split('-')[1]))]
-
-            # Handle nulls (drop rows with nulls in key fields tied to Flex Fare)
-            df_chunk = df_chunk.dropna(subset=['passenger_count', 'RatecodeID', 'store_and_fwd_flag',
-                                               'congestion_surcharge', 'Airport_fee'])
-
-            # Filter outliers and invalid PULocationID
-            df_chunk = df_chunk[df_chunk["tip_amount"] <= 100]
-            df_chunk = df_chunk[df_chunk["trip_distance"] <= 100]
-            df_chunk = df_chunk[df_chunk["tpep_dropoff_datetime"]
-                                >= df_chunk["tpep_pickup_datetime"]]
-            df_chunk = df_chunk[df_chunk["PULocationID"]
-                                != 265]  # Exclude unknown zone
-
-            # Exclude payment_type 3,4,5 and nulls
-            df_chunk = df_chunk[~df_chunk["payment_type"].isin([3, 4, 5])]
-            df_chunk = df_chunk[df_chunk["payment_type"].notnull()]
-
-            # Join with lookup to add Borough with debugging
-            df_chunk = df_chunk.merge(lookup[["LocationID", "Borough"]], left_on="PULocationID",
-                                      right_on="LocationID", how="left").drop(columns=["LocationID"])
-            unmatched_pu = df_chunk[df_chunk['Borough'].isna(
-            )]['PULocationID'].unique()
-            if len(unmatched_pu) > 0:
-                logger.warning(
-                    f"Unmatched PULocationIDs in {month}: {unmatched_pu.tolist()}")
-                logger.info(
-                    f"Sample rows with unmatched PULocationIDs:\n{df_chunk[df_chunk['PULocationID'].isin(unmatched_pu)].head().to_string()}")
-            unknown_borough_count = df_chunk[df_chunk['Borough'].isna() | (
-                df_chunk['Borough'] == '')].shape[0]
-            if unknown_borough_count > 0:
-                logger.warning(
-                    f"Unknown Borough values in {month}: {unknown_borough_count} rows")
-
-            # Calculate Airport_fee
-            df_chunk['Airport_fee'] = np.where(
-                df_chunk['PULocationID'].isin([1, 132]), 5.0, 0.0)
-
-            # Drop unneeded columns
-            df_chunk = df_chunk.drop(
-                columns=['store_and_fwd_flag', 'mta_tax', 'extra', 'tolls_amount'])
-
-            if not df_chunk.empty:
-                chunks.append(df_chunk)
-                total_rows += len(df_chunk)
-                dropped_rows += len(batch.to_pandas()) - len(df_chunk)
-
-        if chunks:
-            df_final = pd.concat(chunks, ignore_index=True)
-
-            # QA check
-            null_counts = df_final.isnull().sum()
-            if null_counts.any():
-                logger.warning(
-                    f"Null values per column in {month}: {null_counts.to_dict()}")
-            valid_rows = df_final.dropna().shape[0]
-            if total_rows != valid_rows:
-                logger.warning(
-                    f"Data quality issue in {month}: {total_rows - valid_rows} rows dropped due to nulls")
-
-            # Log sample data
-            if not df_final.empty:
-                logger.info(
-                    f"First 5 rows in {month}:\n{df_final.head().to_string()}")
-                logger.info(
-                    f"Last 5 rows in {month}:\n{df_final.tail().to_string()}")
-
-            # Save cleaned data with explicit data types
-            df_final = df_final.astype({
-                "VendorID": "int64",
-                "PULocationID": "int64",
-                "DOLocationID": "int64",
-                "tpep_pickup_datetime": "datetime64[ns]",
-                "tpep_dropoff_datetime": "datetime64[ns]"
-            })
-            df_final.to_parquet(output_file, engine="pyarrow",
-                                index=False, compression="snappy")
-            logger.info(
-                f"Saved {output_file}, total rows: {total_rows}, clean rows: {df_final.shape[0]}, dropped rows: {dropped_rows}, invalid date rows: {invalid_date_rows}")
-        else:
-            logger.warning(f"No data after filtering for {month}")
+            return
+
+        logger.info(f"Transforming {input_file} with {engine} engine ({output_profile} profile)")
+        month_metrics = StageMetrics("transform", dataset=dataset, month=month)
+        with month_metrics.phase("fetch"):
+            local_input = fetch_input(input_file)
+        if fused_load:
+            stream_month(month, local_input, output_file, tmp_file, rejected_tmp, month_metrics)
+            return
+        duplicates = StreamDeduplicator(dataset, month, rules["identity"]) if dedup else None
+        try:
+            stats = transform_row_groups(month, local_input, None, tmp_file,
+                                         rejected_tmp if quarantine else None, duplicates=duplicates)
+            if duplicates is not None:
+                stats["duplicates"] = duplicates.finish()
+        except Exception:
+            if duplicates is not None:
+                duplicates.abort()
+            raise
+        month_metrics.merge(stats["metrics"])
+        if quarantine:
+            finish_quarantine(month, rejected_tmp)
+        finish_month(month, tmp_file, output_file, stats, month_metrics)
 
     except Exception as e:
         logger.error(f"Error transforming {input_file}: {e}", exc_info=True)
+    finally:
+        for leftover in (tmp_file, rejected_tmp):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+# Fused mode: clean the month while a loader thread inserts every cleaned batch into
+# the warehouse, deduplicating as batches stream by. The month's load commits once the
+# transform has finished, and only then is the processed file (when persisted) put in
+# place and the load recorded in the manifest, so a failed load publishes nothing.
+def stream_month(month, local_input, output_file, tmp_file, rejected_tmp, month_metrics):
+    stream = MonthStream(month)
+    duplicates = StreamDeduplicator(dataset, month, rules["identity"]) if dedup else None
+    try:
+        stats = transform_row_groups(month, local_input, None, tmp_file if persist_processed else None,
+                                     rejected_tmp if quarantine else None, sink=stream.put, duplicates=duplicates)
+        month_metrics.merge(stats["metrics"])
+        if duplicates is not None:
+            stats["duplicates"] = duplicates.finish()
+    except Exception:
+        if duplicates is not None:
+            duplicates.abort()
+        try:
+            stream.finish(commit=False)
+        except Exception as e:
+            logger.error(f"Loader for {month} failed: {e}")
+        raise
+    stream.finish()
+    if quarantine:
+        finish_quarantine(month, rejected_tmp)
+    finish_month(month, tmp_file, output_file, stats, month_metrics)
+    stream.record(fingerprint=storage.fingerprint(output_file) if persist_processed else None)
+
+
+# Whole-month totals of a sampled month's counters, from one stats dict per sampled row group
+def log_sample_estimates(month, metadata, row_groups, stats_list, month_metrics):
+    counters = ["total_rows", "dropped_rows", "invalid_date_rows", "reject_reasons", "null_counts"]
+    estimates = estimate_totals(metadata, row_groups, [flatten({name: stats[name] for name in counters})
+                                                       for stats in stats_list], rules["pickup"], month)
+    sample = sample_summary(metadata, row_groups, estimates)
+    month_metrics.add("rows_estimated", round(estimates["total_rows"][0]) if "total_rows" in estimates else 0)
+    logger.info(f"Sampled {len(row_groups)} of {metadata.num_row_groups} row groups for {month} "
+                f"({sample['rows_read']} of {sample['rows_total']} rows); estimates for the whole month:")
+    for name, (estimate, _, _) in estimates.items():
+        if estimate or name in ("total_rows", "dropped_rows"):
+            logger.info(f"  {name}: {describe(round(estimate), sample, name)}")
+
+
+# Process pool mode: every (month, row-group range) is a task writing an ordered
+# part file; the parent merges parts per month and aggregates the counters. With
+# SAMPLE_FRACTION every sampled row group is its own task.
+def transform_months_parallel(months):
+    tasks = {}
+    submitted = []
+    # Pool size and each task's share of the memory budget, planned for the widest month
+    inputs = [f"{raw_path}/{file_prefix}_{month}.parquet" for month in months]
+    footers = [storage.metadata(input_file) for input_file in inputs if storage.exists(input_file)]
+    governor = transform_governor(
+        max((row_bytes(metadata, input_columns(metadata.schema.to_arrow_schema().names)) for metadata in footers),
+            default=1.0), max_workers=workers, processes=True)
+    logger.info(f"Process pool: {governor.describe()}")
+    with ProcessPoolExecutor(max_workers=governor.workers) as executor:
+        for month in months:
+            input_file = f"{raw_path}/{file_prefix}_{month}.parquet"
+            output_file = f"{processed_path}/{file_prefix}_{month}_cleaned.parquet"
+            if not storage.exists(input_file):
+                logger.warning(f"{input_file} not found, skipping")
+                continue
+
+            month_metrics = StageMetrics("transform", dataset=dataset, month=month)
+            with month_metrics.phase("fetch"):
+                metadata = storage.metadata(input_file)
+                sampled = select_row_groups(metadata, rules["pickup"], month) if sampling else None
+                local_input = fetch_input(input_file, sampled)
+            num_row_groups = metadata.num_row_groups
+            if sampling:
+                ranges = [[i] for i in sampled]
+                logger.info(f"Transforming {input_file} with {engine} engine: {len(sampled)} of {num_row_groups} "
+                            f"sampled row groups (SAMPLE_FRACTION={sample_fraction}) across {governor.workers} workers")
+            else:
+                ranges = [list(range(start, min(start + row_groups_per_task, num_row_groups)))
+                          for start in range(0, num_row_groups, row_groups_per_task)]
+                logger.info(
+                    f"Transforming {input_file} with {engine} engine: {num_row_groups} row groups across {governor.workers} workers")
+            part_files = []
+            rejected_parts = []
+            futures = []
+            for part, row_groups in enumerate(ranges):
+                part_file = f"{output_file}.part-{part:05d}"
+                rejected_part = f"{quarantine_path}/{file_prefix}_{month}_rejected.part-{part:05d}"
+                part_files.append(part_file)
+                rejected_parts.append(rejected_part)
+                governor.admit(submitted)  # Fewer tasks in flight while memory is tight
+                futures.append(executor.submit(
+                    transform_row_groups, month, local_input, row_groups, part_file,
+                    rejected_part if quarantine else None, budget=governor.share()))
+                submitted.append(futures[-1])
+            tasks[month] = (input_file, output_file, part_files, rejected_parts, futures, month_metrics,
+                            metadata, sampled)
+
+        for month, (input_file, output_file, part_files, rejected_parts, futures, month_metrics,
+                    metadata, sampled) in tasks.items():
+            tmp_file = f"{output_file}.tmp"
+            rejected_tmp = f"{quarantine_path}/{file_prefix}_{month}_rejected.parquet.tmp"
+            try:
+                stats_list = [future.result() for future in futures]
+                for task_stats in stats_list:
+                    month_metrics.merge(task_stats["metrics"])
+                stats = merge_stats(stats_list)
+                if sampling:
+                    log_sample_estimates(month, metadata, sampled, stats_list, month_metrics)
+                duplicates = StreamDeduplicator(dataset, month, rules["identity"]) if dedup else None
+                try:
+                    with month_metrics.phase("merge"):
+                        merge_parts(part_files, tmp_file, duplicates=duplicates, stats=stats)
+                    if duplicates is not None:
+                        stats["duplicates"] = duplicates.finish()
+                except Exception:
+                    if duplicates is not None:
+                        duplicates.abort()
+                    raise
+                if quarantine:
+                    with month_metrics.phase("quarantine"):
+                        merge_parts(rejected_parts, rejected_tmp, quarantine_settings)
+                    finish_quarantine(month, rejected_tmp)
+                finish_month(month, tmp_file, output_file, stats, month_metrics)
+            except Exception as e:
+                logger.error(
+                    f"Error transforming {input_file}: {e}", exc_info=True)
+            finally:
+                for leftover in part_files + rejected_parts + [tmp_file, rejected_tmp]:
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+
+
+if __name__ == "__main__":
+    if (workers > 1 and not fused_load) or sampling:
+        transform_months_parallel(months)
+    else:
+        for month in months:
+            transform_month(month)
 
-logger.removeHandler(file_handler)
-file_handler.close()
+    logger.removeHandler(file_handler)
+    file_handler.close()
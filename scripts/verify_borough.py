@@ -1,21 +1,34 @@
 import pandas as pd
+import pyarrow.compute as pc
+import os
+from rollups import read_rollup, rollup_root
+from zone_index import ZoneIndex
+from query import query
 
-# For January
-df = pd.read_parquet(
-    "data/processed/2025/yellow/yellow_tripdata_2025-01_cleaned.parquet")
-print("January Borough Counts:")
-print(df['Borough'].value_counts())
-print("\n")
+lookup_path = "data/raw/2025/lookup/taxi_zone_lookup.csv"
+months = os.getenv("TLC_MONTHS", "2025-01,2025-02,2025-03").split(",")
+zones = ZoneIndex.load(lookup_path)
 
-# For February
-df = pd.read_parquet(
-    "data/processed/2025/yellow/yellow_tripdata_2025-02_cleaned.parquet")
-print("February Borough Counts:")
-print(df['Borough'].value_counts())
-print("\n")
 
-# For March
-df = pd.read_parquet(
-    "data/processed/2025/yellow/yellow_tripdata_2025-03_cleaned.parquet")
-print("March Borough Counts:")
-print(df['Borough'].value_counts())
+# Borough trip counts from the hourly_zone rollup; falls back to a Borough group-by
+# over the processed file when the month has no rollup yet
+def borough_counts(month):
+    if not os.path.exists(os.path.join(rollup_root, "yellow", "hourly_zone", f"{month}.parquet")):
+        counts = query("yellow", months=[month], filter=pc.is_valid(pc.field("Borough")),
+                       group_by=["Borough"], aggregations=[(None, "count_all")])
+        return pd.Series(counts.column("count_all").to_numpy(),
+                         index=pd.Index(counts.column("Borough").to_pandas().astype(object), name="Borough"),
+                         name="count").sort_values(ascending=False, kind="stable")
+    by_zone = read_rollup("hourly_zone", months=[month]).group_by(
+        "PULocationID").aggregate([("trips", "sum")])
+    borough = zones.gather(by_zone.column("PULocationID"), "Borough")
+    counts = pd.Series(by_zone.column("trips_sum").to_numpy(),
+                       index=pd.Index(borough.to_pandas().astype(object), name="Borough"))
+    return counts.groupby(level=0).sum().sort_values(ascending=False).rename("count")
+
+
+for i, month in enumerate(months):
+    if i:
+        print("\n")
+    print(f"{pd.Timestamp(month).month_name()} Borough Counts:")
+    print(borough_counts(month))
@@ -0,0 +1,61 @@
+import pyarrow.parquet as pq
+import os
+import logging
+from transform_yellow import raw_path, months, clean_batch_pandas, clean_batch_arrow
+from memory_budget import default_batch_rows
+
+# Configuration
+log_path = "logs/yellow/"
+
+# Create log directory
+os.makedirs(log_path, exist_ok=True)
+
+# Configure logger (transform_yellow already attached its own handler on import)
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+log_file = os.path.join(log_path, "verify_engine_parity.log")
+file_handler = logging.FileHandler(log_file)
+file_handler.setFormatter(logging.Formatter(
+    "%(asctime)s - %(levelname)s - %(message)s"))
+logger.addHandler(file_handler)
+
+# Run both transform engines on the same raw batches and compare the results
+for month in months:
+    input_file = f"{raw_path}/yellow_tripdata_{month}.parquet"
+
+    try:
+        if not os.path.exists(input_file):
+            logger.warning(f"{input_file} not found, skipping")
+            continue
+
+        logger.info(f"Comparing pandas and arrow engines on {input_file}")
+        mismatched_batches = 0
+        pandas_rows = 0
+        arrow_rows = 0
+        for i, batch in enumerate(pq.ParquetFile(input_file).iter_batches(batch_size=default_batch_rows)):
+            pandas_table, pandas_invalid, _ = clean_batch_pandas(batch, month)
+            arrow_table, arrow_invalid, _ = clean_batch_arrow(batch, month)
+            pandas_rows += pandas_table.num_rows
+            arrow_rows += arrow_table.num_rows
+            if not pandas_table.equals(arrow_table) or pandas_invalid != arrow_invalid:
+                mismatched_batches += 1
+                logger.warning(
+                    f"Batch {i} differs in {month}: pandas {pandas_table.num_rows} rows "
+                    f"({pandas_invalid} invalid dates), arrow {arrow_table.num_rows} rows "
+                    f"({arrow_invalid} invalid dates)")
+
+        if mismatched_batches:
+            logger.error(
+                f"Engine parity failed for {month}: {mismatched_batches} batches differ")
+        else:
+            logger.info(
+                f"Engine parity OK for {month}: pandas {pandas_rows} rows, arrow {arrow_rows} rows")
+
+    except Exception as e:
+        logger.error(f"Error comparing engines on {input_file}: {e}", exc_info=True)
+
+    finally:
+        print(f"Parity check completed for {month}")
+
+logger.removeHandler(file_handler)
+file_handler.close()
@@ -0,0 +1,167 @@
+import os
+import sys
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import extract
+import storage
+
+# Configuration: serves synthetic Parquet files from a local http.server that honours
+# Range and If-Range like the TLC CloudFront origin, so no network is needed
+log_path = "logs/extract/"
+dataset = "yellow"
+month = "2025-01"
+rows = 200_000
+
+# Create log directory
+os.makedirs(log_path, exist_ok=True)
+
+# Configure logger
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+log_file = os.path.join(log_path, "verify_extract.log")
+file_handler = logging.FileHandler(log_file)
+file_handler.setFormatter(logging.Formatter(
+    "%(asctime)s - %(levelname)s - %(message)s"))
+logger.addHandler(file_handler)
+
+failures = []
+
+
+def check(name, ok):
+    if ok:
+        logger.info(f"{name}: OK")
+    else:
+        logger.error(f"{name}: FAILED")
+        failures.append(name)
+
+
+# Files served by path, and the (method, Range, status) of every request
+served = {}
+requests = []
+
+
+class TLCHandler(BaseHTTPRequestHandler):
+    def send_file(self, body):
+        path = self.path.rsplit("/", 1)[-1]
+        if path not in served:
+            self.send_error(404)
+            requests.append((self.command, None, 404))
+            return
+        content = served[path]
+        etag = f'"{hashlib.md5(content).hexdigest()}"'
+        byte_range = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        start = 0
+        if byte_range and (if_range is None or if_range == etag):
+            start = int(byte_range.split("=")[1].split("-")[0])
+        status = 206 if start else 200
+        requests.append((self.command, byte_range, status))
+        self.send_response(status)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(content) - start))
+        if start:
+            self.send_header("Content-Range", f"bytes {start}-{len(content) - 1}/{len(content)}")
+        self.end_headers()
+        if body:
+            self.wfile.write(content[start:])
+
+    def do_HEAD(self):
+        self.send_file(body=False)
+
+    def do_GET(self):
+        self.send_file(body=True)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def sample_file(seed):
+    rng = np.random.default_rng(seed)
+    table = pa.table({name: rng.random(rows) for name in ("fare_amount", "tip_amount", "trip_distance")})
+    sink = pa.BufferOutputStream()
+    pq.write_table(table, sink, row_group_size=rows // 4, compression="none")
+    return sink.getvalue().to_pybytes()
+
+
+def run_checks(workdir, base_url):
+    os.chdir(workdir)  # extract writes under the relative data/raw/ path
+    extract.base_url = base_url
+    extract.storage = storage.LocalStorage()
+    extract.retries = 1
+    file_name = f"{extract.file_prefixes[dataset]}_{month}.parquet"
+    output_file = os.path.join(extract.raw_path, month.split("-")[0], dataset, file_name)
+    part_file = f"{output_file}.part"
+    content = served[file_name] = sample_file(seed=1)
+
+    # Fresh download: validated and published, no partial file left behind
+    check("download", extract.fetch(dataset, month) == "downloaded")
+    with open(output_file, "rb") as f:
+        check("download complete", f.read() == content)
+    check("part file removed", not os.path.exists(part_file))
+
+    # Unchanged size and ETag: skipped after a HEAD, without a GET
+    requests.clear()
+    check("unchanged skipped", extract.fetch(dataset, month) == "skipped")
+    check("skip without GET", [method for method, _, _ in requests] == ["HEAD"])
+
+    # Interrupted download: the truncated .part file resumes with Range/If-Range
+    os.remove(output_file)
+    os.remove(f"{output_file}.meta.json")
+    half = len(content) // 2
+    with open(part_file, "wb") as f:
+        f.write(content[:half])
+    extract.write_meta(f"{part_file}.meta.json", {"size": len(content), "etag": extract.head(
+        f"{base_url}/{file_name}")[1]})
+    requests.clear()
+    check("resume", extract.fetch(dataset, month) == "downloaded")
+    check("resume ranged GET", ("GET", f"bytes={half}-", 206) in requests)
+    with open(output_file, "rb") as f:
+        check("resumed file complete", f.read() == content)
+
+    # A part file of an older remote version (other ETag) starts over
+    with open(part_file, "wb") as f:
+        f.write(content[:half])
+    extract.write_meta(f"{part_file}.meta.json", {"size": len(content), "etag": '"stale"'})
+    content = served[file_name] = sample_file(seed=2)
+    requests.clear()
+    check("changed file downloaded", extract.fetch(dataset, month) == "downloaded")
+    check("stale part not resumed", ("GET", None, 200) in requests)
+    with open(output_file, "rb") as f:
+        check("changed file complete", f.read() == content)
+
+    # Corrupt footer: rejected, not published, and the part file is not kept to resume
+    served[file_name] = content[:-8] + b"\x00" * 8
+    check("corrupt footer rejected", extract.fetch(dataset, month) == "failed")
+    with open(output_file, "rb") as f:
+        check("corrupt file not published", f.read() == content)
+    check("corrupt part file removed", not os.path.exists(part_file))
+
+    # Months not published yet
+    check("missing file", extract.fetch(dataset, "2025-12") == "missing")
+
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), TLCHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+workdir = tempfile.mkdtemp()
+cwd = os.getcwd()
+try:
+    run_checks(workdir, f"http://127.0.0.1:{server.server_address[1]}/trip-data")
+except Exception as e:
+    logger.error(f"Extract checks failed: {e}", exc_info=True)
+    failures.append("error")
+finally:
+    server.shutdown()
+    os.chdir(cwd)
+    shutil.rmtree(workdir)
+    logger.removeHandler(file_handler)
+    file_handler.close()
+
+print(f"Extract checks completed: {len(failures)} failed")
+sys.exit(1 if failures else 0)
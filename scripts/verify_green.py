@@ -1,14 +1,20 @@
-import pyarrow.parquet as pq
 import pandas as pd
 import os
 import logging
+from dq_scanner import dataset_checks, needed_columns, scan_file, write_report
+from zone_index import ZoneIndex
+from metrics import StageMetrics
+from sampling import describe, sample_fraction, sampling_enabled, select_row_groups
+from sketches import SketchSet, build_sketches, describe_change, record_month
+from storage import open_storage
 
 # Configuration for local processing
 data_path = "data/raw/2025/green/"
 lookup_path = "data/raw/2025/lookup/taxi_zone_lookup.csv"
 log_path = "logs/green/"
 dataset = "green"
-months = ["2025-01", "2025-02", "2025-03"]
+months = os.getenv("TLC_MONTHS", "2025-01,2025-02,2025-03").split(",")
+storage = open_storage()  # Raw files are read through the storage layer (STORAGE_URL)
 
 # Expected columns for Green (removed Airport_fee based on log)
 expected_columns = [
@@ -22,12 +28,13 @@ os.makedirs(log_path, exist_ok=True)
 
 # Configure logger
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
 
 # Load taxi zone lookup
 try:
     lookup = pd.read_csv(lookup_path)
     logger.info(f"Taxi zone lookup loaded: {lookup.columns.tolist()}")
+    zones = ZoneIndex(lookup)
 except Exception as e:
     logger.error(f"Failed to load {lookup_path}: {e}", exc_info=True)
     exit()
@@ -42,14 +49,38 @@ for month in months:
 
     file_path = f"{data_path}/{dataset}_tripdata_{month}.parquet"
     try:
-        if not os.path.exists(file_path):
+        if not storage.exists(file_path):
             logger.warning(f"{file_path}: Not found")
             raise Exception(f"{file_path} missing")
 
         logger.info(f"Processing {file_path}")
-        table = pq.read_table(file_path)
-        columns = table.column_names
-        logger.info(f"{file_path}: {table.num_rows} rows")
+        metrics = StageMetrics("verify_green", dataset=dataset, month=month)
+        with metrics.phase("fetch"):
+            metadata = storage.metadata(file_path)
+            available = metadata.schema.to_arrow_schema().names
+            row_groups = None
+            if sampling_enabled():
+                row_groups = select_row_groups(metadata, dataset_checks[dataset]["pickup"], month)
+                logger.info(f"Sampling {len(row_groups)} of {metadata.num_row_groups} row groups "
+                            f"(SAMPLE_FRACTION={sample_fraction})")
+            local_file = storage.fetch(file_path, needed_columns(dataset_checks[dataset], available), row_groups)
+        sketches = None
+        if build_sketches and row_groups is None:
+            sketches = SketchSet(dataset_checks[dataset]["pickup"], dataset_checks[dataset]["dropoff"])
+        report = scan_file(local_file, dataset_checks[dataset], zones, metrics=metrics,
+                           row_groups=row_groups, month=month, sketches=sketches)
+        sample = report.get("sample")
+        if sketches is not None:
+            with metrics.phase("sketch_write"):
+                previous, changes = record_month(sketches, dataset, "raw", month)
+            for name, change in (changes or {}).items():
+                if change["drift"]:
+                    logger.warning(f"Distribution drift since {previous}: {describe_change(name, change)}")
+        metrics.emit()
+        write_report(report, os.path.join(
+            log_path, f"dq_{dataset}_{month}.json"))
+        columns = report["columns"]
+        logger.info(f"{file_path}: {report['rows']} rows")
         logger.info(f"Columns: {columns}")
 
         missing_cols = [col for col in expected_columns if col not in columns]
@@ -58,118 +89,89 @@ for month in months:
         else:
             logger.info("All expected columns present")
 
-        select_cols = [
-            "PULocationID", "tip_amount", "payment_type",
-            "lpep_pickup_datetime", "trip_distance", "lpep_dropoff_datetime",
-            "fare_amount"
-        ]
-        select_cols = [col for col in select_cols if col in columns]
-        if not select_cols:
+        if not report["null_counts"]:
             logger.error("No columns available")
             raise Exception("No columns available")
 
-        df = pq.read_table(file_path, columns=select_cols).to_pandas()
-
-        if "PULocationID" in df.columns:
-            null_pu = df["PULocationID"].isnull().sum()
-            invalid_pu = len(df[~df["PULocationID"].isin(range(1, 266))])
-            logger.info(f"Null PULocationID: {null_pu}")
-            logger.info(f"Invalid PULocationID (not in 1-265): {invalid_pu}")
+        if "PULocationID" in report["null_counts"]:
+            logger.info(
+                f"Null PULocationID: {describe(report['null_counts']['PULocationID'], sample, 'null_counts.PULocationID')}")
+            logger.info(
+                f"Invalid PULocationID (not in 1-265): {describe(report['invalid_pu_location'], sample, 'invalid_pu_location')}")
 
-        for col in select_cols:
+        for col, null_count in report["null_counts"].items():
             if col != "PULocationID":
-                null_count = df[col].isnull().sum()
-                logger.info(f"Null {col}: {null_count}")
+                logger.info(f"Null {col}: {describe(null_count, sample, f'null_counts.{col}')}")
 
-        if "tip_amount" in df.columns:
-            high_tip = len(df[df["tip_amount"] > 100])
-            logger.info(f"tip_amount > $100: {high_tip}")
+        samples = report["samples"]
+        if "tip_amount" in report["above_threshold"]:
+            high_tip = report["above_threshold"]["tip_amount"]
+            logger.info(f"tip_amount > $100: {describe(high_tip, sample, 'above_threshold.tip_amount')}")
             if high_tip > 0:
-                sample_tips = df[df["tip_amount"] > 100][[
-                    "tip_amount", "payment_type", "PULocationID", "trip_distance"]].head(2)
                 logger.info(
-                    f"Sample rows with tip_amount > $100:\n{sample_tips.to_string(index=False)}")
+                    f"Sample rows with tip_amount > $100:\n{pd.DataFrame(samples['tip_amount_above_threshold']).to_string(index=False)}")
 
-        if "trip_distance" in df.columns:
-            high_distance = len(df[df["trip_distance"] > 100])
-            logger.info(f"trip_distance > 100 miles: {high_distance}")
+        if "trip_distance" in report["above_threshold"]:
+            high_distance = report["above_threshold"]["trip_distance"]
+            logger.info(
+                f"trip_distance > 100 miles: {describe(high_distance, sample, 'above_threshold.trip_distance')}")
             if high_distance > 0:
-                sample_distance = df[df["trip_distance"] > 100][[
-                    "trip_distance", "PULocationID", "lpep_pickup_datetime"]].head(2)
                 logger.info(
-                    f"Sample rows with trip_distance > 100 miles:\n{sample_distance.to_string(index=False)}")
-
-        if "lpep_pickup_datetime" in df.columns and "lpep_dropoff_datetime" in df.columns:
-            df["trip_duration"] = (
-                pd.to_datetime(df["lpep_dropoff_datetime"]) -
-                pd.to_datetime(df["lpep_pickup_datetime"])
-            ).dt.total_seconds() / 60
-            neg_duration = len(df[df["trip_duration"] < 0])
-            logger.info(f"Negative trip durations (minutes): {neg_duration}")
+                    f"Sample rows with trip_distance > 100 miles:\n{pd.DataFrame(samples['trip_distance_above_threshold']).to_string(index=False)}")
+
+        if "lpep_pickup_datetime" in columns and "lpep_dropoff_datetime" in columns:
+            neg_duration = report["negative_duration"]
+            logger.info(
+                f"Negative trip durations (minutes): {describe(neg_duration, sample, 'negative_duration')}")
             if neg_duration > 0:
-                sample_neg = df[df["trip_duration"] < 0][[
-                    "lpep_pickup_datetime", "lpep_dropoff_datetime", "PULocationID"]].head(2)
                 logger.info(
-                    f"Sample rows with negative trip durations:\n{sample_neg.to_string(index=False)}")
+                    f"Sample rows with negative trip durations:\n{pd.DataFrame(samples['negative_duration']).to_string(index=False)}")
 
-        if "payment_type" in df.columns:
-            payment_dist = df["payment_type"].value_counts().to_string()
+        if "payment_type" in columns:
+            payment_dist = pd.Series(report["payment_type_counts"]).rename_axis(
+                "payment_type").sort_values(ascending=False).to_string()
             logger.info(
                 f"Payment type distribution (0=Flex Fare, 1=Credit, 2=Cash, 3=No charge, 4=Dispute, 5=Unknown, 6=Voided):\n{payment_dist}")
 
-        if "tip_amount" in df.columns and "payment_type" in df.columns:
-            zero_tips_credit = len(
-                df[(df["payment_type"] == 1) & (df["tip_amount"] == 0)])
-            zero_tips_cash = len(
-                df[(df["payment_type"] == 2) & (df["tip_amount"] == 0)])
+        if "tip_amount" in columns and "payment_type" in columns and "PULocationID" in columns:
             logger.info(
-                f"tip_amount == 0 for payment_type=1 (credit): {zero_tips_credit}")
+                f"tip_amount == 0 for payment_type=1 (credit): {describe(report['zero_tips']['credit'], sample, 'zero_tips.credit')}")
             logger.info(
-                f"tip_amount == 0 for payment_type=2 (cash): {zero_tips_cash}")
-
-            pt0_tips = df[df["payment_type"] == 0]["tip_amount"].agg(
-                ["mean", "sum", "count"]).round(2)
+                f"tip_amount == 0 for payment_type=2 (cash): {describe(report['zero_tips']['cash'], sample, 'zero_tips.cash')}")
+
+            flex = report["flex_fare_tips"]
+            pt0_tips = pd.Series({
+                "mean": flex["sum"] / flex["count"] if flex["count"] else float("nan"),
+                "sum": flex["sum"],
+                "count": flex["count"],
+            }).round(2)
             logger.info(
                 f"tip_amount stats for payment_type=0 (Flex Fare):\n{pt0_tips.to_string()}")
 
-        if "tip_amount" in df.columns and "PULocationID" in df.columns and "payment_type" in df.columns:
-            df_tips = df[df["payment_type"].isin(
-                [1, 2])][["PULocationID", "tip_amount"]].copy()
-            df_with_borough = df_tips.merge(
-                lookup[["LocationID", "Borough"]],
-                left_on="PULocationID",
-                right_on="LocationID",
-                how="left"
-            )
-            tip_stats = df_with_borough.groupby("Borough")["tip_amount"].agg(
-                ["mean", "sum", "count"]
-            ).round(2)
+            borough_tips = pd.DataFrame.from_dict(
+                report["borough_tips"], orient="index").sort_index()
+            borough_tips.index.name = "Borough"
+            tip_stats = pd.DataFrame({
+                "mean": borough_tips["tip_amount_sum"] / borough_tips["tip_amount_count"],
+                "sum": borough_tips["tip_amount_sum"],
+                "count": borough_tips["tip_amount_count"],
+            }).round(2)
             logger.info(
                 f"Tip analysis by borough (credit and cash):\n{tip_stats.to_string()}")
 
-            unknown_ids = df_with_borough[df_with_borough["Borough"].isna(
-            )]["PULocationID"].unique().tolist()
+            unknown_ids = report["unknown_borough_location_ids"]
             if unknown_ids:
                 logger.info(f"Unknown borough PULocationIDs: {unknown_ids}")
             else:
                 logger.info("No Unknown borough PULocationIDs found")
 
-        if "tip_amount" in df.columns and "fare_amount" in df.columns and "PULocationID" in df.columns and "payment_type" in df.columns:
-            df_tips = df[df["payment_type"].isin(
-                [1, 2])][["PULocationID", "tip_amount", "fare_amount"]].copy()
-            df_tips["tip_percentage"] = (
-                df_tips["tip_amount"] / df_tips["fare_amount"].where(df_tips["fare_amount"] > 0)) * 100
-            df_with_borough = df_tips.merge(
-                lookup[["LocationID", "Borough"]],
-                left_on="PULocationID",
-                right_on="LocationID",
-                how="left"
-            )
-            tip_pct_stats = df_with_borough.groupby("Borough")["tip_percentage"].agg(
-                ["mean", "count"]
-            ).round(2)
-            logger.info(
-                f"Tip percentage by borough (credit and cash):\n{tip_pct_stats.to_string()}")
+            if "fare_amount" in columns:
+                tip_pct_stats = pd.DataFrame({
+                    "mean": borough_tips["tip_percentage_sum"] / borough_tips["tip_percentage_count"],
+                    "count": borough_tips["tip_percentage_count"],
+                }).round(2)
+                logger.info(
+                    f"Tip percentage by borough (credit and cash):\n{tip_pct_stats.to_string()}")
 
     except Exception as e:
         logger.error(f"Error processing {file_path}: {e}", exc_info=True)
@@ -1,12 +1,17 @@
 import pandas as pd
-import pyarrow.parquet as pq
 import os
 import logging
+from parquet_metadata import footer_profile, fill_missing_stats, missing_stats_columns
+from metrics import StageMetrics
+from storage import open_storage
 
 # Configuration
 processed_path = "data/processed/2025/yellow/"
 log_path = "logs/yellow/"
-months = ["2025-01", "2025-02", "2025-03"]
+months = os.getenv("TLC_MONTHS", "2025-01,2025-02,2025-03").split(",")
+verify_mode = os.getenv("VERIFY_MODE", "metadata")  # "metadata" (footer statistics) or "full"
+output_profile = os.getenv("OUTPUT_PROFILE", "standard")  # Expected schema: "standard" or "compact"
+storage = open_storage()  # Processed files are read through the storage layer (STORAGE_URL)
 
 # Expected columns after transformation
 expected_columns = [
@@ -16,80 +21,186 @@ expected_columns = [
     "congestion_surcharge", "Airport_fee", "cbd_congestion_fee", "Borough"
 ]
 
+# Expected data types after transformation
+expected_dtypes = {
+    "VendorID": "int64",
+    "tpep_pickup_datetime": "datetime64[ns]",
+    "tpep_dropoff_datetime": "datetime64[ns]",
+    "passenger_count": "float64",
+    "trip_distance": "float64",
+    "RatecodeID": "float64",
+    "PULocationID": "int64",
+    "DOLocationID": "int64",
+    "payment_type": "int64",
+    "fare_amount": "float64",
+    "tip_amount": "float64",
+    "improvement_surcharge": "float64",
+    "total_amount": "float64",
+    "congestion_surcharge": "float64",
+    "Airport_fee": "float64",
+    "cbd_congestion_fee": "float64",
+    "Borough": "object"
+}
+
+# Compact output profile: narrow codes and IDs, float32 amounts, microsecond
+# timestamps and a categorical Borough
+compact_dtypes = {
+    "VendorID": "int8",
+    "tpep_pickup_datetime": "datetime64[us]",
+    "tpep_dropoff_datetime": "datetime64[us]",
+    "passenger_count": "float32",
+    "trip_distance": "float32",
+    "RatecodeID": "int8",
+    "PULocationID": "int16",
+    "DOLocationID": "int16",
+    "payment_type": "int8",
+    "fare_amount": "float32",
+    "tip_amount": "float32",
+    "improvement_surcharge": "float32",
+    "total_amount": "float32",
+    "congestion_surcharge": "float32",
+    "Airport_fee": "float32",
+    "cbd_congestion_fee": "float32",
+    "Borough": "category"
+}
+if output_profile == "compact":
+    expected_dtypes = compact_dtypes
+
+# Upper bounds checked against column maxima (cleaning caps tip and distance at 100)
+range_limits = {
+    "trip_distance": 100,
+    "tip_amount": 100,
+    "fare_amount": 1000,
+}
+
 # Create log directory
 os.makedirs(log_path, exist_ok=True)
 
 # Configure logger
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
 log_file = os.path.join(log_path, "verify_processed.log")
 file_handler = logging.FileHandler(log_file)
 file_handler.setFormatter(logging.Formatter(
     "%(asctime)s - %(levelname)s - %(message)s"))
 logger.addHandler(file_handler)
 
-for month in months:
-    input_file = f"{processed_path}/yellow_tripdata_{month}_cleaned.parquet"
+def check_dtypes(dtypes):
+    dtype_mismatch = {}
+    for col, exp_dtype in expected_dtypes.items():
+        if col in dtypes.index and str(dtypes[col]) != exp_dtype:
+            dtype_mismatch[col] = {
+                "expected": exp_dtype, "actual": str(dtypes[col])}
+    if dtype_mismatch:
+        logger.warning(f"Data type mismatches: {dtype_mismatch}")
+    else:
+        logger.info("All data types match expected")
+
+
+# Full verification: read the whole file into pandas
+def verify_full(month, input_file, metrics):
+    df = pd.read_parquet(storage.fetch(input_file))
+
+    # Check row count
+    row_count = len(df)
+    metrics.add("rows_in", row_count)
+    logger.info(f"Rows in {month}: {row_count}")
+
+    # Check columns
+    columns = df.columns.tolist()
+    missing_cols = [col for col in expected_columns if col not in columns]
+    if missing_cols:
+        logger.warning(f"Missing columns: {missing_cols}")
+    else:
+        logger.info("All expected columns present")
+
+    # Check data types
+    check_dtypes(df.dtypes)
+
+    # Check for nulls
+    null_counts = df.isnull().sum()
+    if null_counts.any():
+        logger.warning(f"Null values per column: {null_counts.to_dict()}")
+    else:
+        logger.info("No null values found")
+
+    # Log sample (DEBUG only)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"First 5 rows in {month}:\n{df.head().to_string()}")
 
-    try:
-        if not os.path.exists(input_file):
-            logger.warning(f"{input_file} not found, skipping")
-            continue
 
-        logger.info(f"Verifying {input_file}")
-        df = pd.read_parquet(input_file)
+# Metadata verification: answer schema, row-count, null and range checks from the
+# Parquet footer, reading single columns only where statistics are missing
+def verify_metadata(month, input_file, metrics):
+    local_file = storage.fetch(input_file, columns=[])
+    profile = footer_profile(local_file)
 
-        # Check row count
-        row_count = len(df)
-        logger.info(f"Rows in {month}: {row_count}")
+    # Check row count
+    metrics.add("rows_in", profile["num_rows"])
+    logger.info(f"Rows in {month}: {profile['num_rows']}")
 
-        # Check columns
-        columns = df.columns.tolist()
-        missing_cols = [col for col in expected_columns if col not in columns]
-        if missing_cols:
-            logger.warning(f"Missing columns: {missing_cols}")
+    # Check columns
+    columns = profile["schema"].names
+    missing_cols = [col for col in expected_columns if col not in columns]
+    if missing_cols:
+        logger.warning(f"Missing columns: {missing_cols}")
+    else:
+        logger.info("All expected columns present")
+
+    # Check data types (pandas dtypes of an empty table with the file schema)
+    check_dtypes(profile["schema"].empty_table().to_pandas().dtypes)
+
+    # Fall back to projected reads for columns without statistics
+    storage.fetch(input_file, missing_stats_columns(profile, columns))
+    read_columns = fill_missing_stats(local_file, profile, columns)
+    if read_columns:
+        logger.info(f"Statistics missing, read columns: {read_columns}")
+
+    # Check for nulls
+    null_counts = {col: count for col,
+                   count in profile["null_counts"].items() if count}
+    if null_counts:
+        logger.warning(f"Null values per column: {null_counts}")
+    else:
+        logger.info("No null values found")
+
+    # Range checks
+    month_start = pd.Timestamp(f"{month}-01")
+    month_end = month_start + pd.offsets.MonthBegin(1)
+    for col in ["tpep_pickup_datetime", "tpep_dropoff_datetime"]:
+        low, high = profile["min"].get(col), profile["max"].get(col)
+        if low is None or high is None:
+            continue
+        if pd.Timestamp(low) < month_start or pd.Timestamp(high) >= month_end:
+            logger.warning(f"{col} outside {month}: min {low}, max {high}")
         else:
-            logger.info("All expected columns present")
-
-        # Check data types
-        expected_dtypes = {
-            "VendorID": "int64",
-            "tpep_pickup_datetime": "datetime64[ns]",
-            "tpep_dropoff_datetime": "datetime64[ns]",
-            "passenger_count": "float64",
-            "trip_distance": "float64",
-            "RatecodeID": "float64",
-            "PULocationID": "int64",
-            "DOLocationID": "int64",
-            "payment_type": "int64",
-            "fare_amount": "float64",
-            "tip_amount": "float64",
-            "improvement_surcharge": "float64",
-            "total_amount": "float64",
-            "congestion_surcharge": "float64",
-            "Airport_fee": "float64",
-            "cbd_congestion_fee": "float64",
-            "Borough": "object"
-        }
-        dtype_mismatch = {}
-        for col, exp_dtype in expected_dtypes.items():
-            if col in df.columns and str(df[col].dtype) != exp_dtype:
-                dtype_mismatch[col] = {
-                    "expected": exp_dtype, "actual": str(df[col].dtype)}
-        if dtype_mismatch:
-            logger.warning(f"Data type mismatches: {dtype_mismatch}")
+            logger.info(f"{col} within {month}: min {low}, max {high}")
+    for col, limit in range_limits.items():
+        high = profile["max"].get(col)
+        if high is None:
+            continue
+        if high > limit:
+            logger.warning(f"{col} max {high} exceeds {limit}")
         else:
-            logger.info("All data types match expected")
+            logger.info(f"{col} max: {high}")
 
-        # Check for nulls
-        null_counts = df.isnull().sum()
-        if null_counts.any():
-            logger.warning(f"Null values per column: {null_counts.to_dict()}")
-        else:
-            logger.info("No null values found")
 
-        # Log sample
-        logger.info(f"First 5 rows in {month}:\n{df.head().to_string()}")
+for month in months:
+    input_file = f"{processed_path}/yellow_tripdata_{month}_cleaned.parquet"
+
+    try:
+        if not storage.exists(input_file):
+            logger.warning(f"{input_file} not found, skipping")
+            continue
+
+        logger.info(f"Verifying {input_file} ({verify_mode})")
+        metrics = StageMetrics("verify_processed", dataset="yellow", month=month)
+        with metrics.phase(verify_mode):
+            if verify_mode == "full":
+                verify_full(month, input_file, metrics)
+            else:
+                verify_metadata(month, input_file, metrics)
+        metrics.emit()
 
     except Exception as e:
         logger.error(f"Error verifying {input_file}: {e}", exc_info=True)
@@ -0,0 +1,131 @@
+import os
+import sys
+import json
+import shutil
+import logging
+import tempfile
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from moto import mock_aws
+import storage
+
+# Configuration: runs against moto's in-process S3 (pip install moto), so no bucket
+# or credentials are needed; set S3_ENDPOINT_URL to check a MinIO server instead
+log_path = "logs/storage/"
+bucket = "tlc-storage-check"
+rows = 1_000_000
+
+# Create log directory
+os.makedirs(log_path, exist_ok=True)
+
+# Configure logger
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+log_file = os.path.join(log_path, "verify_storage.log")
+file_handler = logging.FileHandler(log_file)
+file_handler.setFormatter(logging.Formatter(
+    "%(asctime)s - %(levelname)s - %(message)s"))
+logger.addHandler(file_handler)
+
+failures = []
+
+
+def check(name, ok):
+    if ok:
+        logger.info(f"{name}: OK")
+    else:
+        logger.error(f"{name}: FAILED")
+        failures.append(name)
+
+
+# Incompressible float columns, so the file spans several upload parts
+def write_sample(path, seed):
+    rng = np.random.default_rng(seed)
+    table = pa.table({name: rng.random(rows) for name in ("fare_amount", "tip_amount", "trip_distance")})
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pq.write_table(table, path, row_group_size=rows // 4, compression="none")
+    return table
+
+
+# Bytes of an object held in the cache
+def cached_bytes(entry_file):
+    with open(f"{entry_file}.json") as f:
+        return sum(end - start for start, end in json.load(f)["ranges"])
+
+
+def run_checks(workdir):
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.chdir(workdir)  # Keys come from the relative data/ paths, as in the stage scripts
+    cache_root = "cache"
+    store = storage.S3Storage(f"s3://{bucket}/checks", storage.s3_endpoint_url, cache_root, cache_limit=2**40)
+    store.client.create_bucket(Bucket=bucket)
+    path = "data/processed/2025/yellow/yellow_tripdata_2025-01_cleaned.parquet"
+    table = write_sample(path, seed=1)
+    size = os.path.getsize(path)
+
+    # Multipart upload: the file is moved into the cache as a complete entry
+    store.put(path)
+    check("multipart upload", store.size(path) == size and not os.path.exists(path))
+    check("upload cached", pq.read_table(store.fetch(path)).equals(table))
+
+    # Footer-only and projected reads on a cold cache
+    shutil.rmtree(cache_root)
+    check("metadata from footer", store.metadata(path).num_rows == rows)
+    entry_file = store.cache_file(path)
+    check("footer fetch is small", cached_bytes(entry_file) < size // 10)
+    projected = pq.read_table(store.fetch(path, ["tip_amount"]), columns=["tip_amount"])
+    check("projected read", projected.column("tip_amount").equals(table.column("tip_amount")))
+    check("projected fetch skips other columns", cached_bytes(entry_file) < size // 2)
+
+    # Repeated reads come from the cache without ranged GETs
+    get_range = store.get_range
+    requests = []
+    store.get_range = lambda *args: requests.append(args) or get_range(*args)
+    pq.read_table(store.fetch(path, ["tip_amount"]), columns=["tip_amount"])
+    check("cache hit without download", not requests)
+    check("full read", pq.read_table(store.fetch(path)).equals(table))
+    check("full read fetches only the rest", 0 < len(requests) <= size // storage.part_bytes + 2)
+    store.get_range = get_range
+
+    # An object replaced behind the cache is re-fetched (ETag mismatch)
+    replacement = write_sample(f"{path}.new", seed=2)
+    store.client.upload_file(f"{path}.new", bucket, store.key(path))
+    os.remove(f"{path}.new")
+    check("replaced object re-fetched", pq.read_table(store.fetch(path)).equals(replacement))
+
+    # LRU eviction keeps the cache within its limit, dropping the oldest object first
+    other = "data/raw/2025/yellow/yellow_tripdata_2025-01.parquet"
+    write_sample(other, seed=3)
+    store.put(other)
+    store.cache_limit = size + size // 2
+    store.fetch(path)
+    store.evict()
+    check("LRU eviction", os.path.exists(store.cache_file(path))
+          and not os.path.exists(store.cache_file(other)))
+
+    store.remove(path)
+    check("remove", not store.exists(path) and not os.path.exists(store.cache_file(path)))
+
+
+workdir = tempfile.mkdtemp()
+cwd = os.getcwd()
+try:
+    if storage.s3_endpoint_url:
+        run_checks(workdir)
+    else:
+        with mock_aws():
+            run_checks(workdir)
+except Exception as e:
+    logger.error(f"Storage checks failed: {e}", exc_info=True)
+    failures.append("error")
+finally:
+    os.chdir(cwd)
+    shutil.rmtree(workdir)
+    logger.removeHandler(file_handler)
+    file_handler.close()
+
+print(f"Storage checks completed: {len(failures)} failed")
+sys.exit(1 if failures else 0)
@@ -0,0 +1,302 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# Column definitions for the cleaned yellow trips table
+yellow_table_columns = [
+    ("VendorID", "INTEGER"),
+    ("tpep_pickup_datetime", "TIMESTAMP"),
+    ("tpep_dropoff_datetime", "TIMESTAMP"),
+    ("passenger_count", "FLOAT"),
+    ("trip_distance", "FLOAT"),
+    ("RatecodeID", "FLOAT"),
+    ("PULocationID", "INTEGER"),
+    ("DOLocationID", "INTEGER"),
+    ("payment_type", "INTEGER"),
+    ("fare_amount", "FLOAT"),
+    ("tip_amount", "FLOAT"),
+    ("improvement_surcharge", "FLOAT"),
+    ("total_amount", "FLOAT"),
+    ("congestion_surcharge", "FLOAT"),
+    ("Airport_fee", "FLOAT"),
+    ("cbd_congestion_fee", "FLOAT"),
+    ("Borough", "VARCHAR"),
+]
+
+
+# Timestamps as the strings every row-insert path sends ("2025-01-01 00:18:38.000000"),
+# at microsecond precision whatever the unit of the file
+def timestamp_strings(column):
+    return pc.cast(pc.cast(column, pa.timestamp("us", column.type.tz), safe=False), pa.string())
+
+
+# Rows of a record batch for executemany, with timestamps as ISO strings
+def batch_rows(batch):
+    columns = [timestamp_strings(col) if pa.types.is_timestamp(col.type) else col
+               for col in batch.columns]
+    return zip(*[col.to_pylist() for col in columns])
+
+
+# Snowflake backend: row inserts through executemany, bulk loads through PUT + COPY INTO
+class SnowflakeWarehouse:
+    placeholder = "%s"
+    timestamp_type = "TIMESTAMP_NTZ"
+
+    def __init__(self, config):
+        import snowflake.connector
+        self.conn = snowflake.connector.connect(**config)
+        self.conn.autocommit(False)  # Explicit commits so month replacements are atomic
+
+    def execute(self, sql, params=None):
+        cursor = self.conn.cursor()
+        cursor.execute(sql, params)
+        return cursor
+
+    def create_table(self, table, columns):
+        column_defs = ",\n        ".join(
+            f"{name} {self.timestamp_type if sql_type == 'TIMESTAMP' else sql_type}"
+            for name, sql_type in columns)
+        self.execute(f"""
+    CREATE TABLE IF NOT EXISTS {table} (
+        {column_defs}
+    )
+    """)
+
+    def truncate(self, table):
+        self.execute(f"TRUNCATE TABLE {table}")
+
+    def delete_range(self, table, column, start, end):
+        self.execute(
+            f"DELETE FROM {table} WHERE {column} >= {self.placeholder} AND {column} < {self.placeholder}", (start, end))
+
+    def count_range(self, table, column, start, end):
+        return self.execute(
+            f"SELECT COUNT(*) FROM {table} WHERE {column} >= {self.placeholder} AND {column} < {self.placeholder}", (start, end)).fetchone()[0]
+
+    def insert_rows(self, table, columns, rows):
+        sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join([self.placeholder] * len(columns))})"
+        self.conn.cursor().executemany(sql, rows)
+
+    # Insert a stream of record batches (the fused transform-to-load path), one executemany per batch
+    def insert_batches(self, table, batches, columns):
+        total_rows = 0
+        for batch in batches:
+            self.insert_rows(table, columns, list(batch_rows(batch.select(columns))))
+            total_rows += batch.num_rows
+        return total_rows
+
+    # Stage the compressed Parquet file in the table stage and copy it in one statement
+    # Extra file columns (e.g. optional zone columns) are skipped by MATCH_BY_COLUMN_NAME
+    def bulk_load(self, table, parquet_file, columns):
+        file_name = os.path.basename(parquet_file)
+        self.execute(
+            f"PUT 'file://{os.path.abspath(parquet_file)}' @%{table} AUTO_COMPRESS=FALSE OVERWRITE=TRUE")
+        cursor = self.execute(f"""
+    COPY INTO {table} FROM @%{table}
+    FILES = ('{file_name}')
+    FILE_FORMAT = (TYPE = PARQUET)
+    MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE
+    PURGE = TRUE
+    FORCE = TRUE
+    """)
+        return sum(row[3] for row in cursor.fetchall() if len(row) > 3)
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+
+# Local SQLite stand-in; bulk loads stream Arrow batches inside one transaction.
+# latency (seconds) is slept for every statement and commit to mimic a network round trip.
+class SQLiteWarehouse:
+    placeholder = "?"
+    timestamp_type = "TEXT"
+    owed = 0.0  # Round trips of the open write transaction, slept after it ends
+
+    def __init__(self, path, latency=0.0):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.latency = latency
+        self.conn = sqlite3.connect(path, timeout=600, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+
+    # SQLite holds one database-wide write lock from a transaction's first write until
+    # it ends, which a networked warehouse does not. Round trips before that are slept
+    # right away; inside a write transaction they are owed and slept once the lock is
+    # released, so simulated latency never serializes concurrent loads.
+    def round_trip(self):
+        if not self.latency:
+            return
+        if self.holds_write_lock():
+            self.owed += self.latency
+        else:
+            time.sleep(self.latency)
+
+    def holds_write_lock(self):
+        return self.conn.in_transaction
+
+    def settle(self):
+        if self.owed:
+            time.sleep(self.owed)
+            self.owed = 0.0
+
+    def execute(self, sql, params=None):
+        self.round_trip()
+        return self.conn.execute(sql, params or ())
+
+    def create_table(self, table, columns):
+        column_defs = ", ".join(
+            f"{name} {self.timestamp_type if sql_type == 'TIMESTAMP' else sql_type}"
+            for name, sql_type in columns)
+        self.execute(f"CREATE TABLE IF NOT EXISTS {table} ({column_defs})")
+
+    def truncate(self, table):
+        self.execute(f"DELETE FROM {table}")
+
+    def delete_range(self, table, column, start, end):
+        self.execute(
+            f"DELETE FROM {table} WHERE {column} >= {self.placeholder} AND {column} < {self.placeholder}", (start, end))
+
+    def count_range(self, table, column, start, end):
+        return self.execute(
+            f"SELECT COUNT(*) FROM {table} WHERE {column} >= {self.placeholder} AND {column} < {self.placeholder}", (start, end)).fetchone()[0]
+
+    def insert_rows(self, table, columns, rows):
+        sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join([self.placeholder] * len(columns))})"
+        self.round_trip()
+        self.conn.executemany(sql, rows)
+
+    def bulk_load(self, table, parquet_file, columns):
+        return self.insert_batches(table, pq.ParquetFile(parquet_file).iter_batches(columns=columns), columns)
+
+    def insert_batches(self, table, batches, columns):
+        total_rows = 0
+        for batch in batches:
+            self.insert_rows(table, columns, batch_rows(batch.select(columns)))
+            total_rows += batch.num_rows
+        return total_rows
+
+    def commit(self):
+        self.round_trip()
+        self.conn.commit()
+        self.settle()
+
+    def rollback(self):
+        self.conn.rollback()
+        self.settle()
+
+    def close(self):
+        self.conn.close()
+
+
+# Local DuckDB stand-in (optional dependency); bulk loads are one INSERT ... SELECT over read_parquet
+class DuckDBWarehouse(SQLiteWarehouse):
+    timestamp_type = "TIMESTAMP"
+
+    # DuckDB allows a single database instance per file and process, so pooled
+    # connections are cursors of one shared instance
+    instances = {}
+    instances_lock = threading.Lock()
+
+    def __init__(self, path, latency=0.0):
+        import duckdb
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.latency = latency
+        with self.instances_lock:
+            if path not in self.instances:
+                self.instances[path] = duckdb.connect(path)
+            self.conn = self.instances[path].cursor()
+        self.conn.begin()
+
+    def insert_rows(self, table, columns, rows):
+        sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join([self.placeholder] * len(columns))})"
+        self.round_trip()
+        self.conn.executemany(sql, list(rows))
+
+    def bulk_load(self, table, parquet_file, columns):
+        column_list = ", ".join(columns)
+        self.execute(
+            f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM read_parquet(?)", [parquet_file])
+        return pq.ParquetFile(parquet_file).metadata.num_rows
+
+    # Each batch is registered as a view and copied with INSERT ... SELECT, without row conversion
+    def insert_batches(self, table, batches, columns):
+        column_list = ", ".join(columns)
+        total_rows = 0
+        for batch in batches:
+            self.conn.register("incoming_batch", pa.Table.from_batches([batch.select(columns)]))
+            try:
+                self.execute(f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM incoming_batch")
+            finally:
+                self.conn.unregister("incoming_batch")
+            total_rows += batch.num_rows
+        return total_rows
+
+    # Concurrent transactions do not lock each other out (optimistic MVCC)
+    def holds_write_lock(self):
+        return False
+
+    def commit(self):
+        self.round_trip()
+        self.conn.commit()
+        self.conn.begin()
+
+    def rollback(self):
+        self.conn.rollback()
+        self.conn.begin()
+
+
+# Open the configured warehouse backend ("snowflake", "sqlite" or "duckdb")
+def connect_warehouse(backend, snowflake_config=None, local_path="data/warehouse/tlc.db", latency=0.0):
+    if backend == "snowflake":
+        return SnowflakeWarehouse(snowflake_config)
+    if backend == "sqlite":
+        return SQLiteWarehouse(local_path, latency)
+    if backend == "duckdb":
+        return DuckDBWarehouse(local_path, latency)
+    raise ValueError(f"Unknown warehouse backend: {backend}")
+
+
+# Bounded pool of warehouse connections, opened lazily and handed out one per worker
+class ConnectionPool:
+    def __init__(self, connect, size):
+        self.connect = connect
+        self.size = size
+        self.idle = queue.Queue()
+        self.opened = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        try:
+            warehouse = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_open = len(self.opened) < self.size
+                if can_open:
+                    warehouse = self.connect()
+                    self.opened.append(warehouse)
+            if not can_open:
+                warehouse = self.idle.get()
+        try:
+            yield warehouse
+        finally:
+            self.idle.put(warehouse)
+
+    def close(self):
+        with self.lock:
+            for warehouse in self.opened:
+                warehouse.close()
+            self.opened = []
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Lookup attributes carried for each location ID
+zone_attributes = ["Borough", "Zone", "service_zone"]
+
+
+# Dense LocationID index over taxi_zone_lookup.csv. Location IDs are a dense
+# 1-265 range, so every attribute is stored as an int32 code per ID plus a small
+# dictionary of distinct values; lookups are a vectorized gather that returns
+# dictionary-encoded arrays instead of a hash join producing object strings.
+class ZoneIndex:
+    def __init__(self, lookup):
+        self.size = int(lookup["LocationID"].max()) + 1
+        self.codes = {}
+        self.dictionaries = {}
+        for attribute in zone_attributes:
+            if attribute not in lookup.columns:
+                continue
+            values = lookup.set_index("LocationID")[attribute].reindex(range(self.size))
+            # Missing lookup values (e.g. "N/A" read as NaN) stay null, as in a left merge
+            categories = pd.Categorical(values)
+            self.codes[attribute] = categories.codes.astype(np.int32)  # -1 = null
+            self.dictionaries[attribute] = pa.array(categories.categories.astype(str), type=pa.string())
+
+    @classmethod
+    def load(cls, path):
+        return cls(pd.read_csv(path))
+
+    # Positions into the dense arrays; null or out-of-range IDs map to slot 0 (always null)
+    def positions(self, ids):
+        ids = pc.cast(ids, pa.int64())
+        raw = ids.to_numpy(zero_copy_only=False) if ids.null_count == 0 else \
+            pc.fill_null(ids, 0).to_numpy(zero_copy_only=False)
+        in_range = (raw > 0) & (raw < self.size)
+        return np.where(in_range, raw, 0), raw, in_range
+
+    # Gather one attribute for an array of location IDs as a dictionary array
+    def gather(self, ids, attribute, positions=None):
+        slots = positions[0] if positions is not None else self.positions(ids)[0]
+        codes = self.codes[attribute][slots]
+        indices = pa.array(codes, type=pa.int32(), mask=codes < 0)
+        return pa.DictionaryArray.from_arrays(indices, self.dictionaries[attribute])
+
+    # Rows and distinct IDs without a value for attribute, counted with a bincount
+    # over the dense ID range (out-of-range IDs are collected separately)
+    def unmatched(self, ids, attribute, positions=None):
+        slots, raw, in_range = positions if positions is not None else self.positions(ids)
+        missing = self.codes[attribute][slots] < 0
+        counts = np.bincount(slots[missing & in_range], minlength=self.size)
+        unmatched_ids = np.flatnonzero(counts).tolist()
+        out_of_range = raw[~in_range]
+        if ids.null_count:
+            out_of_range = raw[~in_range & ~np.asarray(pc.is_null(ids))]
+        unmatched_ids += np.unique(out_of_range).tolist()
+        return int(missing.sum()), unmatched_ids